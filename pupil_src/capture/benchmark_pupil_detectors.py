@@ -0,0 +1,236 @@
+'''
+(*)~----------------------------------------------------------------------------------
+ Pupil - eye tracking platform
+ Copyright (C) 2012-2014  Pupil Labs
+
+ Distributed under the terms of the CC BY-NC-SA License.
+ License details are in the file license.txt, distributed as part of this software.
+----------------------------------------------------------------------------------~(*)
+'''
+
+"""
+Headless benchmark of pupil detectors over a recorded eye video.
+
+Every frame of the video is read with FileCapture and handed to the detector,
+only the detect() call is timed (decoding is reported separately).
+The report (frames per second, p50/p95/p99 latency, time per stage, detection rate
+and confidence distribution) is printed and saved as JSON together with the software version,
+so results of different commits can be compared with the compare command.
+
+usage: python benchmark_pupil_detectors.py path/to/eye.avi [option=value ...]
+       python benchmark_pupil_detectors.py compare old.json new.json
+options: detector   registry name ('Canny Edges','Blob','MSER'), class name (Canny_Detector)
+                    or module:Class for any other Pupil_Detector subclass (default: Canny_Detector)
+         out_file   json report (default: next to the video as benchmark_<detector>.json)
+         start_frame, max_frames, warm_up (frames detected before the measurement starts)
+         and any setting of the detector (e.g. pupil_max for Canny_Detector)
+example: python benchmark_pupil_detectors.py ~/recordings/2014_05_01/000/eye.avi detector=MSER max_frames=1000
+"""
+
+import sys, os, json
+# make shared modules available across pupil_src
+pupil_base_dir = os.path.abspath(__file__).rsplit('pupil_src', 1)[0]
+sys.path.append(os.path.join(pupil_base_dir, 'pupil_src', 'shared_modules'))
+
+from time import time
+import numpy as np
+from methods import Roi, Temp
+from uvc_capture import FileCapture
+import pupil_detectors
+from pupil_detectors.template import Pupil_Detector
+
+#logging
+import logging
+logger = logging.getLogger(__name__)
+
+
+def detector_class(name):
+    """
+    find a detector class by registry name, class name or 'module:Class'
+    """
+    if name in pupil_detectors.detector_by_name:
+        return pupil_detectors.detector_by_name[name]
+    for cls in pupil_detectors.detector_by_index:
+        if cls.__name__ == name:
+            return cls
+    if ':' in name:
+        module_name,cls_name = name.split(':',1)
+        cls = getattr(__import__(module_name,fromlist=[cls_name]),cls_name)
+        if issubclass(cls,Pupil_Detector):
+            return cls
+    raise ValueError("Unknown pupil detector '%s', use one of %s, a class name or module:Class."%(name,pupil_detectors.name_by_index))
+
+
+def percentiles(values,ps=(50,95,99)):
+    if len(values) == 0:
+        return dict([('p%s'%p,None) for p in ps])
+    return dict([('p%s'%p,float(v)) for p,v in zip(ps,np.percentile(values,ps))])
+
+
+def benchmark_detector(video_path,detector='Canny_Detector',settings=None,start_frame=0,max_frames=None,warm_up=10):
+    """
+    run a detector over an eye video and return the report as a dict.
+    settings are applied with set_settings() if the detector has it.
+    The first warm_up frames are detected but not measured (lazy allocations, strong prior).
+    """
+    cls = detector_class(detector)
+    g_pool = Temp()
+    g_pool.user_dir = None #headless: no persistent detector settings
+    pupil_detector = cls(g_pool)
+    if settings and hasattr(pupil_detector,'set_settings'):
+        pupil_detector.set_settings(settings)
+
+    cap = FileCapture(video_path)
+    if not cap.cap.isOpened():
+        raise IOError("Could not open %s"%video_path)
+    if start_frame:
+        cap.seek_to_frame(start_frame)
+
+    stages = pupil_detector.stages
+    latencies = []
+    decode_times = []
+    stage_times = dict([(stage,[]) for stage in stages])
+    confidences = []
+    detected = 0
+    u_r = None
+    n = 0
+    while max_frames is None or n < max_frames+warm_up:
+        t0 = time()
+        frame = cap.get_frame()
+        t1 = time()
+        if not frame:
+            break
+        if u_r is None:
+            u_r = Roi(frame.img.shape)
+        result = pupil_detector.detect_profiled(frame,u_r,visualize=False)
+        t2 = time()
+        n += 1
+        if n <= warm_up:
+            continue
+        decode_times.append(t1-t0)
+        latencies.append(t2-t1)
+        for stage in stages:
+            stage_times[stage].append(pupil_detector.profile.frame_times[stage])
+        if result.get('norm_pupil') is not None:
+            detected += 1
+            if 'confidence' in result:
+                confidences.append(result['confidence'])
+
+    pupil_detector.cleanup()
+    cap.close()
+
+    frames = len(latencies)
+    if not frames:
+        raise IOError("No frames to measure in %s (start_frame %s, warm_up %s)."%(video_path,start_frame,warm_up))
+    latencies = np.array(latencies)*1000.
+    confidences = np.array(confidences)
+
+    report = {}
+    report['detector'] = cls.__name__
+    report['settings'] = pupil_detector.get_settings() if hasattr(pupil_detector,'get_settings') else {}
+    report['video'] = os.path.abspath(video_path)
+    report['version'] = software_version()
+    report['frames'] = frames
+    report['fps'] = frames/(latencies.sum()/1000.)
+    report['latency_ms'] = percentiles(latencies)
+    report['latency_ms']['mean'] = float(latencies.mean())
+    report['latency_ms']['max'] = float(latencies.max())
+    report['decode_ms'] = float(np.mean(decode_times)*1000.)
+    report['stages_ms'] = dict([(stage,float(np.mean(t)*1000.)) for stage,t in stage_times.iteritems()])
+    report['detection_rate'] = detected/float(frames)
+    report['confidence'] = percentiles(confidences,(5,25,50,75,95))
+    report['confidence']['mean'] = float(confidences.mean()) if confidences.size else None
+    histogram,edges = np.histogram(confidences,bins=10,range=(0,1))
+    report['confidence']['histogram'] = histogram.tolist()
+    report['confidence']['bin_edges'] = edges.tolist()
+    return report
+
+
+def software_version():
+    from git_version import get_tag_commit
+    cwd = os.getcwd()
+    try:
+        os.chdir(os.path.dirname(os.path.abspath(__file__)))
+        return get_tag_commit()
+    finally:
+        os.chdir(cwd)
+
+
+def format_report(report):
+    lines = ["%s on %s (%s frames, version %s)"%(report['detector'],report['video'],report['frames'],report['version'])]
+    l = report['latency_ms']
+    lines.append("  %.1f frames per second, latency p50 %.2fms p95 %.2fms p99 %.2fms max %.2fms (decoding %.2fms)"%(report['fps'],l['p50'],l['p95'],l['p99'],l['max'],report['decode_ms']))
+    lines.append("  stages: "+", ".join(["%s %.2fms"%(stage,report['stages_ms'][stage]) for stage in sorted(report['stages_ms'],key=lambda s:-report['stages_ms'][s])]))
+    c = report['confidence']
+    if c['mean'] is None:
+        lines.append("  detection rate %.1f%%, no confidence reported"%(report['detection_rate']*100))
+    else:
+        lines.append("  detection rate %.1f%%, confidence mean %.2f p5 %.2f p50 %.2f p95 %.2f"%(report['detection_rate']*100,c['mean'],c['p5'],c['p50'],c['p95']))
+    return "\n".join(lines)
+
+
+def compare_reports(old,new):
+    """
+    relative changes of the headline numbers between two reports
+    """
+    def change(a,b):
+        if a is None or b is None or a == 0:
+            return "%s -> %s"%(a,b)
+        return "%.3g -> %.3g (%+.1f%%)"%(a,b,(b-a)/float(a)*100)
+    lines = ["%s (%s) -> %s (%s)"%(old['detector'],old['version'],new['detector'],new['version'])]
+    if old['video'] != new['video'] or old['frames'] != new['frames']:
+        lines.append("  warning: the reports are not from the same frames of the same video.")
+    lines.append("  fps            "+change(old['fps'],new['fps']))
+    for p in ('p50','p95','p99'):
+        lines.append("  latency %s ms  "%p+change(old['latency_ms'][p],new['latency_ms'][p]))
+    lines.append("  detection rate "+change(old['detection_rate'],new['detection_rate']))
+    lines.append("  confidence p50 "+change(old['confidence']['p50'],new['confidence']['p50']))
+    for stage in sorted(set(old['stages_ms']) & set(new['stages_ms'])):
+        lines.append("  %-14s "%stage+change(old['stages_ms'][stage],new['stages_ms'][stage]))
+    return "\n".join(lines)
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.WARNING)
+    if len(sys.argv) < 2:
+        print __doc__
+        sys.exit(1)
+
+    if sys.argv[1] == 'compare':
+        with open(sys.argv[2]) as f:
+            old = json.load(f)
+        with open(sys.argv[3]) as f:
+            new = json.load(f)
+        print compare_reports(old,new)
+        sys.exit(0)
+
+    video_path = sys.argv[1]
+    kwargs = {}
+    options = dict([arg.split('=',1) for arg in sys.argv[2:]])
+    detector = options.pop('detector','Canny_Detector')
+    out_file = options.pop('out_file',None)
+    for name in ('start_frame','max_frames','warm_up'):
+        if name in options:
+            kwargs[name] = int(options.pop(name))
+
+    # remaining options are detector settings, typed like the detector defaults
+    settings = {}
+    if options:
+        g_pool = Temp()
+        g_pool.user_dir = None
+        default_detector = detector_class(detector)(g_pool)
+        defaults = default_detector.get_settings() if hasattr(default_detector,'get_settings') else {}
+        default_detector.cleanup()
+        for name,value in options.iteritems():
+            if name not in defaults:
+                print "Unknown option '%s'."%name
+                sys.exit(1)
+            settings[name] = type(defaults[name])(value)
+
+    report = benchmark_detector(video_path,detector,settings,**kwargs)
+    if out_file is None:
+        out_file = os.path.join(os.path.dirname(os.path.abspath(video_path)),'benchmark_%s.json'%report['detector'])
+    with open(out_file,'w') as f:
+        json.dump(report,f,indent=4,sort_keys=True)
+    print format_report(report)
+    print "Saved report to %s"%out_file
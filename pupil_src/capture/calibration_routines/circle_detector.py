@@ -9,64 +9,165 @@
 '''
 import numpy as np
 import cv2
-
-def get_canditate_ellipses(img,area_threshold,dist_threshold,min_ring_count, visual_debug):
-    gray_img = cv2.cvtColor(img,cv2.COLOR_BGR2GRAY)
-
-    # get threshold image used to get crisp-clean edges
-    edges = cv2.adaptiveThreshold(gray_img, 255, cv2.ADAPTIVE_THRESH_MEAN_C, cv2.THRESH_BINARY, 7, 7)
-    # cv2.flip(edges,1 ,dst = edges,)
-    # display the image for debugging purpuses
-    # img[:] = cv2.cvtColor(edges,cv2.COLOR_GRAY2BGR)
-     # from edges to contours to ellipses CV_RETR_CCsOMP ls fr hole
-    contours, hierarchy = cv2.findContours(edges,
-                                    mode=cv2.RETR_TREE,
-                                    method=cv2.CHAIN_APPROX_NONE,offset=(0,0)) #TC89_KCOS
-
-
-    # remove extra encapsulation
-    hierarchy = hierarchy[0]
-    # turn outmost list into array
-    contours =  np.array(contours)
-    # keep only contours                        with parents     and      children
-    contained_contours = contours[np.logical_and(hierarchy[:,3]>=0, hierarchy[:,2]>=0)]
-    # turn on to debug contours
-    if visual_debug:
-        cv2.drawContours(img, contained_contours,-1, (0,0,255))
-
-    # need at least 5 points to fit ellipse
-    contained_contours =  [c for c in contained_contours if len(c) >= 5]
-
-    ellipses = [cv2.fitEllipse(c) for c in contained_contours]
-    candidate_ellipses = []
-    # filter for ellipses that have similar area as the source contour
-    for e,c in zip(ellipses,contained_contours):
-        a,b = e[1][0]/2.,e[1][1]/2.
-        if abs(cv2.contourArea(c)-np.pi*a*b) <area_threshold:
-            candidate_ellipses.append(e)
+from ctypes import c_int,c_bool
+from stage_profile import Stage_Profile
+#logging
+import logging
+logger = logging.getLogger(__name__)
 
 
-
-
-    candidate_ellipses = get_cluster(candidate_ellipses,dist_threshold = dist_threshold,min_ring_count=min_ring_count)
-
-    return candidate_ellipses
+def get_canditate_ellipses(img,area_threshold,dist_threshold,min_ring_count, visual_debug):
+    """
+    one full resolution search of the whole frame, see Concentric_Ring_Detector for the tracking version.
+    """
+    detector = Concentric_Ring_Detector(min_ring_count,pyramid_level=0,tracking=False)
+    return detector.detect(img,area_threshold,dist_threshold,visual_debug)
+
+
+class Concentric_Ring_Detector(object):
+    """
+    finds the concentric rings of a calibration marker.
+
+    - the search runs on the frame downscaled by 2**pyramid_level,
+      the ellipses are returned in full frame pixels.
+    - while the marker is found only a region around its last position
+      (tracking_margin times its outer diameter in every direction) is searched.
+      When the marker is not in that region the whole frame is searched in the same call.
+    - ellipses are clustered with a spatial hash of their centers instead of comparing all pairs.
+    - the time per stage is kept in self.profile, full_scans counts searches of the whole frame
+      and tracked_frames the frames where the marker was found in the tracking region.
+    """
+    stages = ('downscale','threshold','contours','fit','cluster')
+    def __init__(self,min_ring_count=3,pyramid_level=1,tracking=True,tracking_margin=1.):
+        super(Concentric_Ring_Detector, self).__init__()
+        self.min_ring_count = min_ring_count
+        self.pyramid_level = c_int(pyramid_level)
+        self.tracking = c_bool(tracking)
+        self.tracking_margin = tracking_margin
+        self.profile = Stage_Profile(self.stages)
+        self.full_scans = c_int(0)
+        self.tracked_frames = c_int(0)
+        self._marker = None # center x,y and outer diameter of the last marker in full frame pixels
+
+    def detect(self,img,area_threshold,dist_threshold,visual_debug=False):
+        """
+        returns the ellipses of the first marker found, smallest first, or []
+        """
+        self.profile.start()
+        h,w = img.shape[:2]
+        ellipses = []
+        if self._marker and self.tracking.value:
+            x,y,size = self._marker
+            r = size*self.tracking_margin
+            region = max(0,int(x-r)),max(0,int(y-r)),min(w,int(x+r)+1),min(h,int(y+r)+1)
+            ellipses = self.detect_in_region(img,region,area_threshold,dist_threshold,visual_debug)
+            if ellipses:
+                self.tracked_frames.value += 1
+        if not ellipses:
+            self.full_scans.value += 1
+            ellipses = self.detect_in_region(img,(0,0,w,h),area_threshold,dist_threshold,visual_debug)
+        self.profile.finish()
+
+        if ellipses:
+            self._marker = ellipses[0][0][0],ellipses[0][0][1],max(ellipses[-1][1])
+        else:
+            self._marker = None
+        return ellipses
+
+    def detect_in_region(self,img,(lX,lY,uX,uY),area_threshold,dist_threshold,visual_debug=False):
+        scale = 2**self.pyramid_level.value
+        # align the region to the pyramid
+        uX = lX + (uX-lX)//scale*scale
+        uY = lY + (uY-lY)//scale*scale
+        if uX-lX < 5*scale or uY-lY < 5*scale:
+            return []
+        region_img = img[lY:uY,lX:uX]
+        gray_img = cv2.cvtColor(region_img,cv2.COLOR_BGR2GRAY)
+        if scale > 1:
+            gray_img = cv2.resize(gray_img,((uX-lX)//scale,(uY-lY)//scale),interpolation=cv2.INTER_AREA)
+        self.profile.mark('downscale')
+
+        # get threshold image used to get crisp-clean edges
+        # the block shrinks with the image, a 7 pixel block on a downscaled image merges the edges of neighbouring rings.
+        block_size = max(3,7//scale|1)
+        edges = cv2.adaptiveThreshold(gray_img, 255, cv2.ADAPTIVE_THRESH_MEAN_C, cv2.THRESH_BINARY, block_size, 7)
+        self.profile.mark('threshold')
+
+        contours, hierarchy = cv2.findContours(edges,
+                                        mode=cv2.RETR_TREE,
+                                        method=cv2.CHAIN_APPROX_NONE,offset=(0,0))
+        if hierarchy is None:
+            self.profile.mark('contours')
+            return []
+        # remove extra encapsulation
+        hierarchy = hierarchy[0]
+        # keep only contours with parents and children and at least 5 points to fit an ellipse
+        contained = np.logical_and(hierarchy[:,3]>=0, hierarchy[:,2]>=0)
+        contained_contours = [c for c,keep in zip(contours,contained) if keep and len(c) >= 5]
+        self.profile.mark('contours')
+
+        # turn on to debug contours
+        if visual_debug:
+            cv2.drawContours(region_img, [c*scale for c in contained_contours],-1, (0,0,255))
+
+        # filter for ellipses that have similar area as the source contour
+        area_threshold = area_threshold/float(scale*scale)
+        candidate_ellipses = []
+        for c in contained_contours:
+            e = cv2.fitEllipse(c)
+            if abs(cv2.contourArea(c)-np.pi*e[1][0]*e[1][1]/4.) < area_threshold:
+                # back to full frame pixels
+                candidate_ellipses.append((((e[0][0]+.5)*scale-.5+lX,(e[0][1]+.5)*scale-.5+lY),(e[1][0]*scale,e[1][1]*scale),e[2]))
+        self.profile.mark('fit')
+
+        candidate_ellipses = get_cluster(candidate_ellipses,dist_threshold = dist_threshold,min_ring_count=self.min_ring_count)
+        self.profile.mark('cluster')
+        return candidate_ellipses
+
+    def add_to_bar(self,bar,group="marker detection"):
+        bar.add_var("pyramid level",self.pyramid_level,min=0,max=1,group=group,help="search the marker on a 1/2 size image (1), the rings of a marker are too thin for smaller images.")
+        bar.add_var("track marker",self.tracking,group=group,help="search only around the last marker position while it is found.")
+        bar.add_var("full scans",self.full_scans,readonly=True,group=group)
+        bar.add_var("tracked frames",self.tracked_frames,readonly=True,group=group)
+        self.profile.add_to_bar(bar)
 
 
 def man_dist(e,other):
     return abs(e[0][0]-other[0][0])+abs(e[0][1]-other[0][1])
 
 def get_cluster(ellipses,dist_threshold,min_ring_count):
+    """
+    the first ellipse (in input order) that has at least min_ring_count ellipses (itself included)
+    closer than dist_threshold and the minor axes of both, returns these sorted by major axis.
+
+    Close ellipses are at most dist_threshold apart in x and y so only the
+    3x3 neighbouring cells of a grid with dist_threshold sized cells need to be compared.
+    """
+    if len(ellipses) < min_ring_count or dist_threshold <= 0:
+        return []
+    cells = {}
+    for idx,e in enumerate(ellipses):
+        cells.setdefault((int(e[0][0]//dist_threshold),int(e[0][1]//dist_threshold)),[]).append(idx)
+
     for e in ellipses:
+        cx,cy = int(e[0][0]//dist_threshold),int(e[0][1]//dist_threshold)
+        neighbours = []
+        for dx in (-1,0,1):
+            for dy in (-1,0,1):
+                neighbours.extend(cells.get((cx+dx,cy+dy),()))
+        if len(neighbours) < min_ring_count:
+            continue
+        neighbours.sort()
+        e_minor = min(*e[1])
         close_ones = []
-        for other in ellipses:
+        for idx in neighbours:
+            other = ellipses[idx]
             # distance to other ellipse is smaller than min dist threshold and minor of both ellipses
-            if man_dist(e,other)<dist_threshold and man_dist(e,other) < min(min(*e[1]),min(other[1])) :
+            d = man_dist(e,other)
+            if d<dist_threshold and d < min(e_minor,min(other[1])):
                 close_ones.append(other)
         if len(close_ones)>=min_ring_count:
             # sort by major axis to return smallest ellipse first
             close_ones.sort(key=lambda e: max(e[1]))
             return close_ones
     return []
-
-
@@ -13,7 +13,7 @@ import cv2
 import numpy as np
 from methods import normalize,denormalize
 from gl_utils import draw_gl_point,draw_gl_point_norm,draw_gl_polyline
-from circle_detector import get_canditate_ellipses
+from circle_detector import Concentric_Ring_Detector
 import calibrate
 
 from ctypes import c_int,c_bool
@@ -47,6 +47,7 @@ class Manual_Marker_Calibration(Plugin):
         self.counter = 0
         self.counter_max = 30
         self.candidate_ellipses = []
+        self.ring_detector = Concentric_Ring_Detector(min_ring_count=3,pyramid_level=0)
         self.show_edges = c_bool(0)
         self.aperture = 7
         self.dist_threshold = c_int(10)
@@ -67,6 +68,7 @@ class Manual_Marker_Calibration(Plugin):
         # self._bar.add_var("aperture", self.aperture, min=3,step=2, group="Advanced")
         # self._bar.add_var("area threshold", self.area_threshold, group="Advanced")
         # self._bar.add_var("eccetricity threshold", self.dist_threshold, group="Advanced")
+        self.ring_detector.add_to_bar(self._bar)
 
     def start_stop(self):
         if self.active:
@@ -90,12 +92,11 @@ class Manual_Marker_Calibration(Plugin):
         self.active = False
 
 
-        cal_pt_cloud = calibrate.preprocess_data(self.pupil_list,self.ref_list)
+        cal_pt_cloud = calibrate.make_cal_pt_cloud(self.pupil_list,self.ref_list)
         logger.info("Collected %s data points." %len(cal_pt_cloud))
         if len(cal_pt_cloud) < 20:
             logger.warning("Did not collect enough data.")
             return
-        cal_pt_cloud = np.array(cal_pt_cloud)
         self.g_pool.map_pupil = calibrate.get_map_from_cloud(cal_pt_cloud,self.world_size)
         np.save(os.path.join(self.g_pool.user_dir,'cal_pt_cloud.npy'),cal_pt_cloud)
 
@@ -117,10 +118,9 @@ class Manual_Marker_Calibration(Plugin):
             if self.world_size is None:
                 self.world_size = img.shape[1],img.shape[0]
 
-            self.candidate_ellipses = get_canditate_ellipses(img,
+            self.candidate_ellipses = self.ring_detector.detect(img,
                                                             area_threshold=self.area_threshold.value,
                                                             dist_threshold=self.dist_threshold.value,
-                                                            min_ring_count=3,
                                                             visual_debug=self.show_edges.value)
 
             if len(self.candidate_ellipses) > 0:
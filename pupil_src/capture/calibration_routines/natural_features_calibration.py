@@ -66,12 +66,11 @@ class Natural_Features_Calibration(Plugin):
         audio.say("Stopping Calibration")
         logger.info("Stopping Calibration")
         self.active = False
-        cal_pt_cloud = calibrate.preprocess_data(self.pupil_list,self.ref_list)
+        cal_pt_cloud = calibrate.make_cal_pt_cloud(self.pupil_list,self.ref_list)
         logger.info("Collected %s data points." %len(cal_pt_cloud))
         if len(cal_pt_cloud) < 20:
             logger.warning("Did not collect enough data.")
             return
-        cal_pt_cloud = np.array(cal_pt_cloud)
 
         img_size = self.first_img.shape[1],self.first_img.shape[0]
         self.g_pool.map_pupil = calibrate.get_map_from_cloud(cal_pt_cloud,img_size)
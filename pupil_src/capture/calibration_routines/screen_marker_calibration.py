@@ -17,7 +17,7 @@ import OpenGL.GL as gl
 from glfw import *
 from OpenGL.GLU import gluOrtho2D
 import calibrate
-from circle_detector import get_canditate_ellipses
+from circle_detector import Concentric_Ring_Detector
 
 from ctypes import c_int,c_bool
 import atb
@@ -69,6 +69,7 @@ class Screen_Marker_Calibration(Plugin):
         self.on_position = False
 
         self.candidate_ellipses = []
+        self.ring_detector = Concentric_Ring_Detector(min_ring_count=4,pyramid_level=1)
         self.pos = None
 
         self.show_edges = c_bool(0)
@@ -102,6 +103,7 @@ class Screen_Marker_Calibration(Plugin):
         self._bar.add_var("show edges",self.show_edges)
         self._bar.add_var("area threshold", self.area_threshold)
         self._bar.add_var("eccetricity threshold", self.dist_threshold)
+        self.ring_detector.add_to_bar(self._bar)
 
 
     def start(self):
@@ -171,7 +173,7 @@ class Screen_Marker_Calibration(Plugin):
         self.active = False
         self.window_should_close = True
 
-        cal_pt_cloud = calibrate.preprocess_data(self.pupil_list,self.ref_list)
+        cal_pt_cloud = calibrate.make_cal_pt_cloud(self.pupil_list,self.ref_list)
 
         logger.info("Collected %s data points." %len(cal_pt_cloud))
 
@@ -179,7 +181,6 @@ class Screen_Marker_Calibration(Plugin):
             logger.warning("Did not collect enough data.")
             return
 
-        cal_pt_cloud = np.array(cal_pt_cloud)
         map_fn = calibrate.get_map_from_cloud(cal_pt_cloud,self.world_size)
         self.g_pool.map_pupil = map_fn
         np.save(os.path.join(self.g_pool.user_dir,'cal_pt_cloud.npy'),cal_pt_cloud)
@@ -206,10 +207,9 @@ class Screen_Marker_Calibration(Plugin):
                 self.world_size = img.shape[1],img.shape[0]
 
             #detect the marker
-            self.candidate_ellipses = get_canditate_ellipses(img,
+            self.candidate_ellipses = self.ring_detector.detect(img,
                                                             area_threshold=self.area_threshold.value,
                                                             dist_threshold=self.dist_threshold.value,
-                                                            min_ring_count=4,
                                                             visual_debug=self.show_edges.value)
 
             if len(self.candidate_ellipses) > 0:
@@ -10,6 +10,7 @@
 
 import os
 from time import time, sleep
+from threading import Thread, Lock
 import shelve
 import logging
 from ctypes import c_int,c_bool,c_float
@@ -20,14 +21,23 @@ from gl_utils import basic_gl_setup,adjust_gl_view, draw_gl_texture, clear_gl_sc
 from methods import *
 from uvc_capture import autoCreateCapture
 from calibrate import get_map_from_cloud
-from pupil_detectors import Canny_Detector,MSER_Detector,Blob_Detector
+import pupil_detectors
+from video_writer import Async_Video_Writer
+from record_log import Record_Log
+from frame_slot import Latest_Frame_Slot
 
-def eye(g_pool,cap_src,cap_size):
+def eye(g_pool,cap_src,cap_size,headless=False):
     """
     Creates a window, gl context.
     Grabs images from a capture.
     Streams Pupil coordinates into g_pool.pupil_queue
+
+    Capture (and eye video recording) runs on its own thread and hands the newest frame
+    to the detection thread, a frame is skipped when detection falls behind.
+    The main thread only displays the latest detected frame at up to display_rate Hz.
+    headless: no window and no atb bars, the main thread only waits for quit.
     """
+    display_rate = 30.
 
     # modify the root logger for this process
     logger = logging.getLogger()
@@ -108,12 +118,28 @@ def eye(g_pool,cap_src,cap_size):
             bar.fps.value += .05 * (1. / dt - bar.fps.value)
             bar.dt.value = dt
 
+    def update_detect_fps():
+        old_time, bar.detect_timestamp = bar.detect_timestamp, time()
+        dt = bar.detect_timestamp - old_time
+        if dt:
+            bar.detect_fps.value += .05 * (1. / dt - bar.detect_fps.value)
+
     def get_from_data(data):
         """
         helper for atb getter and setter use
         """
         return data.value
 
+    def open_detector(selection,data):
+        # the detection thread must not use a detector that is being replaced
+        with detector_lock:
+            if g_pool.pupil_detector:
+                g_pool.pupil_detector.cleanup()
+            g_pool.pupil_detector = pupil_detectors.detector_by_index[selection](g_pool)
+            if not headless:
+                g_pool.pupil_detector.create_atb_bar(pos=(10,120))
+        data.value = selection
+
 
     # load session persistent settings
     session_settings = shelve.open(os.path.join(g_pool.user_dir,'user_settings_eye'),protocol=2)
@@ -140,120 +166,177 @@ def eye(g_pool,cap_src,cap_size):
     u_r = Roi(frame.img.shape)
     u_r.set(load('roi',default=None))
 
-    writer = None
-
-    pupil_detector = Canny_Detector(g_pool)
-
-    atb.init()
-    # Create main ATB Controls
-    bar = atb.Bar(name = "Eye", label="Display",
-            help="Scene controls", color=(50, 50, 50), alpha=100,
-            text='light', position=(10, 10),refresh=.3, size=(200, 100))
+    g_pool.pupil_detector = None
+    detector_lock = Lock()
+
+    if headless:
+        bar = Temp()
+    else:
+        atb.init()
+        # Create main ATB Controls
+        bar = atb.Bar(name = "Eye", label="Display",
+                help="Scene controls", color=(50, 50, 50), alpha=100,
+                text='light', position=(10, 10),refresh=.3, size=(200, 100))
     bar.fps = c_float(0.0)
     bar.timestamp = time()
     bar.dt = c_float(0.0)
+    bar.detect_fps = c_float(0.0)
+    bar.detect_timestamp = time()
     bar.sleep = c_float(0.0)
     bar.display = c_int(load('bar.display',0))
     bar.draw_pupil = c_bool(load('bar.draw_pupil',True))
     bar.draw_roi = c_int(0)
+    bar.detector_type = c_int(load('bar.detector_type',0))
 
-    dispay_mode_enum = atb.enum("Mode",{"Camera Image":0,
-                                        "Region of Interest":1,
-                                        "Algorithm":2})
+    if not headless:
+        dispay_mode_enum = atb.enum("Mode",{"Camera Image":0,
+                                            "Region of Interest":1,
+                                            "Algorithm":2})
+        detector_type_enum = atb.enum("Pupil Detector",pupil_detectors.index_by_name)
 
-    bar.add_var("FPS",bar.fps, step=1.,readonly=True)
-    bar.add_var("Mode", bar.display,vtype=dispay_mode_enum, help="select the view-mode")
-    bar.add_var("Show_Pupil_Point", bar.draw_pupil)
-    bar.add_button("Draw_ROI", start_roi, help="drag on screen to select a region of interest")
+        bar.add_var("FPS",bar.fps, step=1.,readonly=True,help="capture frame rate")
+        bar.add_var("Detection_FPS",bar.detect_fps, step=1.,readonly=True,help="detected frames per second, frames that arrive while the detector is busy are skipped")
+        bar.add_var("Mode", bar.display,vtype=dispay_mode_enum, help="select the view-mode")
+        bar.add_var("Show_Pupil_Point", bar.draw_pupil)
+        bar.add_var("Detector",setter=open_detector,getter=get_from_data,data=bar.detector_type,vtype=detector_type_enum, help="select the pupil detection algorithm, its timing per stage is shown in its bar.")
+        bar.add_button("Draw_ROI", start_roi, help="drag on screen to select a region of interest")
 
-    bar.add_var("SlowDown",bar.sleep, step=0.01,min=0.0)
-    bar.add_var("SaveSettings&Exit", g_pool.quit)
+        bar.add_var("SlowDown",bar.sleep, step=0.01,min=0.0)
+        bar.add_var("SaveSettings&Exit", g_pool.quit)
 
-    cap.create_atb_bar(pos=(220,10))
+        cap.create_atb_bar(pos=(220,10))
 
-    # create a bar for the detector
-    pupil_detector.create_atb_bar(pos=(10,120))
+    # create the detector (and its bar)
+    open_detector(bar.detector_type.value,bar.detector_type)
 
+    if not headless:
+        glfwInit()
+        window = glfwCreateWindow(width, height, "Eye", None, None)
+        glfwMakeContextCurrent(window)
 
-    glfwInit()
-    window = glfwCreateWindow(width, height, "Eye", None, None)
-    glfwMakeContextCurrent(window)
+        # Register callbacks window
+        glfwSetWindowSizeCallback(window,on_resize)
+        glfwSetWindowCloseCallback(window,on_close)
+        glfwSetKeyCallback(window,on_key)
+        glfwSetCharCallback(window,on_char)
+        glfwSetMouseButtonCallback(window,on_button)
+        glfwSetCursorPosCallback(window,on_pos)
+        glfwSetScrollCallback(window,on_scroll)
 
-    # Register callbacks window
-    glfwSetWindowSizeCallback(window,on_resize)
-    glfwSetWindowCloseCallback(window,on_close)
-    glfwSetKeyCallback(window,on_key)
-    glfwSetCharCallback(window,on_char)
-    glfwSetMouseButtonCallback(window,on_button)
-    glfwSetCursorPosCallback(window,on_pos)
-    glfwSetScrollCallback(window,on_scroll)
+        glfwSetWindowPos(window,800,0)
+        on_resize(window,width,height)
 
-    glfwSetWindowPos(window,800,0)
-    on_resize(window,width,height)
+        # gl_state settings
+        basic_gl_setup()
 
-    # gl_state settings
-    basic_gl_setup()
+        # refresh speed settings
+        glfwSwapInterval(0)
 
-    # refresh speed settings
-    glfwSwapInterval(0)
 
+    capture_slot = Latest_Frame_Slot() # capture thread -> detection thread
+    display_slot = Latest_Frame_Slot() # detection thread -> display (main thread)
 
-    # event loop
-    while not g_pool.quit.value:
-        frame = cap.get_frame()
-        if frame.img is None:
-            break
-        update_fps()
-        sleep(bar.sleep.value) # for debugging only
-
-        if pupil_detector.should_sleep:
-            sleep(16)
-            pupil_detector.should_sleep=False
-
-
-        ###  RECORDING of Eye Video (on demand) ###
-        # Setup variables and lists for recording
-        if g_pool.eye_rx.poll():
-            command = g_pool.eye_rx.recv()
-            if command is not None:
-                record_path = command
-                logger.info("Will save eye video to: %(record_path)s")
-                video_path = os.path.join(record_path, "eye.avi")
-                timestamps_path = os.path.join(record_path, "eye_timestamps.npy")
-                writer = cv2.VideoWriter(video_path, cv2.cv.CV_FOURCC(*'DIVX'), bar.fps.value, (frame.img.shape[1], frame.img.shape[0]))
-                timestamps = []
-            else:
+    def capture_loop():
+        """
+        grab frames as fast as the camera delivers them and record the eye video.
+        """
+        writer = None
+        try:
+            while not g_pool.quit.value:
+                frame = cap.get_frame()
+                if frame.img is None:
+                    break
+                update_fps()
+
+                ###  RECORDING of Eye Video (on demand) ###
+                # Setup variables and lists for recording
+                if g_pool.eye_rx.poll():
+                    command = g_pool.eye_rx.recv()
+                    if command is not None:
+                        record_path,writer_policy = command
+                        logger.info("Will save eye video to: %s"%record_path)
+                        video_path = os.path.join(record_path, "eye.avi")
+                        timestamps_path = os.path.join(record_path, "eye_timestamps.npy")
+                        timestamps_log = Record_Log(os.path.join(record_path, "eye_timestamps.log"),1)
+                        writer = Async_Video_Writer(video_path, 'DIVX', bar.fps.value, (frame.img.shape[1], frame.img.shape[0]),policy=writer_policy,timestamps=timestamps_log)
+                    else:
+                        logger.info("Done recording eye.")
+                        stop_eye_recording(writer,record_path,timestamps_path)
+                        writer = None
+
+                if writer:
+                    writer.write(frame.img,frame.timestamp)
+
+                capture_slot.put(frame)
+        finally:
+            capture_slot.close()
+            # in case eye reconding was still runnnig: Save&close
+            if writer:
                 logger.info("Done recording eye.")
-                writer = None
-                np.save(timestamps_path,np.asarray(timestamps))
-                del timestamps
-
-        if writer:
-            writer.write(frame.img)
-            timestamps.append(frame.timestamp)
-
-
-        # pupil ellipse detection
-        result = pupil_detector.detect(frame,user_roi=u_r,visualize=bar.display.value == 2)
-        # stream the result
-        g_pool.pupil_queue.put(result)
-
-        # VISUALIZATION direct visualizations on the frame.img data
-        if bar.display.value == 1:
-            # and a solid (white) frame around the user defined ROI
-            r_img = frame.img[u_r.lY:u_r.uY,u_r.lX:u_r.uX]
-            r_img[:,0] = 255,255,255
-            r_img[:,-1]= 255,255,255
-            r_img[0,:] = 255,255,255
-            r_img[-1,:]= 255,255,255
-
+                stop_eye_recording(writer,record_path,timestamps_path)
 
+    def detection_loop():
+        """
+        detect the pupil in the newest captured frame and stream the result.
+        """
+        while True:
+            frame = capture_slot.get()
+            if frame is None:
+                break
+            update_detect_fps()
+            sleep(bar.sleep.value) # for debugging only
+
+            with detector_lock:
+                should_sleep = g_pool.pupil_detector.should_sleep
+                g_pool.pupil_detector.should_sleep = False
+            # sleep without the lock, so the ui can still swap or draw the detector
+            if should_sleep:
+                sleep(16)
+
+            with detector_lock:
+                pupil_detector = g_pool.pupil_detector
+                # pupil ellipse detection
+                result = pupil_detector.detect_profiled(frame,u_r,visualize=bar.display.value == 2)
+            # stream the result
+            g_pool.pupil_queue.put(result)
+
+            if headless:
+                continue
+
+            # VISUALIZATION direct visualizations on the frame.img data
+            if bar.display.value == 1:
+                # and a solid (white) frame around the user defined ROI
+                r_img = frame.img[u_r.lY:u_r.uY,u_r.lX:u_r.uX]
+                r_img[:,0] = 255,255,255
+                r_img[:,-1]= 255,255,255
+                r_img[0,:] = 255,255,255
+                r_img[-1,:]= 255,255,255
+
+            display_slot.put((frame,result))
+        display_slot.close()
+
+    capture_thread = Thread(target=capture_loop,name='eye capture')
+    detection_thread = Thread(target=detection_loop,name='eye detection')
+    capture_thread.start()
+    detection_thread.start()
+
+    # event loop: display only, capped at display_rate
+    result = None
+    while detection_thread.is_alive() and not g_pool.quit.value:
+        if headless:
+            sleep(.1)
+            continue
+        next_draw = time() + 1./display_rate
+
+        latest = display_slot.get(block=False)
+        if latest:
+            frame,result = latest
 
         # GL-drawing
         clear_gl_screen()
         draw_gl_texture(frame.img)
 
-        if result['norm_pupil'] is not None and bar.draw_pupil.value:
+        if result and result['norm_pupil'] is not None and bar.draw_pupil.value:
             if result.has_key('axes'):
                 pts = cv2.ellipse2Poly( (int(result['center'][0]),int(result['center'][1])),
                                         (int(result["axes"][0]/2),int(result["axes"][1]/2)),
@@ -263,40 +346,57 @@ def eye(g_pool,cap_src,cap_size):
 
         atb.draw()
         glfwSwapBuffers(window)
+        # gl_display opens and closes the debug window and takes the debug image detect() left,
+        # detect() checks the window state while it runs on the detection thread, so both must not overlap.
+        with detector_lock:
+            g_pool.pupil_detector.gl_display()
         glfwPollEvents()
 
-    # END while running
+        sleep(max(0.,next_draw-time()))
 
-    # in case eye reconding was still runnnig: Save&close
-    if writer:
-        logger.info("Done recording eye.")
-        writer = None
-        np.save(timestamps_path,np.asarray(timestamps))
+    # END while running
+    # when the eye camera stops only this process ends, quit is not set so the world process (and a recording) keeps running.
+    capture_thread.join()
+    detection_thread.join()
+    if capture_slot.skipped:
+        logger.info("Detection skipped %s captured frames."%capture_slot.skipped)
 
 
     # save session persistent settings
     save('roi',u_r.get())
     save('bar.display',bar.display.value)
     save('bar.draw_pupil',bar.draw_pupil.value)
+    save('bar.detector_type',bar.detector_type.value)
     session_settings.close()
 
-    pupil_detector.cleanup()
+    g_pool.pupil_detector.cleanup()
     cap.close()
-    atb.terminate()
-    glfwDestroyWindow(window)
-    glfwTerminate()
+    if not headless:
+        atb.terminate()
+        glfwDestroyWindow(window)
+        glfwTerminate()
 
-    #flushing queue incase world process did not exit gracefully
-    while not g_pool.pupil_queue.empty():
-        g_pool.pupil_queue.get()
+    if g_pool.pupil_queue.dropped:
+        logger.warning("Pupil ring buffer was full %s times. The world process did not keep up."%g_pool.pupil_queue.dropped)
     g_pool.pupil_queue.close()
 
     logger.debug("Process done")
 
-def eye_profiled(g_pool,cap_src,cap_size):
+def stop_eye_recording(writer,record_path,timestamps_path):
+    # wait for the encoder to finish, only frames that made it into the video have timestamps
+    writer.release()
+    writer.timestamps.finalize(timestamps_path)
+    # the world process writes info.csv at the same time, append our lines in one go.
+    try:
+        with open(os.path.join(record_path,"info.csv"),'a') as f:
+            f.write(writer.meta_info("Eye Video Writer"))
+    except IOError:
+        logging.getLogger(__name__).warning("Could not save eye video writer stats to info.csv")
+
+def eye_profiled(g_pool,cap_src,cap_size,headless=False):
     import cProfile,subprocess,os
     from eye import eye
-    cProfile.runctx("eye(g_pool,cap_src,cap_size)",{"g_pool":g_pool,'cap_src':cap_src,'cap_size':cap_size},locals(),"eye.pstats")
+    cProfile.runctx("eye(g_pool,cap_src,cap_size,headless)",{"g_pool":g_pool,'cap_src':cap_src,'cap_size':cap_size,'headless':headless},locals(),"eye.pstats")
     loc = os.path.abspath(__file__).rsplit('pupil_src', 1)
     gprof2dot_loc = os.path.join(loc[0], 'pupil_src', 'shared_modules','gprof2dot.py')
     subprocess.call("python "+gprof2dot_loc+" -f pstats eye.pstats | dot -Tpng -o eye_cpu_time.png", shell=True)
@@ -12,10 +12,10 @@ import sys, os,platform
 from time import sleep
 from ctypes import c_bool, c_int
 if platform.system() == 'Darwin':
-    from billiard import Process, Pipe, Event,Queue,forking_enable,freeze_support
+    from billiard import Process, Pipe, Event,forking_enable,freeze_support
     from billiard.sharedctypes import RawValue, Value, Array
 else:
-    from multiprocessing import Process, Pipe, Event, Queue
+    from multiprocessing import Process, Pipe, Event
     forking_enable = lambda x: x #dummy fn
     from multiprocessing import freeze_support
     from multiprocessing.sharedctypes import RawValue, Value, Array
@@ -72,8 +72,11 @@ logging.getLogger("OpenGL").propagate = False
 logging.getLogger("OpenGL").addHandler(logging.NullHandler())
 
 
-#if you pass any additional argument when calling this script. The profiler will be used.
-if len(sys.argv) >=2:
+# pass --headless to run the eye process without window and atb bars (pupil detection and recording only)
+eye_headless = '--headless' in sys.argv[1:]
+
+#if you pass any other additional argument when calling this script. The profiler will be used.
+if [arg for arg in sys.argv[1:] if arg != '--headless']:
     from eye import eye_profiled as eye
     from world import world_profiled as world
 else:
@@ -81,6 +84,7 @@ else:
     from world import world
 
 from methods import Temp
+from ring_buffer import Ring_Buffer
 
 #get the current software version
 if getattr(sys, 'frozen', False):
@@ -115,7 +119,7 @@ def main():
 
     # Create and initialize IPC
     g_pool = Temp()
-    g_pool.pupil_queue = Queue()
+    g_pool.pupil_queue = Ring_Buffer(capacity=1024) # lock-free shared memory, eye -> world
     g_pool.eye_rx, g_pool.eye_tx = Pipe(False)
     g_pool.quit = RawValue(c_bool,0)
     # make some constants avaiable
@@ -124,7 +128,7 @@ def main():
     g_pool.version = version
     g_pool.app = 'capture'
     # set up subprocesses
-    p_eye = Process(target=eye, args=(g_pool,eye_src,eye_size))
+    p_eye = Process(target=eye, args=(g_pool,eye_src,eye_size,eye_headless))
 
     # Spawn subprocess:
     p_eye.start()
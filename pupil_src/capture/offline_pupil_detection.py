@@ -0,0 +1,158 @@
+'''
+(*)~----------------------------------------------------------------------------------
+ Pupil - eye tracking platform
+ Copyright (C) 2012-2014  Pupil Labs
+
+ Distributed under the terms of the CC BY-NC-SA License.
+ License details are in the file license.txt, distributed as part of this software.
+----------------------------------------------------------------------------------~(*)
+'''
+
+"""
+Offline (batch) pupil detection over a recorded eye.avi + eye_timestamps.npy.
+
+The video is split into fixed size chunks of frames that are detected in a process pool.
+The detector carries state from frame to frame (the strong prior of Canny_Detector).
+To keep results independent of how many workers run and in which order chunks finish,
+every chunk starts from a fresh detector and first runs on `warm_up` frames before the chunk
+(results discarded) so the prior is handed over the same way every time.
+Chunk borders only depend on chunk_size.
+
+usage: python offline_pupil_detection.py path/to/recording [option=value ...]
+options: out_file, n_workers, chunk_size, warm_up and any Canny_Detector setting
+         (intensity_range, pupil_min, pupil_max, min_contour_size)
+example: python offline_pupil_detection.py ~/recordings/2014_05_01/000 pupil_max=120 n_workers=8
+"""
+
+import sys, os, platform
+# make shared modules available across pupil_src (also in spawned worker processes)
+pupil_base_dir = os.path.abspath(__file__).rsplit('pupil_src', 1)[0]
+sys.path.append(os.path.join(pupil_base_dir, 'pupil_src', 'shared_modules'))
+
+from time import time
+import numpy as np
+if platform.system() == 'Darwin':
+    from billiard import Pool, cpu_count, forking_enable
+else:
+    from multiprocessing import Pool, cpu_count
+    forking_enable = lambda x: x #dummy fn
+
+from methods import Roi, Temp
+from uvc_capture import autoCreateCapture
+from ring_buffer import pupil_dtype, pupil_datum_to_record
+from pupil_detectors import Canny_Detector
+
+#logging
+import logging
+logger = logging.getLogger(__name__)
+
+
+def detect_chunk(args):
+    """
+    worker fn: detect pupils in frames [start,stop) of the eye video.
+    returns start and a pupil_dtype array with one record per frame.
+    """
+    eye_video_path,timestamps_path,start,stop,warm_up,settings,roi = args
+    timestamps = np.load(timestamps_path)
+
+    records = np.zeros(stop-start,dtype=pupil_dtype)
+    records['timestamp'] = timestamps[start:stop]
+    records['norm_pupil'] = np.nan
+
+    cap = autoCreateCapture(eye_video_path,timestamps=timestamps_path)
+    if cap is None:
+        logger.error("Could not open %s"%eye_video_path)
+        return start,records
+
+    g_pool = Temp()
+    g_pool.user_dir = None #headless: no persistent detector settings
+    detector = Canny_Detector(g_pool)
+    detector.set_settings(settings)
+
+    first = max(0,start-warm_up)
+    cap.seek_to_frame(first)
+    u_r = None
+    for _ in xrange(first,stop):
+        frame = cap.get_frame()
+        if not frame:
+            logger.warning("Could not read frames %s to %s of %s."%(first,stop,eye_video_path))
+            break
+        if u_r is None:
+            u_r = Roi(frame.img.shape)
+            u_r.set(roi)
+        result = detector.detect(frame,user_roi=u_r,visualize=False)
+        if start <= frame.index < stop:
+            pupil_datum_to_record(result,records[frame.index-start])
+
+    detector.cleanup()
+    cap.close()
+    return start,records
+
+
+def make_chunks(frame_count,chunk_size):
+    return [(start,min(start+chunk_size,frame_count)) for start in xrange(0,frame_count,chunk_size)]
+
+
+def detect_recording(rec_dir,out_file=None,settings=None,roi=None,n_workers=None,chunk_size=600,warm_up=30):
+    """
+    run Canny_Detector over eye.avi of a recording and save one pupil_dtype record per eye frame
+    to out_file (default: rec_dir/pupil_positions.npy).
+    settings: Canny_Detector.get_settings() like dict, defaults to the detector defaults
+    roi: user roi as saved by the eye process (lX,lY,uX,uY[,img_shape]) or None for the full frame
+    """
+    eye_video_path = os.path.join(rec_dir,'eye.avi')
+    timestamps_path = os.path.join(rec_dir,'eye_timestamps.npy')
+    if out_file is None:
+        out_file = os.path.join(rec_dir,'pupil_positions.npy')
+    if settings is None:
+        g_pool = Temp()
+        g_pool.user_dir = None
+        settings = Canny_Detector(g_pool).get_settings()
+    if n_workers is None:
+        n_workers = cpu_count()
+
+    frame_count = len(np.load(timestamps_path))
+    chunks = make_chunks(frame_count,chunk_size)
+    jobs = [(eye_video_path,timestamps_path,start,stop,warm_up,settings,roi) for start,stop in chunks]
+    logger.info("Detecting pupils in %s frames in %s chunks with %s workers."%(frame_count,len(chunks),n_workers))
+
+    # on MacOS we will not use os.fork, elsewhere this does nothing.
+    forking_enable(0)
+    start_time = time()
+    pool = Pool(n_workers)
+    results = np.empty(frame_count,dtype=pupil_dtype)
+    try:
+        for done,(start,records) in enumerate(pool.imap_unordered(detect_chunk,jobs)):
+            results[start:start+records.shape[0]] = records
+            logger.info("Finished chunk %s of %s."%(done+1,len(chunks)))
+    finally:
+        pool.close()
+        pool.join()
+
+    duration = time()-start_time
+    detected = np.sum(results['norm_pupil'][:,0] == results['norm_pupil'][:,0])
+    logger.info("Detected pupils in %s of %s frames in %.1f seconds (%.1f frames per second)."%(detected,frame_count,duration,frame_count/duration))
+    np.save(out_file,results)
+    return results
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+    try:
+        rec_dir = sys.argv[1]
+    except IndexError:
+        print __doc__
+        sys.exit(1)
+    g_pool = Temp()
+    g_pool.user_dir = None
+    settings = Canny_Detector(g_pool).get_settings()
+    kwargs = {}
+    for arg in sys.argv[2:]:
+        name,value = arg.split('=',1)
+        if name in settings:
+            settings[name] = type(settings[name])(value)
+        elif name == 'out_file':
+            kwargs[name] = value
+        else:
+            kwargs[name] = int(value)
+    detect_recording(rec_dir,settings=settings,**kwargs)
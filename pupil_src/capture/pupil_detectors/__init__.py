@@ -27,3 +27,15 @@ logger = logging.getLogger(__name__)
 from canny_detector import Canny_Detector
 from blob_detector import Blob_Detector
 from mser_detector import MSER_Detector
+
+
+name_by_index = (   'Canny Edges',
+                    'Blob',
+                    'MSER')
+
+detector_by_index = (   Canny_Detector,
+                        Blob_Detector,
+                        MSER_Detector)
+
+index_by_name = dict(zip(name_by_index,range(len(name_by_index))))
+detector_by_name = dict(zip(name_by_index,detector_by_index))
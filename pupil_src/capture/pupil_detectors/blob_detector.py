@@ -25,28 +25,31 @@ import atb
 from ctypes import c_int,c_bool,c_float
 import logging
 logger = logging.getLogger(__name__)
-from c_methods import eye_filter
+from c_methods import eye_filter, integral_image
 from template import Pupil_Detector
 
 class Blob_Detector(Pupil_Detector):
     """a Pupil detector based on Canny_Edges"""
-    def __init__(self):
-        super(Blob_Detector, self).__init__()
+    stages = ('coarse filter','threshold','canny')
+    def __init__(self,g_pool=None):
+        super(Blob_Detector, self).__init__(g_pool)
         self.intensity_range = c_int(18)
         self.canny_thresh = c_int(200)
         self.canny_ratio= c_int(2)
         self.canny_aperture = c_int(5)
+        self._integral = None #reused integral image buffer
 
 
     def detect(self,frame,u_roi,visualize=False):
         #get the user_roi
         img = frame.img
         r_img = img[u_roi.lY:u_roi.uY,u_roi.lX:u_roi.uX]
-        gray_img = grayscale(r_img)
+        gray_img = cv2.cvtColor(r_img,cv2.COLOR_BGR2GRAY)
         # coarse pupil detection
-        integral = cv2.integral(gray_img)
-        integral =  np.array(integral,dtype=c_float)
+        integral = integral_image(gray_img,self._integral)
+        self._integral = integral
         x,y,w,response = eye_filter(integral,100,400)
+        self.profile.mark('coarse filter')
         p_roi = Roi(gray_img.shape)
         if w>0:
             p_roi.set((y,x,y+w,x+w))
@@ -102,11 +105,13 @@ class Blob_Detector(Pupil_Detector):
         ret3,th3 = cv2.threshold(blur,lowest_spike+offset,255,cv2.THRESH_BINARY)
         # ret3,th3 = cv2.threshold(th3,0,255,cv2.THRESH_BINARY+cv2.THRESH_OTSU)
         th3 = cv2.Laplacian(th3,cv2.CV_64F)
+        self.profile.mark('threshold')
 
         edges = cv2.Canny(pupil_img,
                             self.canny_thresh.value,
                             self.canny_thresh.value*self.canny_ratio.value,
                             apertureSize= self.canny_aperture.value)
+        self.profile.mark('canny')
 
         r_img[p_roi.lY:p_roi.uY,p_roi.lX:p_roi.uX,1] = th3
         r_img[p_roi.lY:p_roi.uY,p_roi.lX:p_roi.uX,2] = edges
@@ -122,8 +127,9 @@ class Blob_Detector(Pupil_Detector):
 
 
     def create_atb_bar(self,pos):
-        self._bar = atb.Bar(name = "Canny_Pupil_Detector", label="Pupil_Detector",
+        self._bar = atb.Bar(name = "Blob_Pupil_Detector", label="Pupil_Detector",
             help="pupil detection parameters", color=(50, 50, 50), alpha=100,
             text='light', position=pos,refresh=.3, size=(200, 100))
         # self._bar.add_var("pupil_intensity_range",self.intensity_range)
 
+        self.profile.add_to_bar(self._bar)
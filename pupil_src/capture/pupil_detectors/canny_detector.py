@@ -24,7 +24,7 @@ import numpy as np
 from methods import *
 import atb
 from ctypes import c_int,c_bool,c_float
-from c_methods import eye_filter
+from c_methods import eye_filter_coarse_to_fine, integral_image
 from glfw import *
 from gl_utils import adjust_gl_view, draw_gl_texture, clear_gl_screen, draw_gl_point_norm, draw_gl_polyline,basic_gl_setup
 from template import Pupil_Detector
@@ -32,17 +32,44 @@ from template import Pupil_Detector
 
 import logging
 logger = logging.getLogger(__name__)
+
+
+def ellipse_circumference(e):
+    a,b = e[1][0]/2.,e[1][1]/2. # major minor radii of candidate ellipse
+    return np.pi*abs(3*(a+b)-np.sqrt(10*a*b+3*(a**2+b**2)))
+
+
 class Canny_Detector(Pupil_Detector):
     """a Pupil detector based on Canny_Edges"""
+    stages = ('tracking','coarse filter','threshold','canny','prior','contours','fit','search','final fit')
     def __init__(self,g_pool):
-        super(Canny_Detector, self).__init__()
+        super(Canny_Detector, self).__init__(g_pool)
 
-        # load session persistent settings
-        self.session_settings = shelve.open(os.path.join(g_pool.user_dir,'user_settings_detector'),protocol=2)
+        # load session persistent settings, headless use (e.g. offline detection) has no user_dir
+        if getattr(g_pool,'user_dir',None):
+            self.session_settings = shelve.open(os.path.join(g_pool.user_dir,'user_settings_detector'),protocol=2)
+        else:
+            self.session_settings = {}
 
         # coase pupil filter params
         self.coarse_filter_min = 100
         self.coarse_filter_max = 400
+        # coarse pupil tracking: search only around the last coarse result
+        self.coarse_tracking = c_bool(self.load('coarse_tracking',True))
+        self.coarse_tracking_min_ratio = .75 # full scan when the response drops below this fraction of the reference
+        self.coarse_full_scan_interval = 30 # frames
+        self._coarse_last = None
+        self._frames_since_full_scan = 0
+        self._integral = None #reused integral image buffer
+
+        # scratch images reused from frame to frame and structuring elements
+        self.buffers = Buffer_Pool()
+        self.dilate_kernel = cv2.getStructuringElement(cv2.MORPH_ELLIPSE, (7,7))
+        self.open_kernel = cv2.getStructuringElement(cv2.MORPH_ELLIPSE, (9,9))
+        self._kernels = {1:(self.dilate_kernel,self.open_kernel)} # by pyramid scale
+
+        # pyramid mode: detect on a 1/2 (level 1) or 1/4 (level 2) size image, final fit on full resolution edges
+        self.pyramid_level = c_int(self.load('pyramid_level',0))
 
         # canny edge detection params
         self.blur = 1
@@ -68,10 +95,20 @@ class Canny_Detector(Pupil_Detector):
         self.final_perimeter_ratio_range = .6, 1.2
         self.strong_prior = None
 
+        # strong prior tracking: while the last ellipse is well supported only an annulus around it is processed
+        self.prior_tracking = c_bool(self.load('prior_tracking',True))
+        self.prior_band = 3 # half width of the annulus in pixels
+        self.prior_max_size_change = .1 # a tracked ellipse may change its major axis by at most this fraction per frame
+        self._spectral_thresh = 255 # glint threshold of the last full run, reused while tracking
+
+        #combinatorial search budget, time in ms (0: no time limit)
+        self.combine_max_evals = 1000
+        self.combine_time_budget = c_float(self.load('combine_time_budget',0.))
+
 
         #detector dignostics
         #confidance in the mesurement 0(bad) to 1 (perfect)
-        # in this case we take the support ratio capped at 1. (uncapped if the pupil comes from prior)
+        # in this case we take the support ratio capped at 1.
         self.confidence = c_float(0)
         self.confidence_hist = []
 
@@ -79,38 +116,240 @@ class Canny_Detector(Pupil_Detector):
         #debug window
         self.suggested_size = 640,480
         self._window = None
+        self._debug_img = None
+        self._frame_size = None
         self.window_should_open = False
         self.window_should_close = False
 
-        #debug settings
-        self.should_sleep = False
 
     def load(self, var_name, default):
         return self.session_settings.get(var_name,default)
     def save(self, var_name, var):
             self.session_settings[var_name] = var
 
+    def get_settings(self):
+        """
+        the user tunable detector parameters as a plain (pickleable) dict
+        """
+        return {'intensity_range':self.intensity_range.value,
+                'pupil_min':self.pupil_min.value,
+                'pupil_max':self.pupil_max.value,
+                'min_contour_size':self.min_contour_size.value,
+                'combine_time_budget':self.combine_time_budget.value,
+                'pyramid_level':self.pyramid_level.value}
+
+    def set_settings(self,settings):
+        for name,value in settings.iteritems():
+            getattr(self,name).value = value
+
+    def coarse_pupil_search(self,integral,u_r,scale=1):
+        """
+        find the dark square of the pupil with the eye filter.
+        integral is the integral image of the user roi at 1/scale of the full resolution.
+        When tracking, only the surrounding of the last result is searched (positions +-w/2, sizes +-25%).
+        We fall back to a full scan when the response collapses, the roi or scale changed or every coarse_full_scan_interval frames.
+        """
+        filter_min,filter_max = self.coarse_filter_min//scale,self.coarse_filter_max//scale
+        if self.coarse_tracking.value and self._coarse_last and self._frames_since_full_scan < self.coarse_full_scan_interval:
+            x,y,w,reference,view = self._coarse_last
+            if view == (u_r.view,scale):
+                margin = w/2
+                min_w = max(filter_min,int(w*.75))
+                max_w = min(filter_max,int(w*1.25)+1)
+                x,y,w,response = eye_filter_coarse_to_fine(integral,min_w,max_w,window=(x-margin,x+margin+1,y-margin,y+margin+1))
+                if w > 0 and response >= self.coarse_tracking_min_ratio*reference:
+                    self._frames_since_full_scan += 1
+                    self._coarse_last = x,y,w,.9*reference+.1*response,view
+                    return x,y,w,response
+
+        x,y,w,response = eye_filter_coarse_to_fine(integral,filter_min,filter_max)
+        self._frames_since_full_scan = 0
+        if w > 0 and response > 0:
+            self._coarse_last = x,y,w,response,(u_r.view,scale)
+        else:
+            self._coarse_last = None
+        return x,y,w,response
+
+    def scaled_kernels(self,scale):
+        """
+        dilate and open kernels for images at 1/scale of the full resolution
+        """
+        if scale not in self._kernels:
+            size = lambda full_size: max(3,full_size//scale|1)
+            self._kernels[scale] = (cv2.getStructuringElement(cv2.MORPH_ELLIPSE, (size(7),size(7))),
+                                    cv2.getStructuringElement(cv2.MORPH_ELLIPSE, (size(9),size(9))))
+        return self._kernels[scale]
+
+    def pupil_edges(self,pupil_img,dark_thresh,spectral_thresh,kernels,prefix=''):
+        """
+        canny edges of the opened image in dark areas only and away from glints.
+        returns edges, the (dilated) dark mask and the (eroded) glint mask, all are buffers of the pool named with prefix.
+        """
+        buffers = self.buffers
+        dilate_kernel,open_kernel = kernels
+        # create dark and spectral glint masks
+        binary_img = bin_thresholding(pupil_img,image_upper=dark_thresh,dst=buffers.get(prefix+'binary',pupil_img.shape))
+        cv2.dilate(binary_img, dilate_kernel,binary_img, iterations=2)
+        spec_mask = bin_thresholding(pupil_img, image_upper=spectral_thresh,dst=buffers.get(prefix+'spec_mask',pupil_img.shape))
+        cv2.erode(spec_mask, dilate_kernel,spec_mask, iterations=1)
+
+        #open operation to remove eye lashes
+        pupil_img = cv2.morphologyEx(pupil_img, cv2.MORPH_OPEN, open_kernel,buffers.get(prefix+'opened',pupil_img.shape))
+
+        if self.blur > 1:
+            pupil_img = cv2.medianBlur(pupil_img,self.blur)
+
+        edges = cv2.Canny(pupil_img,
+                            self.canny_thresh,
+                            self.canny_thresh*self.canny_ratio,
+                            buffers.get(prefix+'edges',pupil_img.shape),
+                            apertureSize= self.canny_aperture)
+
+        # remove edges in areas not dark enough and where the glint is (spectral refelction from IR leds)
+        cv2.min(edges, spec_mask, edges)
+        cv2.min(edges, binary_img, edges)
+        return edges,binary_img,spec_mask
+
+    def track_strong_prior(self,frame,u_r,visualize=False):
+        """
+        look for the edges of the last strong ellipse (image coordinates) in a narrow annulus around it.
+        Only the bounding box of the annulus is converted, opened and edge detected,
+        the dark and glint masks use the thresholds of the last full run.
+        The refit ellipse has to pass the same roundness and size filter as a full run and may not change its size by more
+        than prior_max_size_change, otherwise the prior could drift or grow from frame to frame.
+        returns the refit ellipse in the coordinates of the annulus bounding box, the box origin (image coordinates)
+        and the support ratio or None when the ellipse is lost.
+        """
+        (cx,cy),axes,angle = self.strong_prior
+        band = self.prior_band
+        # keep the bounding box clear of the annulus by the kernel size, filter results at the border are not valid.
+        r = max(axes)/2.+band+self.open_kernel.shape[0]
+        lX,lY = max(u_r.lX,int(cx-r)),max(u_r.lY,int(cy-r))
+        uX,uY = min(u_r.uX,int(cx+r)+1),min(u_r.uY,int(cy+r)+1)
+        if uX-lX < self.open_kernel.shape[0] or uY-lY < self.open_kernel.shape[0]:
+            return None
+
+        buffers = self.buffers
+        r_img = frame.img[lY:uY,lX:uX]
+        gray_img = cv2.cvtColor(r_img,cv2.COLOR_BGR2GRAY,buffers.get('track_gray',r_img.shape[:2]))
+        edges,_,_ = self.pupil_edges(gray_img,self.bin_thresh.value + self.intensity_range.value,self._spectral_thresh,
+                                        self.scaled_kernels(1),'track_')
+
+        e = (cx-lX,cy-lY),axes,angle
+        annulus = buffers.zeros('track_annulus',gray_img.shape,np.uint8)
+        cv2.ellipse(annulus,e,255,thickness=2*band+1)
+        cv2.min(edges, annulus, edges)
+        if visualize:
+            r_img[:,:,1] = cv2.max(r_img[:,:,1],edges)
+
+        raw_edges = cv2.findNonZero(edges)
+        if raw_edges is None or raw_edges.shape[0] < 5:
+            return None
+        # the pupil moved since the last frame, the prior itself is only supported by a part of its edges:
+        # fit all edges in the annulus, then refit to the edges that support that fit.
+        e = cv2.fitEllipse(raw_edges)
+        distances,inliers = dist_pts_ellipses((e,),raw_edges,1.3)
+        support_pixels = raw_edges[inliers[0]]
+        support_ratio = support_pixels.shape[0]/ellipse_circumference(e)
+        if support_pixels.shape[0] < 5 or support_ratio < self.strong_perimeter_ratio_range[0]:
+            return None
+        refit_e = cv2.fitEllipse(support_pixels)
+        if not self.tracked_ellipse_filter(refit_e,axes,gray_img.shape):
+            return None
+        return refit_e,(lX,lY),support_ratio
+
+    def tracked_ellipse_filter(self,e,prior_axes,shape):
+        (x,y),axes,angle = e
+        if min(axes) <= 0:
+            return False
+        in_box = 0 <= x < shape[1] and 0 <= y < shape[0]
+        is_round = min(axes)/max(axes) >= self.min_ratio
+        right_size = self.pupil_min.value <= max(axes) <= self.pupil_max.value
+        size_dif = abs(1 - max(prior_axes)/max(axes))
+        return in_box and is_round and right_size and size_dif <= self.prior_max_size_change
+
+    def pupil_result(self,frame,e,roi_origin,support_ratio):
+        """
+        result of a detected pupil, e is the ellipse in the coordinates of the pupil roi at roi_origin (image coordinates).
+        The full pipeline and the tracking fast path report the same keys, frames and confidence range.
+        """
+        e_img_center = e[0][0]+roi_origin[0],e[0][1]+roi_origin[1]
+        goodness = min(1.,support_ratio)
+        pupil_ellipse = {}
+        pupil_ellipse['confidence'] = goodness
+        pupil_ellipse['ellipse'] = e
+        pupil_ellipse['pos_in_roi'] = e[0]
+        pupil_ellipse['major'] = max(e[1])
+        pupil_ellipse['apparent_pupil_size'] = max(e[1])
+        pupil_ellipse['minor'] = min(e[1])
+        pupil_ellipse['axes'] = e[1]
+        pupil_ellipse['angle'] = e[2]
+        norm_center = normalize(e_img_center,(frame.img.shape[1], frame.img.shape[0]),flip_y=True)
+        pupil_ellipse['norm_pupil'] = norm_center
+        pupil_ellipse['center'] = e_img_center
+        pupil_ellipse['timestamp'] = frame.timestamp
+
+        self.target_size.value = max(e[1])
+
+        self.confidence.value = goodness
+        self.confidence_hist.append(goodness)
+        self.confidence_hist[:-200]=[]
+        return pupil_ellipse
+
     def detect(self,frame,user_roi,visualize=False):
         u_r = user_roi
-        if self.window_should_open:
-            self.open_window((frame.img.shape[1],frame.img.shape[0]))
-        if self.window_should_close:
-            self.close_window()
+        self._frame_size = frame.img.shape[1],frame.img.shape[0]
 
         if self._window:
             debug_img = np.zeros(frame.img.shape,frame.img.dtype)
 
+        # tracking fast path, the full pipeline only runs when the support of the prior drops
+        if self.strong_prior and self.prior_tracking.value:
+            tracked = self.track_strong_prior(frame,u_r,visualize)
+            self.profile.mark('tracking')
+            if tracked:
+                e,(lX,lY),support_ratio = tracked
+                # the annulus bounding box is the pupil roi of the fast path
+                pupil_ellipse = self.pupil_result(frame,e,(lX,lY),support_ratio)
+                self.strong_prior = pupil_ellipse['center'],e[1],e[2]
+                if self._window:
+                    cv2.ellipse(debug_img,self.strong_prior,(255,100,100),thickness=1)
+                    self._debug_img = debug_img
+                return pupil_ellipse
+            # lost: run the full pipeline with a full coarse scan
+            self.strong_prior = None
+            self._coarse_last = None
 
         #get the user_roi
         img = frame.img
         r_img = img[u_r.view]
-        gray_img = cv2.cvtColor(r_img,cv2.COLOR_BGR2GRAY)
+        buffers = self.buffers
+        gray_img = cv2.cvtColor(r_img,cv2.COLOR_BGR2GRAY,buffers.get('gray',r_img.shape[:2]))
+
+        # pyramid mode: everything up to the final fit runs on a downscaled image (pixel sizes are divided by scale)
+        scale = 2**self.pyramid_level.value
+        if scale > 1:
+            full_gray_img = gray_img
+            h,w = full_gray_img.shape[0]//scale,full_gray_img.shape[1]//scale
+            gray_img = cv2.resize(full_gray_img[:h*scale,:w*scale],(w,h),buffers.get('small_gray',(h,w)),interpolation=cv2.INTER_AREA)
+
+        def to_full(e):
+            # ellipse in the downscaled pupil roi to full resolution pupil roi coordinates
+            if scale == 1:
+                return e
+            return ((e[0][0]+.5)*scale-.5,(e[0][1]+.5)*scale-.5),(e[1][0]*scale,e[1][1]*scale),e[2]
+
+        def to_small(e):
+            if scale == 1:
+                return e
+            return ((e[0][0]+.5)/scale-.5,(e[0][1]+.5)/scale-.5),(e[1][0]/scale,e[1][1]/scale),e[2]
 
 
         # coarse pupil detection
-        integral = cv2.integral(gray_img)
-        integral =  np.array(integral,dtype=c_float)
-        x,y,w,response = eye_filter(integral,self.coarse_filter_min,self.coarse_filter_max)
+        integral = integral_image(gray_img,self._integral)
+        self._integral = integral
+        x,y,w,response = self.coarse_pupil_search(integral,u_r,scale)
+        self.profile.mark('coarse filter')
         p_r = Roi(gray_img.shape)
         if w>0:
             p_r.set((y,x,y+w,x+w))
@@ -120,13 +359,19 @@ class Canny_Detector(Pupil_Detector):
         coarse_pupil_width = w/2.
         padding = coarse_pupil_width/4.
         pupil_img = gray_img[p_r.view]
+        # the pupil roi at full resolution
+        if scale > 1:
+            p_r_full = Roi(full_gray_img.shape)
+            p_r_full.set((p_r.lX*scale,p_r.lY*scale,(p_r.lX+pupil_img.shape[1])*scale,(p_r.lY+pupil_img.shape[0])*scale))
+        else:
+            p_r_full = p_r
 
 
 
         # binary thresholding of pupil dark areas
         hist = cv2.calcHist([pupil_img],[0],None,[256],[0,256]) #(images, channels, mask, histSize, ranges[, hist[, accumulate]])
         bins = np.arange(hist.shape[0])
-        spikes = bins[hist[:,0]>40] # every intensity seen in more than 40 pixels
+        spikes = bins[hist[:,0]>40./scale**2] # every intensity seen in more than 40 (full resolution) pixels
         if spikes.shape[0] >0:
             lowest_spike = spikes.min()
             highest_spike = spikes.max()
@@ -151,38 +396,24 @@ class Canny_Detector(Pupil_Detector):
             cv2.line(img,(w,int((highest_spike)*sy)),(int(w-.5*sx),int((highest_spike)*sy)),colors[0])
             cv2.line(img,(w,int((highest_spike- spectral_offset )*sy)),(int(w-.5*sx),int((highest_spike - spectral_offset)*sy)),colors[3])
 
-        # create dark and spectral glint masks
         self.bin_thresh.value = lowest_spike
-        binary_img = bin_thresholding(pupil_img,image_upper=lowest_spike + offset)
-        kernel = cv2.getStructuringElement(cv2.MORPH_ELLIPSE, (7,7))
-        cv2.dilate(binary_img, kernel,binary_img, iterations=2)
-        spec_mask = bin_thresholding(pupil_img, image_upper=highest_spike - spectral_offset)
-        cv2.erode(spec_mask, kernel,spec_mask, iterations=1)
-
-        kernel = cv2.getStructuringElement(cv2.MORPH_ELLIPSE, (9,9))
-
-        #open operation to remove eye lashes
-        pupil_img = cv2.morphologyEx(pupil_img, cv2.MORPH_OPEN, kernel)
-
-        if self.blur > 1:
-            pupil_img = cv2.medianBlur(pupil_img,self.blur.value)
-
-        edges = cv2.Canny(pupil_img,
-                            self.canny_thresh,
-                            self.canny_thresh*self.canny_ratio,
-                            apertureSize= self.canny_aperture)
-
+        self._spectral_thresh = highest_spike - spectral_offset
+        self.profile.mark('threshold')
 
-        # remove edges in areas not dark enough and where the glint is (spectral refelction from IR leds)
-        edges = cv2.min(edges, spec_mask)
-        edges = cv2.min(edges,binary_img)
+        edges,binary_img,spec_mask = self.pupil_edges(pupil_img,lowest_spike + offset,highest_spike - spectral_offset,self.scaled_kernels(scale))
 
-        overlay =  img[u_r.view][p_r.view]
+        overlay =  img[u_r.view][p_r_full.view]
         if visualize:
             b,g,r = overlay[:,:,0],overlay[:,:,1],overlay[:,:,2]
-            g[:] = cv2.max(g,edges)
-            b[:] = cv2.max(b,binary_img)
-            b[:] = cv2.min(b,spec_mask)
+            if scale > 1:
+                size = overlay.shape[1],overlay.shape[0]
+                g[:] = cv2.max(g,cv2.resize(edges,size,interpolation=cv2.INTER_NEAREST))
+                b[:] = cv2.max(b,cv2.resize(binary_img,size,interpolation=cv2.INTER_NEAREST))
+                b[:] = cv2.min(b,cv2.resize(spec_mask,size,interpolation=cv2.INTER_NEAREST))
+            else:
+                g[:] = cv2.max(g,edges)
+                b[:] = cv2.max(b,binary_img)
+                b[:] = cv2.min(b,spec_mask)
 
             # draw a frame around the automatic pupil ROI in overlay.
             overlay[::2,0] = 255 #yeay numpy broadcasting
@@ -190,10 +421,11 @@ class Canny_Detector(Pupil_Detector):
             overlay[0,::2] = 255
             overlay[-1,::2]= 255
             # draw a frame around the area we require the pupil center to be.
-            overlay[padding:-padding:4,padding] = 255
-            overlay[padding:-padding:4,-padding]= 255
-            overlay[padding,padding:-padding:4] = 255
-            overlay[-padding,padding:-padding:4]= 255
+            p = padding*scale
+            overlay[p:-p:4,p] = 255
+            overlay[p:-p:4,-p]= 255
+            overlay[p,p:-p:4] = 255
+            overlay[-p,p:-p:4]= 255
 
         if visualize:
             c = (100.,frame.img.shape[0]-100.)
@@ -206,50 +438,38 @@ class Canny_Detector(Pupil_Detector):
 
         #get raw edge pix for later
         raw_edges = cv2.findNonZero(edges)
+        self.profile.mark('canny')
 
         def ellipse_true_support(e,raw_edges):
-            a,b = e[1][0]/2.,e[1][1]/2. # major minor radii of candidate ellipse
-            ellipse_circumference = np.pi*abs(3*(a+b)-np.sqrt(10*a*b+3*(a**2+b**2)))
-            distances = dist_pts_ellipse(e,raw_edges)
-            support_pixels = raw_edges[distances<=1.3]
+            distances,inliers = dist_pts_ellipses((e,),raw_edges,1.3)
+            support_pixels = raw_edges[inliers[0]]
             # support_ratio = support_pixel.shape[0]/ellipse_circumference
-            return support_pixels,ellipse_circumference
+            return support_pixels,ellipse_circumference(e)
+
+        def ellipses_support_count(ellipses,raw_edges,batch_size=8):
+            # number of support pixels of every ellipse, evaluated in small batches to keep the temporaries in cache
+            counts = []
+            for i in range(0,len(ellipses),batch_size):
+                distances,inliers = dist_pts_ellipses(ellipses[i:i+batch_size],raw_edges,1.3)
+                counts.extend(inliers.sum(axis=1))
+            return counts
 
         # if we had a good ellipse before ,let see if it is still a good first guess:
         if self.strong_prior:
-            e = p_r.sub_vector(u_r.sub_vector(self.strong_prior[0])),self.strong_prior[1],self.strong_prior[2]
+            e = to_small((p_r_full.sub_vector(u_r.sub_vector(self.strong_prior[0])),self.strong_prior[1],self.strong_prior[2]))
 
             self.strong_prior = None
             if raw_edges is not None:
-                support_pixels,ellipse_circumference = ellipse_true_support(e,raw_edges)
-                support_ratio =  support_pixels.shape[0]/ellipse_circumference
+                support_pixels,circumference = ellipse_true_support(e,raw_edges)
+                support_ratio =  support_pixels.shape[0]/circumference
                 if support_ratio >= self.strong_perimeter_ratio_range[0]:
                     refit_e = cv2.fitEllipse(support_pixels)
                     if self._window:
                         cv2.ellipse(debug_img,e,(255,100,100),thickness=4)
                         cv2.ellipse(debug_img,refit_e,(0,0,255),thickness=1)
-                    e = refit_e
-                    self.strong_prior = u_r.add_vector(p_r.add_vector(e[0])),e[1],e[2]
-                    goodness = support_ratio
-                    pupil_ellipse = {}
-                    pupil_ellipse['confidence'] = goodness
-                    pupil_ellipse['ellipse'] = e
-                    pupil_ellipse['roi_center'] = e[0]
-                    pupil_ellipse['major'] = max(e[1])
-                    pupil_ellipse['minor'] = min(e[1])
-                    pupil_ellipse['axes'] = e[1]
-                    pupil_ellipse['angle'] = e[2]
-                    e_img_center =u_r.add_vector(p_r.add_vector(e[0]))
-                    norm_center = normalize(e_img_center,(frame.img.shape[1], frame.img.shape[0]),flip_y=True)
-                    pupil_ellipse['norm_pupil'] = norm_center
-                    pupil_ellipse['center'] = e_img_center
-                    pupil_ellipse['timestamp'] = frame.timestamp
-
-                    self.target_size.value = max(e[1])
-
-                    self.confidence.value = goodness
-                    self.confidence_hist.append(goodness)
-                    self.confidence_hist[:-200]=[]
+                    e = to_full(refit_e)
+                    pupil_ellipse = self.pupil_result(frame,e,u_r.add_vector(p_r_full.add_vector((0,0))),support_ratio)
+                    self.strong_prior = pupil_ellipse['center'],e[1],e[2]
                     if self._window:
                         #draw a little animation of confidence
                         cv2.putText(debug_img, 'good',(410,debug_img.shape[0]-100), cv2.FONT_HERSHEY_SIMPLEX,0.3,(255,100,100))
@@ -257,8 +477,10 @@ class Canny_Detector(Pupil_Detector):
                         cv2.putText(debug_img, 'no detection',(410,debug_img.shape[0]-10), cv2.FONT_HERSHEY_SIMPLEX,0.3,(255,100,100))
                         lines = np.array([[[2*x,debug_img.shape[0]-int(100*y)],[2*x,debug_img.shape[0]]] for x,y in enumerate(self.confidence_hist)])
                         cv2.polylines(debug_img,lines,isClosed=False,color=(255,100,100))
-                        self.gl_display_in_window(debug_img)
+                        self._debug_img = debug_img
+                    self.profile.mark('prior')
                     return pupil_ellipse
+        self.profile.mark('prior')
 
 
 
@@ -272,7 +494,7 @@ class Canny_Detector(Pupil_Detector):
 
         ### first we want to filter out the bad stuff
         # to short
-        good_contours = [c for c in contours if c.shape[0]>self.min_contour_size.value]
+        good_contours = [c for c in contours if c.shape[0]>self.min_contour_size.value/scale]
         # now we learn things about each contour through looking at the curvature.
         # For this we need to simplyfy the contour so that pt to pt angles become more meaningfull
         aprox_contours = [cv2.approxPolyDP(c,epsilon=1.5,closed=False) for c in good_contours]
@@ -281,33 +503,32 @@ class Canny_Detector(Pupil_Detector):
             x_shift = coarse_pupil_width*2
             color = zip(range(0,250,15),range(0,255,15)[::-1],range(230,250))
         split_contours = []
-        for c in aprox_contours:
-            curvature = GetAnglesPolyline(c)
-            # we split whenever there is a real kink (abs(curvature)<right angle) or a change in the genreal direction
-            kink_idx = find_kink_and_dir_change(curvature,80)
-            segs = split_at_corner_index(c,kink_idx)
-
-            #TODO: split at shart inward turns
-            for s in segs:
-                if s.shape[0]>2:
-                    split_contours.append(s)
-                    if self._window:
-                        c = color.pop(0)
-                        color.append(c)
-                        s = s.copy()
-                        s[:,:,0] += debug_img.shape[1]-coarse_pupil_width*2
-                        # s[:,:,0] += x_shift
-                        # x_shift += 5
-                        cv2.polylines(debug_img,[s],isClosed=False,color=map(lambda x: x,c),thickness = 1,lineType=4)#cv2.CV_AA
+        # we split whenever there is a real kink (abs(curvature)<right angle) or a change in the genreal direction
+        # all contours are processed in one go, segments are index ranges into the concatenated points.
+        points,seg_starts,seg_ends = split_polylines_at_kinks(aprox_contours,80)
+        #TODO: split at shart inward turns
+        for start,end in zip(seg_starts,seg_ends):
+            if end-start>2:
+                s = points[start:end]
+                split_contours.append(s)
+                if self._window:
+                    c = color.pop(0)
+                    color.append(c)
+                    s = s.copy()
+                    s[:,:,0] += debug_img.shape[1]-coarse_pupil_width*2
+                    # s[:,:,0] += x_shift
+                    # x_shift += 5
+                    cv2.polylines(debug_img,[s],isClosed=False,color=map(lambda x: x,c),thickness = 1,lineType=4)#cv2.CV_AA
 
         split_contours.sort(key=lambda x:-x.shape[0])
+        self.profile.mark('contours')
         # print [x.shape[0]for x in split_contours]
         if len(split_contours) == 0:
             # not a single usefull segment found -> no pupil found
             self.confidence.value = 0
             self.confidence_hist.append(0)
             if self._window:
-                self.gl_display_in_window(debug_img)
+                self._debug_img = debug_img
             return {'timestamp':frame.timestamp,'norm_pupil':None}
 
 
@@ -319,7 +540,7 @@ class Canny_Detector(Pupil_Detector):
             if in_center:
                 is_round = min(e[1])/max(e[1]) >= self.min_ratio
                 if is_round:
-                    right_size = self.pupil_min.value <= max(e[1]) <= self.pupil_max.value
+                    right_size = self.pupil_min.value/scale <= max(e[1]) <= self.pupil_max.value/scale
                     if right_size:
                         return True
             return False
@@ -341,10 +562,10 @@ class Canny_Detector(Pupil_Detector):
 
         def final_fitting(c,edges):
             #use the real edge pixels to fit, not the aproximated contours
-            support_mask = np.zeros(edges.shape,edges.dtype)
-            cv2.polylines(support_mask,c,isClosed=False,color=(255,255,255),thickness=2)
+            support_mask = buffers.zeros('support_mask',edges.shape,edges.dtype)
+            cv2.polylines(support_mask,c,isClosed=False,color=(255,255,255),thickness=2*scale)
             # #draw into the suport mast with thickness 2
-            new_edges = cv2.min(edges, support_mask)
+            new_edges = cv2.min(edges, support_mask, support_mask)
             new_contours = cv2.findNonZero(new_edges)
             if self._window:
                 new_edges[new_edges!=0] = 255
@@ -383,6 +604,7 @@ class Canny_Detector(Pupil_Detector):
                                 cv2.ellipse(debug_img,e,color=(255,0,0))
 
         sc = np.array(split_contours)
+        self.profile.mark('fit')
 
 
         if strong_seed_contours:
@@ -392,7 +614,7 @@ class Canny_Detector(Pupil_Detector):
 
         if not (strong_seed_contours or weak_seed_contours):
             if self._window:
-                self.gl_display_in_window(debug_img)
+                self._debug_img = debug_img
             self.confidence.value = 0
             self.confidence_hist.append(0)
             return {'timestamp':frame.timestamp,'norm_pupil':None}
@@ -400,30 +622,43 @@ class Canny_Detector(Pupil_Detector):
         # if self._window:
         #     cv2.polylines(debug_img,[split_contours[i] for i in seed_idx],isClosed=False,color=(255,255,100),thickness=3)
 
-        def ellipse_eval(contours):
-            c = np.concatenate(contours)
-            e = cv2.fitEllipse(c)
+        # the state of a contour combination is its points and their ellipse fit, it is refit from all points.
+        # Carrying conic moment sums instead would make extending free but the 6x6 least squares solve in numpy
+        # takes ~130us against ~18us for cv2.fitEllipse on the points, and the check needs all point distances anyway.
+        def ellipse_extend(state,contour):
+            if state is None:
+                c = contour
+            else:
+                c = np.concatenate((state[0],contour))
+            return c,cv2.fitEllipse(c)
+
+        def ellipse_eval(state):
+            c,e = state
             d = dist_pts_ellipse(e,c)
             fit_variance = np.sum(d**2)/float(d.shape[0])
             return fit_variance <= self.inital_ellipse_fit_threshhold
 
-
-        solutions = pruning_quick_combine(split_contours,ellipse_eval,seed_idx,max_evals=1000,max_depth=5)
+        fits = {}
+        time_budget = self.combine_time_budget.value/1000. if self.combine_time_budget.value > 0 else None
+        solutions = pruning_quick_combine(split_contours,ellipse_eval,seed_idx,max_evals=self.combine_max_evals,max_depth=5,
+                                            time_budget=time_budget,extend=ellipse_extend,states=fits)
         solutions = filter_subsets(solutions)
+        self.profile.mark('search')
         ratings = []
 
 
-        for s in solutions:
-            e = cv2.fitEllipse(np.concatenate(sc[s]))
+        solution_ellipses = [fits[tuple(s)][1] for s in solutions]
+        support_counts = ellipses_support_count(solution_ellipses,raw_edges)
+        for e,support_count in zip(solution_ellipses,support_counts):
             if self._window:
                 cv2.ellipse(debug_img,e,(0,150,100))
-            support_pixels,ellipse_circumference = ellipse_true_support(e,raw_edges)
-            support_ratio =  support_pixels.shape[0]/ellipse_circumference
+            support_ratio =  support_count/ellipse_circumference(e)
             # TODO: refine the selection of final canditate
             if support_ratio >=self.final_perimeter_ratio_range[0] and ellipse_filter(e):
-                ratings.append(support_pixels.shape[0])
+                ratings.append(support_count)
                 if support_ratio >=self.strong_perimeter_ratio_range[0]:
-                    self.strong_prior = u_r.add_vector(p_r.add_vector(e[0])),e[1],e[2]
+                    e_full = to_full(e)
+                    self.strong_prior = u_r.add_vector(p_r_full.add_vector(e_full[0])),e_full[1],e_full[2]
                     if self._window:
                         cv2.ellipse(debug_img,e,(0,255,255),thickness = 2)
             else:
@@ -435,48 +670,35 @@ class Canny_Detector(Pupil_Detector):
         if max(ratings) == -1:
             #no good final ellipse found
             if self._window:
-                self.gl_display_in_window(debug_img)
+                self._debug_img = debug_img
             self.confidence.value = 0
             self.confidence_hist.append(0)
             return {'timestamp':frame.timestamp,'norm_pupil':None}
 
-        best = solutions[ratings.index(max(ratings))]
-        e = cv2.fitEllipse(np.concatenate(sc[best]))
+        best_idx = ratings.index(max(ratings))
+        best = solutions[best_idx]
+        e = solution_ellipses[best_idx]
 
         #final calculation of goodness of fit
-        support_pixels,ellipse_circumference = ellipse_true_support(e,raw_edges)
-        support_ratio =  support_pixels.shape[0]/ellipse_circumference
-        goodness = min(1.,support_ratio)
-
-        #final fitting and return of result
-        new_e,final_edges = final_fitting(sc[best],edges)
+        support_ratio =  support_counts[best_idx]/ellipse_circumference(e)
+
+        #final fitting and return of result, always on full resolution edge pixels
+        e = to_full(e)
+        if scale > 1:
+            full_edges,_,_ = self.pupil_edges(full_gray_img[p_r_full.view],lowest_spike + offset,highest_spike - spectral_offset,
+                                                self.scaled_kernels(1),'full_')
+            best_contours = [np.int32(np.round((c+.5)*scale-.5)) for c in sc[best]]
+            new_e,final_edges = final_fitting(best_contours,full_edges)
+        else:
+            new_e,final_edges = final_fitting(sc[best],edges)
         size_dif = abs(1 - max(e[1])/max(new_e[1]))
-        if ellipse_filter(new_e) and size_dif < .3:
+        if ellipse_filter(to_small(new_e)) and size_dif < .3:
             if self._window:
                 cv2.ellipse(debug_img,new_e,(0,255,0))
             e = new_e
+        self.profile.mark('final fit')
 
-
-        pupil_ellipse = {}
-        pupil_ellipse['confidence'] = goodness
-        pupil_ellipse['ellipse'] = e
-        pupil_ellipse['pos_in_roi'] = e[0]
-        pupil_ellipse['major'] = max(e[1])
-        pupil_ellipse['apparent_pupil_size'] = max(e[1])
-        pupil_ellipse['minor'] = min(e[1])
-        pupil_ellipse['axes'] = e[1]
-        pupil_ellipse['angle'] = e[2]
-        e_img_center =u_r.add_vector(p_r.add_vector(e[0]))
-        norm_center = normalize(e_img_center,(frame.img.shape[1], frame.img.shape[0]),flip_y=True)
-        pupil_ellipse['norm_pupil'] = norm_center
-        pupil_ellipse['center'] = e_img_center
-        pupil_ellipse['timestamp'] = frame.timestamp
-
-        self.target_size.value = max(e[1])
-
-        self.confidence.value = goodness
-        self.confidence_hist.append(goodness)
-        self.confidence_hist[:-200]=[]
+        pupil_ellipse = self.pupil_result(frame,e,u_r.add_vector(p_r_full.add_vector((0,0))),support_ratio)
         if self._window:
             #draw a little animation of confidence
             cv2.putText(debug_img, 'good',(410,debug_img.shape[0]-100), cv2.FONT_HERSHEY_SIMPLEX,0.3,(255,100,100))
@@ -484,7 +706,7 @@ class Canny_Detector(Pupil_Detector):
             cv2.putText(debug_img, 'no detection',(410,debug_img.shape[0]-10), cv2.FONT_HERSHEY_SIMPLEX,0.3,(255,100,100))
             lines = np.array([[[2*x,debug_img.shape[0]-int(100*y)],[2*x,debug_img.shape[0]]] for x,y in enumerate(self.confidence_hist)])
             cv2.polylines(debug_img,lines,isClosed=False,color=(255,100,100))
-            self.gl_display_in_window(debug_img)
+            self._debug_img = debug_img
         return pupil_ellipse
 
 
@@ -503,10 +725,15 @@ class Canny_Detector(Pupil_Detector):
         self._bar.add_var("pupil_max",self.pupil_max,min=1)
         self._bar.add_var("Pupil_Aparent_Size",self.target_size)
         self._bar.add_var("Contour min length",self.min_contour_size)
+        self._bar.add_var("coarse tracking",self.coarse_tracking,help="search for the pupil only around its last position, with a full scan when lost.")
+        self._bar.add_var("pyramid level",self.pyramid_level,min=0,max=2,help="detect on a 1/2 (1) or 1/4 (2) size image, the final ellipse fit uses full resolution edges.")
+        self._bar.add_var("prior tracking",self.prior_tracking,help="while the last pupil ellipse is well supported only look for its edges in a narrow band around it.")
+        self._bar.add_var("combine time budget ms",self.combine_time_budget,min=0,step=.5,help="time limit of the contour combination search, 0 for no limit.")
 
 
         self._bar.add_var("Pupil_Shade",self.bin_thresh, readonly=True)
         self._bar.add_var("confidence",self.confidence, readonly=True)
+        self.profile.add_to_bar(self._bar)
         # self._bar.add_var("Image_Blur",self.blur, step=2,min=1,max=9)
         # self._bar.add_var("Canny_aparture",self.canny_aperture, step=2,min=3,max=7)
         # self._bar.add_var("canny_threshold",self.canny_thresh, step=1,min=0)
@@ -567,6 +794,18 @@ class Canny_Detector(Pupil_Detector):
             self._window = None
             self.window_should_close = False
 
+    def gl_display(self):
+        """
+        debug window handling, detect() runs on the detection thread and only leaves the debug image here.
+        """
+        if self.window_should_open and self._frame_size:
+            self.open_window(self._frame_size)
+        if self.window_should_close:
+            self.close_window()
+        if self._window and self._debug_img is not None:
+            self.gl_display_in_window(self._debug_img)
+            self._debug_img = None
+
     def gl_display_in_window(self,img):
         active_window = glfwGetCurrentContext()
         glfwMakeContextCurrent(self._window)
@@ -581,4 +820,129 @@ class Canny_Detector(Pupil_Detector):
         self.save('pupil_min',self.pupil_min.value)
         self.save('pupil_max',self.pupil_max.value)
         self.save('min_contour_size',self.min_contour_size.value)
-        self.session_settings.close()
+        self.save('combine_time_budget',self.combine_time_budget.value)
+        self.save('coarse_tracking',self.coarse_tracking.value)
+        self.save('prior_tracking',self.prior_tracking.value)
+        self.save('pyramid_level',self.pyramid_level.value)
+        if hasattr(self.session_settings,'close'):
+            self.session_settings.close()
+        self.close_window()
+        super(Canny_Detector, self).cleanup()
+
+
+
+class Allocation_Counter(object):
+    """
+    counts the array buffers detect() allocates, per stage of the profile.
+
+    While installed the cv2 and np names of this module and of methods are replaced by proxies.
+    An ndarray returned by one of their functions that shares no memory with an argument
+    (e.g. the dst= buffer it was given) is a newly allocated buffer. Arrays made by numpy operators (a*b)
+    and inside c_methods are not seen. Counting slows detect() down, time it without the counter.
+    """
+    def __init__(self,profile):
+        self.profile = profile
+        self.counts = dict.fromkeys(profile.stages,0)
+        self.bytes = dict.fromkeys(profile.stages,0)
+        self._pending = [0,0]
+
+    def book(self,result,args):
+        if isinstance(result,(tuple,list)):
+            arrays = [r for r in result if isinstance(r,np.ndarray)]
+        else:
+            arrays = [result] if isinstance(result,np.ndarray) else []
+        inputs = [a for a in args if isinstance(a,np.ndarray)]
+        for a in arrays:
+            if not any(np.may_share_memory(a,i) for i in inputs):
+                self._pending[0] += 1
+                self._pending[1] += a.nbytes
+
+    def install(self):
+        import methods
+        counter = self
+        class Counting_Module(object):
+            def __init__(self,module):
+                self.module = module
+            def __getattr__(self,name):
+                attr = getattr(self.module,name)
+                if isinstance(attr,type) or not callable(attr):
+                    return attr
+                def counted(*args,**kwargs):
+                    result = attr(*args,**kwargs)
+                    counter.book(result,args+tuple(kwargs.values()))
+                    return result
+                return counted
+        self._namespaces = globals(),methods.__dict__
+        for namespace in self._namespaces:
+            namespace['cv2'],namespace['np'] = Counting_Module(cv2),Counting_Module(np)
+        profile_mark = self.profile.mark
+        def mark(stage):
+            self.counts[stage] += self._pending[0]
+            self.bytes[stage] += self._pending[1]
+            self._pending = [0,0]
+            profile_mark(stage)
+        self.profile.mark = mark
+
+    def uninstall(self):
+        for namespace in self._namespaces:
+            namespace['cv2'],namespace['np'] = cv2,np
+        del self.profile.mark
+
+
+def benchmark_buffers(frames,repeat=3):
+    """
+    run detect() over frames with and without the buffer pool.
+    returns {'pool':(allocations per frame, MB allocated per frame, ms per frame, {stage:allocations per frame}),'no pool':(...)}
+    the allocations are counted by an Allocation_Counter in one extra pass, the time is taken without it.
+    """
+    from time import time
+    results = {}
+    for name,enabled in (('no pool',False),('pool',True)):
+        g_pool = Temp()
+        g_pool.user_dir = None
+        detector = Canny_Detector(g_pool)
+        detector.buffers = Buffer_Pool(enabled)
+        u_r = Roi(frames[0].img.shape)
+        start = time()
+        for _ in range(repeat):
+            for frame in frames:
+                detector.detect(frame,u_r)
+        ms = (time()-start)/(repeat*len(frames))*1000
+
+        counter = Allocation_Counter(detector.profile)
+        counter.install()
+        try:
+            for frame in frames:
+                detector.detect_profiled(frame,u_r)
+        finally:
+            counter.uninstall()
+        n = float(len(frames))
+        per_stage = dict([(stage,count/n) for stage,count in counter.counts.iteritems()])
+        results[name] = sum(counter.counts.values())/n, sum(counter.bytes.values())/n/1e6, ms, per_stage
+    return results
+
+
+if __name__ == '__main__':
+    # usage: python canny_detector.py [path/to/eye.avi]
+    import sys
+    from uvc_capture import Frame, autoCreateCapture
+    logging.basicConfig(level=logging.WARNING)
+    frames = []
+    if len(sys.argv) > 1:
+        cap = autoCreateCapture(sys.argv[1])
+        for _ in range(200):
+            frame = cap.get_frame()
+            if not frame:
+                break
+            frames.append(frame.copy())
+    else:
+        # synthetic eye images: a dark pupil with a glint on noisy skin moving across the image.
+        for i in range(100):
+            img = np.random.normal(170,10,(360,640)).clip(0,255).astype(np.uint8)
+            center = (200+2*i,180+int(30*np.sin(i/10.)))
+            cv2.ellipse(img,(center,(90,80),20),0,-1)
+            cv2.circle(img,(center[0]+15,center[1]-10),5,255,-1)
+            frames.append(Frame(i/30.,cv2.cvtColor(img,cv2.COLOR_GRAY2BGR),index=i))
+    for name,(allocations,mb,ms,per_stage) in benchmark_buffers(frames).iteritems():
+        print "%-8s %5.1f array allocations (%.2f MB) per frame %7.2f ms per frame"%(name,allocations,mb,ms)
+        print "         "+", ".join(["%s %.1f"%(stage,per_stage[stage]) for stage in Canny_Detector.stages if per_stage[stage]])
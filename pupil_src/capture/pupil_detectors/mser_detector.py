@@ -30,8 +30,9 @@ from template import Pupil_Detector
 
 class MSER_Detector(Pupil_Detector):
     """docstring for MSER_Detector"""
-    def __init__(self):
-        super(MSER_Detector, self).__init__()
+    stages = ('mser','hull filter')
+    def __init__(self,g_pool=None):
+        super(MSER_Detector, self).__init__(g_pool)
 
     def detect(self,frame,u_roi,visualize=False):
         #get the user_roi
@@ -44,6 +45,7 @@ class MSER_Detector(Pupil_Detector):
         mser = cv2.MSER(**PARAMS)
         gray = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
         regions = mser.detect(gray, None)
+        self.profile.mark('mser')
         hulls = []
         # Select most circular hull
         for region in regions:
@@ -61,6 +63,7 @@ class MSER_Detector(Pupil_Detector):
                 continue
             logger.debug('Kept: Area[%f] Intensity[%f] Ratio[%f]' % (region.shape[0], mval, r))
             hulls.append((r, region, h))
+        self.profile.mark('hull filter')
         if hulls:
             hulls.sort()
             gaze = np.round(np.mean(hulls[0][2].reshape((-1, 2)), 0)).astype(np.int).tolist()
@@ -73,8 +76,9 @@ class MSER_Detector(Pupil_Detector):
 
 
     def create_atb_bar(self,pos):
-        self.bar = atb.Bar(name = "MSER_Detector", label="MSER PUPIL Detector Controls",
+        self._bar = atb.Bar(name = "MSER_Detector", label="MSER PUPIL Detector Controls",
             help="pupil detection params", color=(50, 50, 50), alpha=100,
             text='light', position=pos,refresh=.3, size=(200, 200))
-        # self.bar.add_var("VAR1",self.var1, step=1.,readonly=False)
+        # self._bar.add_var("VAR1",self.var1, step=1.,readonly=False)
+        self.profile.add_to_bar(self._bar)
 
@@ -14,15 +14,34 @@ import numpy as np
 from methods import *
 import atb
 from ctypes import c_int,c_bool,c_float
+from stage_profile import Stage_Profile
 import logging
 logger = logging.getLogger(__name__)
 
 
 class Pupil_Detector(object):
-    """base class for pupil detector"""
-    def __init__(self):
+    """
+    base class for pupil detector
+
+    stages: names of the steps of detect(), call self.profile.mark(stage) at the end of each of them.
+    """
+    stages = ('detect',)
+    def __init__(self,g_pool=None):
         super(Pupil_Detector, self).__init__()
-        var1 = c_int(0)
+        self.g_pool = g_pool
+        self.profile = Stage_Profile(self.stages)
+        self.should_sleep = False
+        self._bar = None
+        self.var1 = c_int(0)
+
+    def detect_profiled(self,frame,u_roi,visualize=False):
+        """
+        detect() with the time of each stage booked into self.profile
+        """
+        self.profile.start()
+        result = self.detect(frame,u_roi,visualize)
+        self.profile.finish()
+        return result
 
     def detect(self,frame,u_roi,visualize=False):
         img = frame.img
@@ -44,6 +63,8 @@ class Pupil_Detector(object):
                         'minor': None,
                         'goodness': 0} #some estimation on how sure you are about the detected ellipse and its fit. Smaller is better
 
+        self.profile.mark('detect')
+
         # If you use region of interest p_roi and u_roi make sure to return pupil coordinates relative to the full image
         candidate_pupil_ellipse['center'] = u_roi.add_vector(candidate_pupil_ellipse['center'])
         candidate_pupil_ellipse['timestamp'] = frame.timestamp
@@ -59,11 +80,21 @@ class Pupil_Detector(object):
             return no_result
 
 
+    def gl_display(self):
+        """
+        called from the display loop of the eye process (main thread), detect() runs on the detection thread.
+        Draw into windows of your own here.
+        """
+        pass
+
     def create_atb_bar(self,pos):
-        self.bar = atb.Bar(name = "Pupil_Detector", label="Pupil Detector Controls",
+        self._bar = atb.Bar(name = "Pupil_Detector", label="Pupil Detector Controls",
             help="pupil detection params", color=(50, 50, 50), alpha=100,
             text='light', position=pos,refresh=.3, size=(200, 200))
-        self.bar.add_var("VAR1",self.var1, step=1.,readonly=False)
-
-
+        self._bar.add_var("VAR1",self.var1, step=1.,readonly=False)
+        self.profile.add_to_bar(self._bar)
 
+    def cleanup(self):
+        if self._bar:
+            self._bar.destroy()
+            self._bar = None
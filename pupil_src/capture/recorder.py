@@ -17,20 +17,20 @@ from time import strftime,localtime,time,gmtime
 from ctypes import create_string_buffer
 from shutil import copy2
 from glob import glob
+from video_writer import Async_Video_Writer
+from record_log import Record_Log
 #logging
 import logging
 logger = logging.getLogger(__name__)
 
 class Recorder(Plugin):
     """Capture Recorder"""
-    def __init__(self,g_pool, session_str, fps, img_shape, record_eye, eye_tx):
+    def __init__(self,g_pool, session_str, fps, img_shape, record_eye, eye_tx, writer_policy='block'):
         Plugin.__init__(self)
         self.g_pool = g_pool
         self.session_str = session_str
         self.record_eye = record_eye
         self.frame_count = 0
-        self.timestamps = []
-        self.gaze_list = []
         self.eye_tx = eye_tx
         self.start_time = time()
 
@@ -60,15 +60,22 @@ class Recorder(Plugin):
             f.write("Recording Name\t"+self.session_str+ "\n")
             f.write("Start Date\t"+ strftime("%d.%m.%Y", localtime(self.start_time))+ "\n")
             f.write("Start Time\t"+ strftime("%H:%M:%S", localtime(self.start_time))+ "\n")
+            f.write("Capture Software Version\t"+ self.g_pool.version + "\n")
+
+        # gaze and timestamps are streamed to disk while recording, see stop_and_destruct for finalization.
+        # gaze x | gaze y | pupil x | pupil y | timestamp | confidence
+        self.gaze_log = Record_Log(os.path.join(self.rec_path, "gaze_positions.log"),6)
+        self.timestamps_log = Record_Log(os.path.join(self.rec_path, "timestamps.log"),1)
 
 
         video_path = os.path.join(self.rec_path, "world.avi")
-        self.writer = cv2.VideoWriter(video_path, cv2.cv.CV_FOURCC(*'DIVX'), fps, (img_shape[1], img_shape[0]))
+        # encoding runs on a worker thread, see video_writer.policies for writer_policy
+        self.writer = Async_Video_Writer(video_path, 'DIVX', fps, (img_shape[1], img_shape[0]),policy=writer_policy,timestamps=self.timestamps_log)
         self.height = img_shape[0]
         self.width = img_shape[1]
         # positions path to eye process
         if self.record_eye:
-            self.eye_tx.send(self.rec_path)
+            self.eye_tx.send((self.rec_path,writer_policy))
 
         atb_pos = (10, 540)
         self._bar = atb.Bar(name = self.__class__.__name__, label='REC: '+session_str,
@@ -84,17 +91,22 @@ class Recorder(Plugin):
 
     def update(self,frame,recent_pupil_positons,events):
         self.frame_count += 1
-        for p in recent_pupil_positons:
-            if p['norm_pupil'] is not None:
-                gaze_pt = p['norm_gaze'][0],p['norm_gaze'][1],p['norm_pupil'][0],p['norm_pupil'][1],p['timestamp'],p['confidence']
-                self.gaze_list.append(gaze_pt)
-        self.timestamps.append(frame.timestamp)
-        self.writer.write(frame.img)
+        records = getattr(recent_pupil_positons,'records',None)
+        if records is not None:
+            # the whole batch at once, only detected pupils are logged
+            records = records[records['norm_pupil'][:,0] == records['norm_pupil'][:,0]]
+            if records.shape[0]:
+                self.gaze_log.extend(np.column_stack((records['norm_gaze'],records['norm_pupil'],records['timestamp'],records['confidence'])))
+        else:
+            for p in recent_pupil_positons:
+                if p['norm_pupil'] is not None:
+                    gaze_pt = p['norm_gaze'][0],p['norm_gaze'][1],p['norm_pupil'][0],p['norm_pupil'][1],p['timestamp'],p['confidence']
+                    self.gaze_log.append(gaze_pt)
+        self.writer.write(frame.img,frame.timestamp)
 
     def stop_and_destruct(self):
-        #explicit release of VideoWriter
+        # wait for the encoder to finish, only frames that made it into the video have timestamps
         self.writer.release()
-        self.writer = None
 
         if self.record_eye:
             try:
@@ -102,10 +114,10 @@ class Recorder(Plugin):
             except:
                 logger.warning("Could not stop eye-recording. Please report this bug!")
         gaze_list_path = os.path.join(self.rec_path, "gaze_positions.npy")
-        np.save(gaze_list_path,np.asarray(self.gaze_list))
+        self.gaze_log.finalize(gaze_list_path)
 
         timestamps_path = os.path.join(self.rec_path, "timestamps.npy")
-        np.save(timestamps_path,np.array(self.timestamps))
+        self.timestamps_log.finalize(timestamps_path)
 
         try:
             surface_definitions_file = glob(os.path.join(self.g_pool.user_dir,"surface_definitions*"))[0].rsplit(os.path.sep,1)[-1]
@@ -134,9 +146,9 @@ class Recorder(Plugin):
         try:
             with open(self.meta_info_path, 'a') as f:
                 f.write("Duration Time\t"+ self.get_rec_time_str()+ "\n")
-                f.write("World Camera Frames\t"+ str(self.frame_count)+ "\n")
+                f.write("World Camera Frames\t"+ str(len(self.timestamps_log))+ "\n")
+                f.write(self.writer.meta_info("World Video Writer"))
                 f.write("World Camera Resolution\t"+ str(self.width)+"x"+str(self.height)+"\n")
-                f.write("Capture Software Version\t"+ self.g_pool.version + "\n")
                 f.write("User\t"+os.getlogin()+"\n")
                 try:
                     sysname, nodename, release, version, machine = os.uname()
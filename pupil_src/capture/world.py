@@ -32,10 +32,12 @@ import atb
 from methods import normalize, denormalize,Temp
 from gl_utils import basic_gl_setup, adjust_gl_view, draw_gl_texture, clear_gl_screen, draw_gl_point_norm,draw_gl_texture
 from uvc_capture import autoCreateCapture
+from ring_buffer import Pupil_Positions
 import calibrate
 # Plug-ins
 import calibration_routines
 import recorder
+import video_writer
 from show_calibration import Show_Calibration
 from display_recent_gaze import Display_Recent_Gaze
 from pupil_server import Pupil_Server
@@ -49,7 +51,7 @@ def world(g_pool,cap_src,cap_size):
     """world
     Creates a window, gl context.
     Grabs images from a capture.
-    Receives Pupil coordinates from g_pool.pupil_queue
+    Receives Pupil coordinates from g_pool.pupil_queue (a shared memory Ring_Buffer)
     Can run various plug-ins.
     """
 
@@ -158,7 +160,8 @@ def world(g_pool,cap_src,cap_size):
         if not bar.rec_name.value:
             bar.rec_name.value = recorder.get_auto_name()
 
-        new_plugin = recorder.Recorder(g_pool,bar.rec_name.value, bar.fps.value, frame.img.shape, bar.record_eye.value, g_pool.eye_tx)
+        writer_policy = video_writer.policies[bar.writer_policy.value]
+        new_plugin = recorder.Recorder(g_pool,bar.rec_name.value, bar.fps.value, frame.img.shape, bar.record_eye.value, g_pool.eye_tx,writer_policy)
         g.plugins.append(new_plugin)
         g.plugins.sort(key=lambda p: p.order)
 
@@ -203,9 +206,11 @@ def world(g_pool,cap_src,cap_size):
     bar.timestamp = time()
     bar.calibration_type = c_int(load("calibration_type",0))
     bar.record_eye = c_bool(load("record_eye",0))
+    bar.writer_policy = c_int(load("writer_policy",0))
     bar.window_size = c_int(load("window_size",0))
     window_size_enum = atb.enum("Display Size",{"Full":0, "Medium":1,"Half":2,"Mini":3})
     calibrate_type_enum = atb.enum("Calibration Method",calibration_routines.index_by_name)
+    writer_policy_enum = atb.enum("Writer Backpressure",dict(zip(video_writer.policies,range(len(video_writer.policies)))))
     bar.rec_name = create_string_buffer(512)
     bar.version = create_string_buffer(g_pool.version,512)
     bar.rec_name.value = recorder.get_auto_name()
@@ -216,6 +221,7 @@ def world(g_pool,cap_src,cap_size):
     bar.add_var("session name",bar.rec_name, group="Recording", help="creates folder Data_Name_XXX, where xxx is an increasing number")
     bar.add_button("record", toggle_record_video, key="r", group="Recording", help="Start/Stop Recording")
     bar.add_var("record eye", bar.record_eye, group="Recording", help="check to save raw video of eye")
+    bar.add_var("writer backpressure", bar.writer_policy, vtype=writer_policy_enum, group="Recording", help="what to do when video encoding falls behind: block capture, drop the oldest or the newest queued frame")
     bar.add_button("start/stop marker tracking",toggle_ar,key="x",help="find markers in scene to map gaze onto referace surfaces")
     bar.add_button("start/stop server",toggle_server,key="s",help="the server broadcasts pupil and gaze positions locally or via network")
     bar.add_separator("Sep1")
@@ -285,14 +291,10 @@ def world(g_pool,cap_src,cap_size):
         events = []
 
         #receive and map pupil positions
-        recent_pupil_positions = []
-        while not g_pool.pupil_queue.empty():
-            p = g_pool.pupil_queue.get()
-            if p['norm_pupil'] is None:
-                p['norm_gaze'] = None
-            else:
-                p['norm_gaze'] = g_pool.map_pupil(p['norm_pupil'])
-            recent_pupil_positions.append(p)
+        # all pending samples are mapped in one polynomial evaluation, not detected pupils stay nan
+        pupil_records = calibrate.map_pupil_records(g_pool.map_pupil,g_pool.pupil_queue.get_records())
+        # plugins get the records as dict like Pupil_Datum and the whole batch as .records
+        recent_pupil_positions = Pupil_Positions(pupil_records)
 
 
         # allow each Plugin to do its work.
@@ -324,6 +326,7 @@ def world(g_pool,cap_src,cap_size):
     save('window_size',bar.window_size.value)
     save('calibration_type',bar.calibration_type.value)
     save('record_eye',bar.record_eye.value)
+    save('writer_policy',bar.writer_policy.value)
     session_settings.close()
 
     cap.close()
@@ -19,14 +19,14 @@ logger = logging.getLogger(__name__)
 from ctypes import c_bool, c_int,create_string_buffer
 
 if platform.system() == 'Darwin':
-    from billiard import Process,forking_enable
+    from billiard import Process,forking_enable,cpu_count
     from billiard.sharedctypes import RawValue
 else:
-    from multiprocessing import Process
+    from multiprocessing import Process,cpu_count
     forking_enable = lambda x: x #dummy fn
     from multiprocessing.sharedctypes import RawValue
 
-from exporter import export
+from exporter import export, export_parallel
 
 def verify_out_file_path(out_file_path,data_dir):
     #Out file path verification
@@ -65,6 +65,7 @@ class Export_Launcher(Plugin):
         self.rec_name = create_string_buffer("world_viz.avi",512)
         self.start_frame = c_int(0)
         self.end_frame = c_int(frame_count)
+        self.n_workers = c_int(1)
 
 
     def init_gui(self):
@@ -90,6 +91,7 @@ class Export_Launcher(Plugin):
         self._bar.add_var('export name',self.rec_name)
         self._bar.add_var('start frame',self.start_frame)
         self._bar.add_var('end frame',self.end_frame)
+        self._bar.add_var('worker processes',self.n_workers,min=1,max=cpu_count(),help="more than one worker renders the export in parallel shards that are stitched at the end. The shards are lossless and need about 2.8 MB of temporary disk space per 720p frame.")
         self._bar.add_button('new export',self.add_export)
 
         for job,i in zip(self.exports,range(len(self.exports))):
@@ -110,6 +112,8 @@ class Export_Launcher(Plugin):
 
     def atb_progress(self,job):
         if job.current_frame.value == job.frames_to_export.value:
+            if job.stitched_frame is not None and job.stitched_frame.value < job.frames_to_export.value:
+                return create_string_buffer("stitching %s / %s" %(job.stitched_frame.value,job.frames_to_export.value),512)
             return create_string_buffer("Done",512)
         return create_string_buffer("%s / %s" %(job.current_frame.value,job.frames_to_export.value),512)
 
@@ -140,10 +144,16 @@ class Export_Launcher(Plugin):
                 pass
 
         out_file_path=verify_out_file_path(self.rec_name.value,self.data_dir)
-        process = Process(target=export, args=(should_terminate,frames_to_export,current_frame, data_dir,start_frame,end_frame,plugins,out_file_path))
+        if self.n_workers.value > 1:
+            stitched_frame = RawValue(c_int,0)
+            process = Process(target=export_parallel, args=(should_terminate,frames_to_export,current_frame, data_dir,start_frame,end_frame,plugins,out_file_path,self.n_workers.value,self.g_pool.gaze_version,stitched_frame))
+        else:
+            stitched_frame = None
+            process = Process(target=export, args=(should_terminate,frames_to_export,current_frame, data_dir,start_frame,end_frame,plugins,out_file_path,0,self.g_pool.gaze_version))
         process.should_terminate = should_terminate
         process.frames_to_export = frames_to_export
         process.current_frame = current_frame
+        process.stitched_frame = stitched_frame
         process.out_file_path = out_file_path
         self.new_export = process
 
@@ -17,12 +17,20 @@ if __name__ == '__main__':
     del syspath, ospath
 
 
-import os
-from time import time
+import os, platform
+from time import time, sleep
+from ctypes import c_int
 import cv2
 import numpy as np
+if platform.system() == 'Darwin':
+    from billiard import Process,forking_enable
+    from billiard.sharedctypes import RawValue
+else:
+    from multiprocessing import Process
+    forking_enable = lambda x: x #dummy fn
+    from multiprocessing.sharedctypes import RawValue
 from uvc_capture import autoCreateCapture
-from player_methods import correlate_gaze
+from player_methods import load_positions_by_frame
 from methods import denormalize, Temp
 #logging
 import logging
@@ -45,7 +53,15 @@ additive_plugins = (Vis_Circle,Vis_Polyline)
 
 
 
-def export(should_terminate,frames_to_export,current_frame, data_dir,start_frame=None,end_frame=None,plugin_initializers=[],out_file_path=None):
+def export(should_terminate,frames_to_export,current_frame, data_dir,start_frame=None,end_frame=None,plugin_initializers=[],out_file_path=None,warm_up_frames=0,gaze_version=None,fps=None,fourcc='DIVX'):
+    """
+    render plugins into the frames start_frame:end_frame of the world video and write them to out_file_path.
+    warm_up_frames: number of frames before start_frame that are fed to the plugins but not written.
+    This lets stateful plugins (Scan_Path) start a shard of a parallel export in the same state a serial export would be in.
+    gaze_version: re-calibrated gaze to render (see offline_calibration), None for the gaze as recorded.
+    fps: frame rate of the video, None for the average frame rate of start_frame:end_frame.
+    fourcc: codec of the video, if it is not available DIVX is used.
+    """
 
 
     logger = logging.getLogger(__name__+' with pid: '+str(os.getpid()) )
@@ -65,11 +81,9 @@ def export(should_terminate,frames_to_export,current_frame, data_dir,start_frame
     logger.debug("Exporting a video from recording with version: %s , %s"%(rec_version,rec_version_int))
 
 
-    #load gaze information
-    gaze_list = np.load(gaze_positions_path)
-    timestamps = np.load(timestamps_path)
-    #correlate data
-    positions_by_frame = correlate_gaze(gaze_list,timestamps)
+    #load gaze information, correlated to world frames (memory mapped)
+    timestamps = np.load(timestamps_path,mmap_mode='r')
+    positions_by_frame = load_positions_by_frame(data_dir,gaze_version)
 
 
     # Initialize capture, check if it works
@@ -114,14 +128,19 @@ def export(should_terminate,frames_to_export,current_frame, data_dir,start_frame
 
 
     #lets get the avg. framerate for our slice of video:
-    fps = float(len(trimmed_timestamps))/(trimmed_timestamps[-1] - trimmed_timestamps[0])
+    if fps is None:
+        fps = float(len(trimmed_timestamps))/(trimmed_timestamps[-1] - trimmed_timestamps[0])
     logger.debug("Framerate of export video is %s"%fps)
 
 
     #setup of writer
-    writer = cv2.VideoWriter(out_file_path, cv2.cv.CV_FOURCC(*'DIVX'), fps, (width,height))
+    writer = cv2.VideoWriter(out_file_path, cv2.cv.CV_FOURCC(*fourcc), fps, (width,height))
+    if not writer.isOpened() and fourcc != 'DIVX':
+        logger.warning("Codec %s is not available, using DIVX."%fourcc)
+        writer = cv2.VideoWriter(out_file_path, cv2.cv.CV_FOURCC(*'DIVX'), fps, (width,height))
 
-    cap.seek_to_frame(start_frame)
+    warm_up_start = max(0,start_frame-warm_up_frames)
+    cap.seek_to_frame(warm_up_start)
 
     start_time = time()
 
@@ -141,6 +160,16 @@ def export(should_terminate,frames_to_export,current_frame, data_dir,start_frame
         except:
             logger.warning("Plugin '%s' failed to load." %name)
 
+    #feed the warm up frames to the plugins, they are not written.
+    for _ in xrange(start_frame-warm_up_start):
+        frame = cap.get_frame()
+        if not frame:
+            logger.error("Could not read warm up frames.")
+            break
+        current_pupil_positions = positions_by_frame[frame.index]
+        for p in plugins:
+            p.update(frame,current_pupil_positions,None)
+
 
     while frames_to_export.value - current_frame.value > 0:
 
@@ -191,6 +220,152 @@ def export(should_terminate,frames_to_export,current_frame, data_dir,start_frame
 
 
 
+def warm_up_frames_for(plugin_initializers,fps):
+    """
+    how many frames before a shard border stateful plugins need to see to render the border frame like a serial export.
+    Plugins that keep a history of gaze for `timeframe` seconds (Scan_Path) need that many seconds of frames.
+    """
+    timeframe = max([args.get('timeframe',0) for name,args in plugin_initializers]+[0])
+    return int(np.ceil(timeframe*fps))+1 if timeframe else 0
+
+
+def make_shards(start_frame,end_frame,n_shards):
+    """
+    split start_frame:end_frame into n_shards consecutive (start,end) slices of about equal size.
+    There are never more shards than frames.
+    """
+    n_shards = max(1,min(n_shards,end_frame-start_frame))
+    borders = np.linspace(start_frame,end_frame,n_shards+1).astype(int)
+    return [(s,e) for s,e in zip(borders[:-1],borders[1:]) if e > s]
+
+
+def stitch_videos(part_paths,out_file_path,fps,size,should_terminate,stitched_frame):
+    """
+    append the frames of all part videos in order to one DIVX video at out_file_path. Parts are removed.
+    The parts are written with a fast intermediate codec (part_fourcc) that keeps all detail DIVX can keep,
+    so this is the only lossy encoding and decoding the parts is cheap.
+    """
+    writer = cv2.VideoWriter(out_file_path, cv2.cv.CV_FOURCC(*'DIVX'), fps, size)
+    for part_path in part_paths:
+        cap = cv2.VideoCapture(part_path)
+        while not should_terminate.value:
+            s,img = cap.read()
+            if not s:
+                break
+            writer.write(img)
+            stitched_frame.value += 1
+        cap.release()
+        os.remove(part_path)
+    writer.release()
+    writer = None
+    return not should_terminate.value
+
+
+# huffyuv: lossless apart from 4:2:2 chroma (DIVX is 4:2:0 anyway) and much faster to encode and decode than DIVX.
+part_fourcc = 'HFYU'
+# huffyuv compresses camera images only a little, we plan with uncompressed 24bit frames:
+# about 2.8 MB per 1280x720 frame, 1 minute at 30 fps is about 5GB of parts.
+part_bytes_per_pixel = 3
+
+def free_disk_space(path):
+    """
+    bytes available to the user at the file system of path, None where we cannot tell.
+    """
+    try:
+        stat = os.statvfs(path)
+    except (AttributeError,OSError):
+        return None
+    return stat.f_bavail*stat.f_frsize
+
+def export_parallel(should_terminate,frames_to_export,current_frame, data_dir,start_frame=None,end_frame=None,plugin_initializers=[],out_file_path=None,n_workers=2,gaze_version=None,stitched_frame=None):
+    """
+    parallel version of export(): start_frame:end_frame is split into (at most) n_workers shards.
+    Each shard is exported by its own process (own capture, own plugin instances) into a part video,
+    stateful plugins get warm up frames before the shard border.
+    The parts are then stitched in order into out_file_path.
+
+    The parts are lossless and large: they need up to width*height*part_bytes_per_pixel bytes per exported frame
+    of temporary disk space next to out_file_path (about 2.8 MB per 720p frame) until the stitching is done.
+    When the disk does not have that much free space we export serially with export() instead.
+
+    Rendering progress is reported through frames_to_export and current_frame like export(),
+    stitching progress through stitched_frame (a shared int counting up to frames_to_export as well).
+    """
+    logger = logging.getLogger(__name__+' with pid: '+str(os.getpid()) )
+    if stitched_frame is None:
+        stitched_frame = RawValue(c_int,0)
+
+    timestamps = np.load(data_dir + "/timestamps.npy",mmap_mode='r')
+    trimmed_timestamps = timestamps[start_frame:end_frame]
+    if len(trimmed_timestamps)==0:
+        logger.warn("Start and end frames are set such that no video will be exported.")
+        return False
+    #normalize trim marks to absolute frame indices (they are defined like python list slices)
+    start_frame,end_frame,_ = slice(start_frame,end_frame).indices(len(timestamps))
+
+    if out_file_path is None:
+        out_file_path = os.path.join(data_dir, "world_viz.avi")
+    # every part is written with the frame rate of the whole export, a short shard has no meaningful one of its own.
+    fps = float(len(trimmed_timestamps))/(trimmed_timestamps[-1] - trimmed_timestamps[0])
+    cap = autoCreateCapture(data_dir + "/world.avi",timestamps=data_dir + "/timestamps.npy")
+    if cap is None:
+        logger.error("Did not receive valid Capture")
+        return False
+    size = cap.get_size()
+    cap.close()
+
+    part_bytes = (end_frame-start_frame)*size[0]*size[1]*part_bytes_per_pixel
+    free_bytes = free_disk_space(os.path.dirname(os.path.abspath(out_file_path)))
+    if free_bytes is not None and free_bytes < part_bytes:
+        logger.warning("Parallel export needs up to %.1f GB of temporary disk space for its lossless parts but only %.1f GB are free. Exporting with one process instead."%(part_bytes/1e9,free_bytes/1e9))
+        done = export(should_terminate,frames_to_export,current_frame,data_dir,start_frame,end_frame,plugin_initializers,out_file_path,0,gaze_version)
+        stitched_frame.value = frames_to_export.value
+        return done
+    logger.debug("Parallel export will use up to %.1f GB of temporary disk space for its parts."%(part_bytes/1e9))
+
+    shards = make_shards(start_frame,end_frame,n_workers)
+    warm_up_frames = warm_up_frames_for(plugin_initializers,fps)
+    base_path,ext = os.path.splitext(out_file_path)
+    part_paths = ["%s.part%02d.avi"%(base_path,i) for i in range(len(shards))]
+    logger.debug("Exporting %s frames in %s shards with %s warm up frames per shard."%(end_frame-start_frame,len(shards),warm_up_frames))
+
+    frames_to_export.value = end_frame-start_frame
+    current_frame.value = 0
+    stitched_frame.value = 0
+
+    # on MacOS we will not use os.fork, elsewhere this does nothing.
+    forking_enable(0)
+    start_time = time()
+    workers = []
+    for (s,e),part_path in zip(shards,part_paths):
+        w_frames_to_export,w_current_frame = RawValue(c_int,0),RawValue(c_int,0)
+        w = Process(target=export, args=(should_terminate,w_frames_to_export,w_current_frame,data_dir,s,e,plugin_initializers,part_path,warm_up_frames,gaze_version,fps,part_fourcc))
+        w.current_frame = w_current_frame
+        w.start()
+        workers.append(w)
+
+    while any([w.is_alive() for w in workers]):
+        current_frame.value = sum([w.current_frame.value for w in workers])
+        sleep(.1)
+    current_frame.value = sum([w.current_frame.value for w in workers])
+
+    if should_terminate.value or current_frame.value != end_frame-start_frame:
+        if not should_terminate.value:
+            logger.error("Export of at least one shard failed.")
+        for part_path in part_paths:
+            if os.path.isfile(part_path):
+                os.remove(part_path)
+        return False
+
+    if not stitch_videos(part_paths,out_file_path,fps,size,should_terminate,stitched_frame):
+        logger.warning("User aborted export while stitching.")
+        return False
+
+    duration = time()-start_time
+    logger.info("Export done: Exported %s frames to %s with %s workers. This took %s seconds. Exporter ran at %s frames per second"%(end_frame-start_frame,out_file_path,len(shards),duration,(end_frame-start_frame)/duration))
+    return True
+
+
 
 if __name__ == '__main__':
 
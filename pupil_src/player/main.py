@@ -45,11 +45,11 @@ import numpy as np
 from glfw import *
 import atb
 
-from uvc_capture import autoCreateCapture
+from uvc_capture import autoCreateCapture, Read_Ahead_Capture
 
 # helpers/utils
 from methods import normalize, denormalize,Temp
-from player_methods import correlate_gaze,patch_meta_info,is_pupil_rec_dir
+from player_methods import load_positions_by_frame,patch_meta_info,is_pupil_rec_dir,recover_crashed_recording
 from gl_utils import basic_gl_setup, adjust_gl_view, draw_gl_texture, clear_gl_screen, draw_gl_point_norm,draw_gl_texture
 
 import logging
@@ -94,8 +94,9 @@ from seek_bar import Seek_Bar
 from export_launcher import Export_Launcher
 from scan_path import Scan_Path
 from marker_detector import Marker_Detector
+from offline_calibration import Offline_Calibration
 
-plugin_by_index =  (Vis_Circle,Vis_Cross, Vis_Polyline, Scan_Path, Vis_Light_Points,Marker_Detector)
+plugin_by_index =  (Vis_Circle,Vis_Cross, Vis_Polyline, Scan_Path, Vis_Light_Points,Marker_Detector,Offline_Calibration)
 name_by_index = [p.__name__ for p in plugin_by_index]
 index_by_name = dict(zip(name_by_index,range(len(name_by_index))))
 plugin_by_name = dict(zip(name_by_index,plugin_by_index))
@@ -117,6 +118,13 @@ def main():
             if action == GLFW_PRESS:
                 if key == GLFW_KEY_ESCAPE:
                     pass
+                #single step through the video when paused
+                elif key == GLFW_KEY_RIGHT and not g.play:
+                    if cap.seek_to_frame(cap.get_frame_index()):
+                        g.new_seek = True
+                elif key == GLFW_KEY_LEFT and not g.play:
+                    if cap.seek_to_frame(cap.get_frame_index()-2):
+                        g.new_seek = True
 
 
     def on_char(window,char):
@@ -160,6 +168,10 @@ def main():
                        \nPlease supply a Pupil recoding directory as first arg when calling Pupil Player.")
             return
 
+    #recordings of a crashed capture session only have the streamed logs.
+    if os.path.isdir(rec_dir):
+        recover_crashed_recording(rec_dir)
+
     if not is_pupil_rec_dir(rec_dir):
         logger.error("You did not supply a dir with the required files inside.")
         return
@@ -182,12 +194,8 @@ def main():
     logger.debug("Recording version: %s , %s"%(rec_version,rec_version_float))
 
 
-    #load gaze information
-    gaze_list = np.load(gaze_positions_path)
-    timestamps = np.load(timestamps_path)
-
-    #correlate data
-    positions_by_frame = correlate_gaze(gaze_list,timestamps)
+    #load gaze information, correlated to world frames (memory mapped)
+    timestamps = np.load(timestamps_path,mmap_mode='r')
 
 
     # load session persistent settings
@@ -199,10 +207,13 @@ def main():
 
 
     # Initialize capture, check if it works
-    cap = autoCreateCapture(video_path,timestamps=timestamps_path)
+    # decoded frames around the playhead are cached to make scrubbing and stepping instant.
+    cap = autoCreateCapture(video_path,timestamps=timestamps_path,cache_size_mb=256)
     if cap is None:
         logger.error("Did not receive valid Capture")
         return
+    # decode ahead on a background thread so decode spikes do not show up as stutter.
+    cap = Read_Ahead_Capture(cap,max_queue_size=10)
     width,height = cap.get_size()
 
 
@@ -231,6 +242,10 @@ def main():
     g.user_dir = user_dir
     g.rec_dir = rec_dir
     g.app = 'player'
+    g.world_size = width,height
+    # Offline_Calibration can switch to re-calibrated gaze
+    g.gaze_version = None
+    g.positions_by_frame = load_positions_by_frame(rec_dir)
 
     # helpers called by the main atb bar
     def update_fps():
@@ -366,7 +381,7 @@ def main():
         frame = new_frame.copy()
 
         #new positons and events
-        current_pupil_positions = positions_by_frame[frame.index][:]
+        current_pupil_positions = g.positions_by_frame[frame.index][:]
         events = []
 
         # allow each Plugin to do its work.
@@ -0,0 +1,163 @@
+'''
+(*)~----------------------------------------------------------------------------------
+ Pupil - eye tracking platform
+ Copyright (C) 2012-2014  Pupil Labs
+
+ Distributed under the terms of the CC BY-NC-SA License.
+ License details are in the file license.txt, distributed as part of this software.
+----------------------------------------------------------------------------------~(*)
+'''
+
+"""
+Offline re-calibration of a recording.
+
+Gaze is mapped at capture time and saved in gaze_positions.npy.
+Here the calibration point cloud (the cal_pt_cloud.npy the recorder copies into the recording
+or any other one) is fitted again and every norm_pupil of gaze_positions.npy is remapped
+in one vectorized pass. The result is saved as gaze_positions_<version>.npy next to the original
+(which is never changed) together with the point cloud used as cal_pt_cloud_<version>.npy,
+so several calibrations of the same recording can be compared in Player.
+
+usage: python offline_calibration.py path/to/recording [path/to/cal_pt_cloud.npy] [version]
+The world video size is taken from the recording.
+"""
+
+if __name__ == '__main__':
+    # make shared modules available across pupil_src
+    from sys import path as syspath
+    from os import path as ospath
+    loc = ospath.abspath(__file__).rsplit('pupil_src', 1)
+    syspath.append(ospath.join(loc[0], 'pupil_src', 'shared_modules'))
+    del syspath, ospath
+
+import os
+import numpy as np
+from ctypes import c_int,create_string_buffer
+from plugin import Plugin
+import calibrate
+from player_methods import gaze_positions_file,gaze_versions,load_positions_by_frame,world_size,_save_atomic
+#logging
+import logging
+logger = logging.getLogger(__name__)
+
+
+def next_gaze_version(data_dir):
+    versions = [int(v) for v in gaze_versions(data_dir) if v.isdigit()]
+    return "%03d"%(max(versions+[0])+1)
+
+
+def recalibrate_recording(data_dir,cal_pt_cloud=None,gaze_version=None,screen_size=None):
+    """
+    refit the calibration and remap all gaze of a recording.
+    cal_pt_cloud: point cloud array, path to a .npy file or None for the cal_pt_cloud.npy of the recording
+    gaze_version: name of the new gaze file, the next free number if None
+    screen_size: world video size in pixels, None to read it from the recording.
+        The outlier threshold of the fit is in pixels, so this decides which points are outliers.
+    returns the gaze version that was written.
+    """
+    if cal_pt_cloud is None:
+        cal_pt_cloud = os.path.join(data_dir,"cal_pt_cloud.npy")
+    if isinstance(cal_pt_cloud,basestring):
+        cal_pt_cloud = np.load(cal_pt_cloud)
+    cal_pt_cloud = np.asarray(cal_pt_cloud,dtype=np.float64)
+    if gaze_version is None:
+        gaze_version = next_gaze_version(data_dir)
+    if screen_size is None:
+        screen_size = world_size(data_dir)
+
+    map_fn = calibrate.get_map_from_cloud(cal_pt_cloud,screen_size)
+    gaze_positions = np.load(gaze_positions_file(data_dir))
+    remapped = calibrate.map_gaze_positions(map_fn,gaze_positions)
+
+    _save_atomic(os.path.join(data_dir,"cal_pt_cloud_%s.npy"%gaze_version),cal_pt_cloud)
+    _save_atomic(gaze_positions_file(data_dir,gaze_version),remapped)
+    logger.info("Remapped %s gaze positions of %s with %s calibration points into gaze version %s."%(remapped.shape[0],data_dir,cal_pt_cloud.shape[0],gaze_version))
+    return gaze_version
+
+
+class Offline_Calibration(Plugin):
+    """
+    re-calibrate the open recording and choose which gaze Player shows.
+    The selected gaze version is g_pool.gaze_version, exports use it as well.
+    """
+    def __init__(self, g_pool,gaze_version=None,cal_pt_cloud_path=None,gui_settings={'pos':(320,10),'size':(300,100),'iconified':False}):
+        super(Offline_Calibration, self).__init__()
+        self.g_pool = g_pool
+        self.order = .2
+        self.gui_settings = gui_settings
+
+        if cal_pt_cloud_path is None:
+            cal_pt_cloud_path = os.path.join(g_pool.rec_dir,"cal_pt_cloud.npy")
+        self.cal_pt_cloud_path = create_string_buffer(cal_pt_cloud_path,512)
+        self.versions = [None] + gaze_versions(g_pool.rec_dir)
+        self.selected = c_int(0)
+        if gaze_version in self.versions:
+            self.select_version(self.versions.index(gaze_version),self.selected)
+
+    def select_version(self,selection,data):
+        gaze_version = self.versions[selection]
+        try:
+            self.g_pool.positions_by_frame = load_positions_by_frame(self.g_pool.rec_dir,gaze_version)
+        except (OSError,IOError,ValueError) as e:
+            logger.error("Could not load gaze version %s: %s"%(gaze_version,e))
+            return
+        self.g_pool.gaze_version = gaze_version
+        data.value = selection
+
+    def get_from_data(self,data):
+        return data.value
+
+    def get_version_name(self,data):
+        return create_string_buffer(self.versions[data.value] or "as recorded",512)
+
+    def recalibrate(self):
+        try:
+            gaze_version = recalibrate_recording(self.g_pool.rec_dir,self.cal_pt_cloud_path.value,screen_size=self.g_pool.world_size)
+        except (OSError,IOError,ValueError,np.linalg.LinAlgError) as e:
+            logger.error("Re-calibration failed: %s"%e)
+            return
+        self.versions.append(gaze_version)
+        self._bar.define(definition='max=%s'%(len(self.versions)-1),varname='gaze_version')
+        self.select_version(len(self.versions)-1,self.selected)
+
+    def init_gui(self):
+        import atb
+        pos = self.gui_settings['pos']
+        self._bar = atb.Bar(name =self.__class__.__name__, label="Offline Calibration",
+            help="re-calibrate and remap the gaze of this recording", color=(50, 50, 50), alpha=100,
+            text='light', position=pos,refresh=.3, size=self.gui_settings['size'])
+        self._bar.iconified = self.gui_settings['iconified']
+
+        self._bar.add_var('point cloud',self.cal_pt_cloud_path,help="calibration point cloud (.npy) used for re-calibration")
+        self._bar.add_button('recalibrate',self.recalibrate,help="fit the point cloud again and remap all gaze into a new gaze version")
+        self._bar.add_var('gaze_version',label='gaze version',vtype=c_int,setter=self.select_version,getter=self.get_from_data,data=self.selected,min=0,max=len(self.versions)-1,help="0 is the gaze as recorded")
+        self._bar.add_var('showing',create_string_buffer(512),getter=self.get_version_name,data=self.selected)
+        self._bar.add_button('remove',self.unset_alive)
+
+    def unset_alive(self):
+        self.alive = False
+
+    def get_init_dict(self):
+        d = {'gaze_version':self.versions[self.selected.value],'cal_pt_cloud_path':self.cal_pt_cloud_path.value}
+        if hasattr(self,'_bar'):
+            gui_settings = {'pos':self._bar.position,'size':self._bar.size,'iconified':self._bar.iconified}
+            d['gui_settings'] = gui_settings
+        return d
+
+    def cleanup(self):
+        # back to the gaze as recorded
+        if self.g_pool.gaze_version is not None:
+            self.select_version(0,self.selected)
+        self._bar.destroy()
+
+
+if __name__ == '__main__':
+    import sys
+    logging.basicConfig(level=logging.INFO)
+    if len(sys.argv) < 2:
+        print __doc__
+        sys.exit(1)
+    data_dir = sys.argv[1]
+    cal_pt_cloud = sys.argv[2] if len(sys.argv) > 2 else None
+    gaze_version = sys.argv[3] if len(sys.argv) > 3 else None
+    print "Saved gaze version %s"%recalibrate_recording(data_dir,cal_pt_cloud,gaze_version)
@@ -11,45 +11,205 @@
 
 import os
 import cv2
+import numpy as np
+from record_log import load_record_log
+from record_view import Record_View
 #logging
 import logging
 logger = logging.getLogger(__name__)
 
 
+def correlate_gaze_index(gaze_list,timestamps):
+    '''
+    gaze_list: gaze x | gaze y | pupil x | pupil y | timestamp (| confidence)
+    timestamps timestamps to correlate gaze data to
+
+    Buckets all gaze samples into world frames in one pass:
+    A gaze sample belongs to the first frame whose midpoint to the next frame
+    is not earlier than the gaze timestamp.
+    Gaze samples after the midpoint between the last two frames are not assigned (like before).
+
+    returns two int arrays with the length of the number of recorded frames:
+    the gaze samples of frame i are gaze_list[start[i]:end[i]]
+    '''
+    gaze_timestamps = np.asarray(gaze_list)[:,4] if len(gaze_list) else np.zeros(0)
+    timestamps = np.asarray(timestamps,dtype=np.float64)
+
+    end = np.zeros(timestamps.shape[0],dtype=np.int64)
+    if timestamps.shape[0] > 1:
+        t_between_frames = (timestamps[:-1]+timestamps[1:]) / 2.
+        end[:-1] = np.searchsorted(gaze_timestamps,t_between_frames,side='right')
+        # the last frame has no next frame and gets no gaze.
+        end[-1] = end[-2]
+    start = np.empty_like(end)
+    start[:1] = 0
+    start[1:] = end[:-1]
+    return start,end
+
+
+# columnar record of one gaze sample as stored in the gaze store
+gaze_dtype = np.dtype([('norm_gaze',np.float64,(2,)),
+                       ('norm_pupil',np.float64,(2,)),
+                       ('timestamp',np.float64),
+                       ('confidence',np.float64)])
+
+
+def gaze_list_to_records(gaze_list):
+    '''
+    gaze_list: gaze x | gaze y | pupil x | pupil y | timestamp (| confidence)
+    returns a structured array with gaze_dtype.
+    Recordings that did not save confidence get a confidence of 1.
+    '''
+    gaze_list = np.asarray(gaze_list,dtype=np.float64)
+    records = np.empty(gaze_list.shape[0],dtype=gaze_dtype)
+    if not records.shape[0]:
+        return records
+    records['norm_gaze'] = gaze_list[:,0:2]
+    records['norm_pupil'] = gaze_list[:,2:4]
+    records['timestamp'] = gaze_list[:,4]
+    if gaze_list.shape[1] > 5:
+        records['confidence'] = gaze_list[:,5]
+    else:
+        records['confidence'] = 1.
+    return records
+
+
+class Gaze_Datum(Record_View):
+    """
+    lightweight view on one row of the gaze store.
+    It behaves like the dicts plugins used before:
+    datum['norm_gaze'], datum['norm_pupil'], datum['timestamp'], datum['confidence']
+
+    The store may be memory mapped read-only.
+    Values written by plugins (e.g. Scan_Path moving norm_gaze) shadow the stored values.
+    """
+    __slots__ = ()
+
+
+class Positions_By_Frame(object):
+    """
+    view on the gaze store and a per frame index.
+    Indexing with a frame index returns a new list with a Gaze_Datum for each
+    gaze sample of that frame, just like the list of lists of dicts
+    that was used by plugins before.
+
+    Nothing is copied out of the store, only the views for the requested frame are made.
+    """
+    def __init__(self, records,start,end):
+        self.records = records
+        self.start = start
+        self.end = end
+
+    def __len__(self):
+        return self.start.shape[0]
+
+    def __getitem__(self,frame_idx):
+        return [Gaze_Datum(self.records,row) for row in xrange(self.start[frame_idx],self.end[frame_idx])]
+
+    def __iter__(self):
+        for frame_idx in xrange(len(self)):
+            yield self[frame_idx]
+
+    def records_of_frame(self,frame_idx):
+        '''
+        the structured array slice of a frame, for plugins that want to work on columns.
+        '''
+        return self.records[self.start[frame_idx]:self.end[frame_idx]]
+
+
 def correlate_gaze(gaze_list,timestamps):
     '''
     gaze_list: gaze x | gaze y | pupil x | pupil y | timestamp
     timestamps timestamps to correlate gaze data to
 
 
-    this takes a gaze positions list and a timestamps list and makes a new list
+    this takes a gaze positions list and a timestamps list and makes a new list like object
     with the length of the number of recorded frames.
     Each slot conains a list that will have 0, 1 or more assosiated gaze postions.
-    load gaze information
+    see correlate_gaze_index for the per frame offset index this is based on.
     '''
-    gaze_list = list(gaze_list)
-    timestamps = list(timestamps)
+    records = gaze_list_to_records(gaze_list)
+    start,end = correlate_gaze_index(gaze_list,timestamps)
+    return Positions_By_Frame(records,start,end)
 
 
-    positions_by_frame = [[] for i in timestamps]
-    frame_idx = 0
-    data_point = gaze_list.pop(0)
-    gaze_timestamp = data_point[4]
+def _save_atomic(path,array):
+    # several processes (player, exporters) may build the store at the same time.
+    tmp_path = path + '.%s.tmp'%os.getpid()
+    with open(tmp_path,'wb') as f:
+        np.save(f,array)
+    os.rename(tmp_path,path)
 
-    while gaze_list:
-        # if the current gaze point is before the mean of the current world frame timestamp and the next worldframe timestamp
-        try:
-            t_between_frames = ( timestamps[frame_idx]+timestamps[frame_idx+1] ) / 2.
-        except IndexError:
-            break
-        if gaze_timestamp <= t_between_frames:
-            positions_by_frame[frame_idx].append({'norm_gaze':(data_point[0],data_point[1]),'norm_pupil': (data_point[2],data_point[3]), 'timestamp':gaze_timestamp})
-            data_point = gaze_list.pop(0)
-            gaze_timestamp = data_point[4]
-        else:
-            frame_idx+=1
 
-    return positions_by_frame
+def gaze_positions_file(data_dir,gaze_version=None):
+    '''
+    gaze_positions.npy as recorded or gaze_positions_<gaze_version>.npy made by offline re-calibration
+    '''
+    if gaze_version:
+        return os.path.join(data_dir,"gaze_positions_%s.npy"%gaze_version)
+    return os.path.join(data_dir,"gaze_positions.npy")
+
+
+def gaze_versions(data_dir):
+    '''
+    the versions of re-calibrated gaze of a recording, oldest first.
+    '''
+    versions = []
+    for name in os.listdir(data_dir):
+        if name.startswith("gaze_positions_") and name.endswith(".npy"):
+            versions.append(name[len("gaze_positions_"):-len(".npy")])
+    versions.sort(key=lambda v: os.path.getmtime(gaze_positions_file(data_dir,v)))
+    return versions
+
+
+def load_gaze_store(data_dir,gaze_version=None):
+    '''
+    returns the gaze records (gaze_dtype) and the frame index (n_frames x [start,end])
+    of a recording.
+
+    Both are saved next to gaze_positions.npy as gaze_records.npy and gaze_frame_index.npy
+    the first time a recording is opened and memory mapped from there on.
+    The store is rebuilt when gaze_positions.npy or timestamps.npy are newer than it.
+    Re-calibrated gaze (gaze_version) has its own store: gaze_records_<gaze_version>.npy ...
+    '''
+    suffix = "_%s"%gaze_version if gaze_version else ""
+    gaze_positions_path = gaze_positions_file(data_dir,gaze_version)
+    timestamps_path = os.path.join(data_dir,"timestamps.npy")
+    records_path = os.path.join(data_dir,"gaze_records%s.npy"%suffix)
+    index_path = os.path.join(data_dir,"gaze_frame_index%s.npy"%suffix)
+
+    source_mtime = max(os.path.getmtime(gaze_positions_path),os.path.getmtime(timestamps_path))
+    try:
+        if min(os.path.getmtime(records_path),os.path.getmtime(index_path)) >= source_mtime:
+            records = np.load(records_path,mmap_mode='r')
+            frame_index = np.load(index_path,mmap_mode='r')
+            if records.dtype == gaze_dtype:
+                logger.debug("Loaded gaze store from %s"%data_dir)
+                return records,frame_index
+    except (OSError,IOError,ValueError):
+        pass
+
+    logger.debug("Building gaze store for %s"%data_dir)
+    gaze_list = np.load(gaze_positions_path)
+    timestamps = np.load(timestamps_path)
+    records = gaze_list_to_records(gaze_list)
+    start,end = correlate_gaze_index(gaze_list,timestamps)
+    frame_index = np.column_stack((start,end))
+    try:
+        _save_atomic(records_path,records)
+        _save_atomic(index_path,frame_index)
+    except (OSError,IOError):
+        logger.warning("Could not save gaze store into %s. Will keep it in memory."%data_dir)
+        return records,frame_index
+    return np.load(records_path,mmap_mode='r'),np.load(index_path,mmap_mode='r')
+
+
+def load_positions_by_frame(data_dir,gaze_version=None):
+    '''
+    memory mapped replacement for np.load(gaze_positions) + correlate_gaze
+    '''
+    records,frame_index = load_gaze_store(data_dir,gaze_version)
+    return Positions_By_Frame(records,frame_index[:,0],frame_index[:,1])
 
 
 def rec_version(data_dir):
@@ -60,6 +220,40 @@ def rec_version(data_dir):
     return rec_version_float
 
 
+def world_size(data_dir):
+    '''
+    (width,height) of the world video, from info.csv or the video itself for recordings without the resolution entry.
+    '''
+    with open(data_dir + "/info.csv") as info:
+        meta_info = dict( ((line.strip().split('\t')) for line in info.readlines() ) )
+    try:
+        width,height = meta_info["World Camera Resolution"].split('x')
+        return int(width),int(height)
+    except (KeyError,ValueError):
+        pass
+    cap = cv2.VideoCapture(data_dir + "/world.avi")
+    width,height = int(cap.get(cv2.cv.CV_CAP_PROP_FRAME_WIDTH)),int(cap.get(cv2.cv.CV_CAP_PROP_FRAME_HEIGHT))
+    cap.release()
+    if not width or not height:
+        raise IOError("Could not get the world video size of %s"%data_dir)
+    return width,height
+
+
+
+def recover_crashed_recording(data_dir):
+    '''
+    A recording that was not stopped properly (e.g. Pupil Capture crashed) has the streamed
+    record logs but no gaze_positions.npy and timestamps.npy.
+    We make the .npy files from everything that made it to disk. The logs are kept.
+    '''
+    for name in ('gaze_positions','timestamps','eye_timestamps'):
+        log_path = os.path.join(data_dir,name+'.log')
+        npy_path = os.path.join(data_dir,name+'.npy')
+        if os.path.isfile(log_path) and not os.path.isfile(npy_path):
+            data = load_record_log(log_path)
+            np.save(npy_path,data)
+            logger.warning("Recovered %s records from %s. This recording was not stopped properly."%(data.shape[0],log_path))
+
 
 def is_pupil_rec_dir(data_dir):
     if not os.path.isdir(data_dir):
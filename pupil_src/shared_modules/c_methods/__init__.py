@@ -15,6 +15,7 @@ Only wrappers are exposed not the loaded libraries.
 """
 
 from ctypes import *
+import numpy as np
 from numpy.ctypeslib import ndpointer
 import os,sys
 #logging
@@ -68,6 +69,31 @@ __methods_dll.filter.argtypes = [ndpointer(c_float),  # integral image
                                 POINTER(c_float)]     # maxinal response filter_response
 
 
+### C-Types Argtypes and Restype
+__methods_dll.integral_image.argtypes = [ndpointer(c_uint8),  # 8bit image
+                                        c_int,              # rows/shape[0]
+                                        c_int,              # cols/shape[1]
+                                        c_int,              # bytes per image row
+                                        ndpointer(c_float,flags='C_CONTIGUOUS')]  # integral image (rows+1,cols+1)
+
+
+### C-Types Argtypes and Restype
+__methods_dll.filter_coarse_to_fine.argtypes = [ndpointer(c_float),  # integral image
+                                                c_size_t,           # rows/shape[0]
+                                                c_size_t,           # cols/shape[1]
+                                                c_int,     # search window top left anchor min height
+                                                c_int,     # search window top left anchor max height (excluded)
+                                                c_int,     # search window top left anchor min width
+                                                c_int,     # search window top left anchor max width (excluded)
+                                                c_int,     # maximal response min_w
+                                                c_int,     # maximal response max_w
+                                                c_int,     # scale of the coarse pass
+                                                POINTER(c_int),     # maximal response top left anchor pos height
+                                                POINTER(c_int),     # maximal response top left anchor pos width
+                                                POINTER(c_int),     # maxinal response window size
+                                                POINTER(c_float)]     # maxinal response filter_response
+
+
 ### C-Types Argtypes and Restype
 __methods_dll.ring_filter.argtypes = [ndpointer(c_float),  # integral image
                                     c_size_t,           # rows/shape[0]
@@ -87,6 +113,40 @@ def eye_filter(integral,min_w=10,max_w=100):
     __methods_dll.filter(integral,rows,cols,x,y,w,min_w,max_w,response)
     return x.value,y.value,w.value,response.value
 
+### Function Wrappers
+def integral_image(img,out=None):
+    """
+    float32 integral image of a 2d uint8 image as used by the eye filters.
+    The result is written into out if it has the right shape, pass the last result back in to avoid allocations.
+    """
+    rows, cols = img.shape
+    if img.strides[1] != 1:
+        img = np.ascontiguousarray(img)
+    if out is None or out.shape != (rows+1,cols+1):
+        out = np.empty((rows+1,cols+1),dtype=c_float)
+    __methods_dll.integral_image(img,rows,cols,img.strides[0],out)
+    return out
+
+### Function Wrappers
+def eye_filter_coarse_to_fine(integral,min_w=10,max_w=100,scale=None,window=None):
+    """
+    like eye_filter but searches a downsampled integral image first and refines locally.
+    scale: downsampling of the first pass, default: the largest power of 2 that keeps min_w at 12 coarse pixels or more.
+    window: (min_row,max_row,min_col,max_col) range of the top left window anchor to search, default: all
+    """
+    rows, cols = integral.shape[0],integral.shape[1]
+    if scale is None:
+        scale = 1
+        while scale*2*12 <= min_w:
+            scale *= 2
+    if window is None:
+        window = 0,rows,0,cols
+    x, y, w = c_int(), c_int(), c_int()
+    response = c_float()
+    min_r,max_r,min_c,max_c = [int(v) for v in window]
+    __methods_dll.filter_coarse_to_fine(integral,rows,cols,min_r,max_r,min_c,max_c,int(min_w),int(max_w),int(scale),x,y,w,response)
+    return x.value,y.value,w.value,response.value
+
 ### Function Wrappers
 def ring_filter(integral):
     rows, cols = integral.shape[0],integral.shape[1]
@@ -9,6 +9,7 @@
 */
 
 #include <stdio.h>
+#include <stdlib.h>
 
 
 #define MAX(x, y) (((x) > (y)) ? (x) : (y))
@@ -224,6 +225,125 @@ void filter(const float *img, const int rows, const int cols, int * x_pos,int *y
     }
 
 
+void integral_image(const unsigned char *src, const int rows, const int cols, const int src_step, float *dst)
+// integral image of a 8bit image into a (rows+1) x (cols+1) float32 buffer,
+// same result as np.array(cv2.integral(src),dtype=np.float32) without the temporary int32 image.
+// Sums are accumulated as integers and only the stored value is converted to float.
+{
+    int i, j;
+    const int dst_cols = cols+1;
+    int *col_sums = calloc(cols,sizeof(int));
+    if (col_sums == NULL){
+        return;
+    }
+    for (j=0; j<dst_cols; j++){
+        dst[j] = 0;
+    }
+    for (i=0; i<rows; i++)
+    {
+        const unsigned char *s = src + i*src_step;
+        float *d = dst + (i+1)*dst_cols;
+        int sum = 0;
+        d[0] = 0;
+        for (j=0; j<cols; j++)
+        {
+            col_sums[j] += s[j];
+            sum += col_sums[j];
+            d[j+1] = (float)sum;
+        }
+    }
+    free(col_sums);
+}
+
+
+inline float eye_response(const float *img,point_t size,const eye_t *eye,point_t offset){
+    return eye->outer.f*area(img,size,eye->outer.s,eye->outer.e,offset)
+          +eye->inner.f*area(img,size,eye->inner.s,eye->inner.e,offset);
+}
+
+
+void filter_coarse_to_fine(const float *img, const int rows, const int cols,
+                            int min_r, int max_r, int min_c, int max_c,
+                            int min_w, int max_w, int scale,
+                            int *x_pos, int *y_pos, int *width, float *response)
+// coarse to fine version of filter()
+// The first pass runs on the integral image subsampled by `scale`, this is the integral image of the image downsampled by scale:
+// window sizes and anchor positions are multiples of scale.
+// Every following pass halves the scale and only searches +-2 steps in position and size around the best result so far,
+// the last pass runs at pixel resolution.
+// The top left anchor is searched in [min_r,max_r) x [min_c,max_c) (clipped to the image),
+// pass the full image range for a global search or a small window around a known pupil for tracking.
+{
+    point_t img_size = {rows,cols};
+    int s = MAX(1,scale);
+    int min_h = MAX(1,min_w/3);
+    int max_h = MAX(min_h+1,max_w/3);
+    int h, i, j, prev_s;
+    float best_response = -10000;
+    point_t best_pos = {0,0};
+    int best_h = 0;
+    min_r = MAX(0,min_r);
+    min_c = MAX(0,min_c);
+
+    // coarse pass on the downsampled grid
+    int h_start = ((min_h+s-1)/s)*s;
+    if (h_start >= max_h){
+        // size range smaller than one coarse step
+        h_start = min_h;
+    }
+    for (h = h_start; h < max_h; h+=s)
+        {
+            eye_t eye = make_eye(h);
+            int r_end = MIN(max_r,rows-eye.w);
+            int c_end = MIN(max_c,cols-eye.w);
+            for (i=((min_r+s-1)/s)*s; i<r_end; i +=s)
+            {
+                for (j=((min_c+s-1)/s)*s; j<c_end; j+=s)
+                {
+                    float response = eye_response(img,img_size,&eye,(point_t){i,j});
+                    if(response > best_response){
+                        best_response = response;
+                        best_pos = (point_t){i,j};
+                        best_h = eye.h;
+                    }
+                }
+            }
+        }
+
+    // refine around the best result, halving the step every pass
+    while (s > 1 && best_h > 0)
+        {
+            prev_s = s;
+            s = s/2;
+            point_t center = best_pos;
+            int center_h = best_h;
+            for (h = MAX(min_h,center_h-prev_s); h <= MIN(max_h-1,center_h+prev_s); h+=s)
+                {
+                    eye_t eye = make_eye(h);
+                    int r_end = MIN(MIN(max_r,rows-eye.w),center.r+prev_s+1);
+                    int c_end = MIN(MIN(max_c,cols-eye.w),center.c+prev_s+1);
+                    for (i=MAX(min_r,center.r-prev_s); i<r_end; i +=s)
+                    {
+                        for (j=MAX(min_c,center.c-prev_s); j<c_end; j+=s)
+                        {
+                            float response = eye_response(img,img_size,&eye,(point_t){i,j});
+                            if(response > best_response){
+                                best_response = response;
+                                best_pos = (point_t){i,j};
+                                best_h = eye.h;
+                            }
+                        }
+                    }
+                }
+        }
+
+    *x_pos = (int)best_pos.r;
+    *y_pos = (int)best_pos.c;
+    *width = best_h*3;
+    *response = best_response;
+    }
+
+
 void ring_filter(const float *img, const int rows, const int cols, int * x_pos,int *y_pos,int *width, float *response)
 // Algorithm based on:
 // Robust real-time pupil tracking in highly off-axis images
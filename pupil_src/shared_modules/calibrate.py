@@ -0,0 +1,477 @@
+'''
+(*)~----------------------------------------------------------------------------------
+ Pupil - eye tracking platform
+ Copyright (C) 2012-2014  Pupil Labs
+
+ Distributed under the terms of the CC BY-NC-SA License.
+ License details are in the file license.txt, distributed as part of this software.
+----------------------------------------------------------------------------------~(*)
+'''
+
+import numpy as np
+from time import time
+#logging
+import logging
+logger = logging.getLogger(__name__)
+
+
+def get_map_from_cloud(cal_pt_cloud,screen_size=(2,2),threshold=None,return_inlier_map=False):
+    """
+    robust fit of a pair of bi-variate polynomials, see fit_calibration.
+    threshold: outlier distance in pixels, None to derive it from the residuals (at least 35 pixels).
+    return the function to map vector
+    """
+    map_fn,inlier_map,report = fit_calibration(cal_pt_cloud,screen_size,threshold=threshold)
+    if return_inlier_map:
+        return map_fn,inlier_map
+    return map_fn
+
+
+def fit_calibration(cal_pt_cloud,screen_size=(2,2),models=(3,7,9),threshold=None,min_threshold=35.,folds=5,time_limit=.03):
+    """
+    calibration engine:
+    1. outliers are found with RANSAC on the 7 term model (see ransac_inliers),
+       a derived outlier threshold is never below min_threshold pixels (the old fixed threshold)
+    2. the model (number of terms, see make_model) with the lowest k-fold cross validation error
+       on the inliers is chosen, a smaller model wins when it is within 2% of the best.
+       When there are too few inliers to validate the 7 term model it is used without validation.
+    3. the chosen model is fitted to all inliers
+
+    The whole fit stays within about time_limit seconds also for large point clouds,
+    so calibrating does not stall the world window.
+    returns the map function, the inlier map and a report of the residuals (in pixels)
+    """
+    start = time()
+    cal_pt_cloud = np.asarray(cal_pt_cloud,dtype=np.float64)
+    default_n = 7
+    inlier_map,threshold = ransac_inliers(cal_pt_cloud,default_n,screen_size,threshold,min_threshold=min_threshold,time_limit=time_limit*.4)
+    inliers = cal_pt_cloud[inlier_map]
+
+    cv_rms = {}
+    for n in models:
+        # every training set needs at least twice as many points as the model has terms
+        if inliers.shape[0]*(folds-1) >= 2*n*folds:
+            cv_rms[n] = cross_validation_error(inliers,n,screen_size,folds)
+    if default_n in cv_rms:
+        # the smallest model that is (almost) as good as the best one
+        best_rms = min(cv_rms.values())
+        model_n = min([n for n in cv_rms if cv_rms[n] <= best_rms*1.02])
+    else:
+        # a smaller model validating better on a few points says little, keep the default like before
+        model_n = default_n if inliers.shape[0] >= default_n else min(models)
+        logger.warning('Not enough calibration points for cross validation, using the %s term model.'%model_n)
+
+    cx,cy,err_x,err_y = fit_poly_surface(inliers,model_n)
+    err_dist,err_mean,err_rms = fit_error_screen(err_x,err_y,screen_size)
+
+    report = {'model_n':model_n,
+            'points':cal_pt_cloud.shape[0],
+            'inliers':inliers.shape[0],
+            'threshold':threshold,
+            'rms':err_rms,
+            'mean':err_mean,
+            'median':float(np.median(err_dist)),
+            'p95':float(np.percentile(err_dist,95)),
+            'max':float(err_dist.max()),
+            'cv_rms':cv_rms,
+            'time':time()-start}
+
+    logger.info('used %i datapoints out of the full dataset %i: subset is %i percent, outlier threshold %.1f pixel' \
+        %(report['inliers'],report['points'],100*report['inliers']/float(report['points']),threshold))
+    logger.info('cross validation root-mean-square residuals per model: %s, using the %s term model' \
+        %(", ".join(["%s: %.1f"%(n,cv_rms[n]) for n in sorted(cv_rms)]),model_n))
+    logger.info('residuals in pixel: root-mean-square %.1f, mean %.1f, median %.1f, 95th percentile %.1f, max %.1f (fit took %.1fms)' \
+        %(err_rms,err_mean,report['median'],report['p95'],report['max'],report['time']*1000))
+    if err_rms > 35:
+        logger.warning('The data cannot be represented by the model in a meaningfull way.')
+
+    return make_map_function(cx,cy,model_n),inlier_map,report
+
+
+def ransac_inliers(cal_pt_cloud,n=7,screen_size=(2,2),threshold=None,min_threshold=1.,time_limit=.01,batch_size=64,max_batches=10,max_score_points=1000,seed=0):
+    """
+    find the outliers of a point cloud by fitting the n term model to random minimal samples.
+
+    All hypotheses of a batch are solved and scored at once (stacked normal equations),
+    large clouds are scored on a random subset of max_score_points.
+    Without threshold hypotheses are scored by their median residual (least median of squares)
+    and points further than 3x the median residual of the best one (about 3.5 sigma) are outliers.
+    The median residual of a fit underestimates the noise on small clouds (the fit follows the noise of its own points),
+    it is corrected by sqrt(m/(m-n)) for a fit to m points, the derived threshold is at least min_threshold pixels.
+    Stops after max_batches or time_limit seconds, whatever comes first.
+    returns the inlier map and the threshold that was used in pixels
+    """
+    rng = np.random.RandomState(seed)
+    M = make_model(cal_pt_cloud,n)
+    A,B = M[:,:n],M[:,n:n+2]
+    n_points = A.shape[0]
+    scale = np.array(screen_size,dtype=np.float64)/2.
+    if n_points > max_score_points:
+        score_idx = rng.choice(n_points,max_score_points,replace=False)
+        A_score,B_score = A[score_idx],B[score_idx]
+    else:
+        A_score,B_score = A,B
+    # tiny ridge: degenerate samples (duplicates, collinear points) stay solvable and simply score badly
+    ridge = 1e-9*np.eye(n)
+    median_idx = A_score.shape[0]//2
+
+    best_score,best_coefs = np.inf,None
+    start = time()
+    for batch in xrange(max_batches):
+        samples = rng.randint(0,n_points,(batch_size,n))
+        a,b = A[samples],B[samples]
+        coefs = np.linalg.solve(np.einsum('kij,kil->kjl',a,a)+ridge,np.einsum('kij,kil->kjl',a,b))
+        # predictions of all hypotheses in one matrix product: (points, hypotheses, 2)
+        err = (np.dot(A_score,coefs.transpose(1,0,2).reshape(n,-1)).reshape(-1,batch_size,2)-B_score[:,np.newaxis])*scale
+        dist_sq = (err*err).sum(axis=2)
+        if threshold is None:
+            scores = np.partition(dist_sq,median_idx,axis=0)[median_idx]
+        else:
+            scores = -(dist_sq <= threshold*threshold).sum(axis=0)
+        best = scores.argmin()
+        if scores[best] < best_score:
+            best_score,best_coefs = scores[best],coefs[best]
+        if time()-start > time_limit:
+            break
+
+    def residuals(coefs):
+        err = (np.dot(A,coefs)-B)*scale
+        return np.sqrt((err*err).sum(axis=1))
+
+    def derived_threshold(err_dist,m):
+        correction = np.sqrt(m/float(m-n)) if m > n else 2.
+        return max(3*float(np.median(err_dist))*correction,min_threshold)
+
+    err_dist = residuals(best_coefs)
+    derive_threshold = threshold is None
+    if derive_threshold:
+        # the n points of the minimal sample have no residual at all
+        threshold = derived_threshold(err_dist,n_points)
+    inlier_map = err_dist <= threshold
+    m = inlier_map.sum()
+    if m >= n:
+        # the best minimal sample also fits its own noise: refit to its inliers once and classify again
+        err_dist = residuals(np.linalg.lstsq(A[inlier_map],B[inlier_map])[0])
+        if derive_threshold:
+            threshold = derived_threshold(err_dist,m)
+        inlier_map = err_dist <= threshold
+    if inlier_map.sum() < n:
+        logger.warning('RANSAC did not find a consistent subset, using all calibration points.')
+        inlier_map[:] = True
+    return inlier_map,threshold
+
+
+def cross_validation_error(cal_pt_cloud,n=7,screen_size=(2,2),folds=5,max_points=2000,seed=0):
+    """
+    k-fold cross validation of the n term model: root-mean-square residual in pixels
+    of every point predicted by the model fitted to the other folds.
+    Large clouds are validated on a random subset of max_points.
+    """
+    if cal_pt_cloud.shape[0] > max_points:
+        cal_pt_cloud = cal_pt_cloud[np.random.RandomState(seed).choice(cal_pt_cloud.shape[0],max_points,replace=False)]
+    M = make_model(cal_pt_cloud,n)
+    fold_of_point = np.random.RandomState(seed).permutation(M.shape[0]) % folds
+    scale = np.array(screen_size,dtype=np.float64)/2.
+    sq_err = 0.
+    for fold in xrange(folds):
+        test = fold_of_point == fold
+        coefs = np.linalg.lstsq(M[~test,:n],M[~test,n:n+2])[0]
+        err = (np.dot(M[test,:n],coefs)-M[test,n:n+2])*scale
+        sq_err += (err*err).sum()
+    return np.sqrt(sq_err/M.shape[0])
+
+
+def fit_poly_surface(cal_pt_cloud,n=7):
+    M = make_model(cal_pt_cloud,n)
+    coefs = np.linalg.lstsq(M[:,:n],M[:,n:n+2])[0]
+    cx = coefs[:,0]
+    cy = coefs[:,1]
+    # compute model error in world screen units if screen_res specified
+    err_x=(np.dot(M[:,:n],cx)-M[:,n])
+    err_y=(np.dot(M[:,:n],cy)-M[:,n+1])
+    return cx,cy,err_x,err_y
+
+def fit_error_screen(err_x,err_y,(screen_x,screen_y)):
+    err_x *= screen_x/2.
+    err_y *= screen_y/2.
+    err_dist=np.sqrt(err_x*err_x + err_y*err_y)
+    err_mean=np.sum(err_dist)/len(err_dist)
+    err_rms=np.sqrt(np.sum(err_dist*err_dist)/len(err_dist))
+    return err_dist,err_mean,err_rms
+
+def make_model(cal_pt_cloud,n=7):
+    n_points = cal_pt_cloud.shape[0]
+
+    if n==3:
+        X=cal_pt_cloud[:,0]
+        Y=cal_pt_cloud[:,1]
+        Ones=np.ones(n_points)
+        ZX=cal_pt_cloud[:,2]
+        ZY=cal_pt_cloud[:,3]
+        M=np.array([X,Y,Ones,ZX,ZY]).transpose()
+
+    elif n==7:
+        X=cal_pt_cloud[:,0]
+        Y=cal_pt_cloud[:,1]
+        XX=X*X
+        YY=Y*Y
+        XY=X*Y
+        XXYY=XX*YY
+        Ones=np.ones(n_points)
+        ZX=cal_pt_cloud[:,2]
+        ZY=cal_pt_cloud[:,3]
+        M=np.array([X,Y,XX,YY,XY,XXYY,Ones,ZX,ZY]).transpose()
+
+    elif n==9:
+        X=cal_pt_cloud[:,0]
+        Y=cal_pt_cloud[:,1]
+        XX=X*X
+        YY=Y*Y
+        XY=X*Y
+        XXYY=XX*YY
+        XXY=XX*Y
+        YYX=YY*X
+        Ones=np.ones(n_points)
+        ZX=cal_pt_cloud[:,2]
+        ZY=cal_pt_cloud[:,3]
+        M=np.array([X,Y,XX,YY,XY,XXYY,XXY,YYX,Ones,ZX,ZY]).transpose()
+    else:
+        raise Exception("ERROR: Model n needs to be 3, 7 or 9")
+    return M
+
+
+def make_map_function(cx,cy,n):
+    """
+    return fn((X,Y)) -> (x2,y2) evaluating the fitted polynomials.
+    X and Y can be scalars or numpy arrays of any shape, each term is computed once per call.
+    use map_batch() / map_pupil_records() to map many pupil positions in one call.
+    """
+    if n==3:
+        def fn((X,Y)):
+            x2 = cx[0]*X + cx[1]*Y +cx[2]
+            y2 = cy[0]*X + cy[1]*Y +cy[2]
+            return x2,y2
+
+    elif n==7:
+        def fn((X,Y)):
+            XX = X*X
+            YY = Y*Y
+            XY = X*Y
+            XXYY = XX*YY
+            x2 = cx[0]*X + cx[1]*Y + cx[2]*XX + cx[3]*YY + cx[4]*XY + cx[5]*XXYY +cx[6]
+            y2 = cy[0]*X + cy[1]*Y + cy[2]*XX + cy[3]*YY + cy[4]*XY + cy[5]*XXYY +cy[6]
+            return x2,y2
+
+    elif n==9:
+        def fn((X,Y)):
+            XX = X*X
+            YY = Y*Y
+            XY = X*Y
+            XXYY = XX*YY
+            XXY = XX*Y
+            YYX = YY*X
+            #          X         Y         XX         YY         XY         XXYY         XXY         YYX         Ones
+            x2 = cx[0]*X + cx[1]*Y + cx[2]*XX + cx[3]*YY + cx[4]*XY + cx[5]*XXYY + cx[6]*XXY + cx[7]*YYX + cx[8]
+            y2 = cy[0]*X + cy[1]*Y + cy[2]*XX + cy[3]*YY + cy[4]*XY + cy[5]*XXYY + cy[6]*XXY + cy[7]*YYX + cy[8]
+            return x2,y2
+    else:
+        raise Exception("ERROR: Model n needs to be 3, 7 or 9")
+
+    return fn
+
+
+def map_batch(map_fn,norm_pupil):
+    """
+    map a (n,2) array of pupil positions in one polynomial evaluation, returns a (n,2) array.
+    Rows of not detected pupils (nan) stay nan.
+    """
+    norm_pupil = np.asarray(norm_pupil,dtype=np.float64).reshape(-1,2)
+    return np.column_stack(map_fn((norm_pupil[:,0],norm_pupil[:,1])))
+
+
+def map_pupil_records(map_fn,records):
+    """
+    set norm_gaze of pupil_dtype records (ring buffer batch or offline pupil_positions.npy) in place.
+    """
+    if records.shape[0]:
+        records['norm_gaze'] = map_batch(map_fn,records['norm_pupil'])
+    return records
+
+
+def map_gaze_positions(map_fn,gaze_positions):
+    """
+    remap a recording: returns a copy of gaze_positions.npy data
+    (norm_gaze x,y, norm_pupil x,y, timestamp, confidence per row)
+    with norm_gaze computed from norm_pupil with map_fn.
+    """
+    gaze_positions = np.array(gaze_positions,dtype=np.float64)
+    if gaze_positions.shape[0]:
+        gaze_positions[:,0:2] = map_batch(map_fn,gaze_positions[:,2:4])
+    return gaze_positions
+
+
+def correlate_data(pupil_ts,norm_pupil,ref_ts,ref_norm_pos,max_dt=1/15.):
+    '''
+    pair pupil samples with reference positions by timestamp, all inputs are arrays sorted by time.
+
+    A pupil sample belongs to the reference sample whose midpoints to the previous and next
+    reference sample enclose its timestamp, it is only used if it is within max_dt of it (30fps + slack).
+    The last reference sample has no next one and gets no pupil samples (like before).
+    returns cal_pt_cloud: (n,4) array of pupil x | pupil y | ref x | ref y
+    '''
+    pupil_ts = np.asarray(pupil_ts,dtype=np.float64)
+    ref_ts = np.asarray(ref_ts,dtype=np.float64)
+    if ref_ts.shape[0] <= 2 or pupil_ts.shape[0] == 0:
+        return np.zeros((0,4))
+    norm_pupil = np.asarray(norm_pupil,dtype=np.float64).reshape(-1,2)
+    ref_norm_pos = np.asarray(ref_norm_pos,dtype=np.float64).reshape(-1,2)
+
+    midpoints = (ref_ts[:-1]+ref_ts[1:])/2.
+    ref_idx = np.searchsorted(midpoints,pupil_ts,side='left')
+    pupil_idx = np.flatnonzero(ref_idx < midpoints.shape[0])
+    ref_idx = ref_idx[pupil_idx]
+    close = np.abs(pupil_ts[pupil_idx]-ref_ts[ref_idx]) <= max_dt
+    return np.column_stack((norm_pupil[pupil_idx[close]],ref_norm_pos[ref_idx[close]]))
+
+
+def make_cal_pt_cloud(pupil_pts,ref_pts):
+    '''
+    cal_pt_cloud array from the lists the calibration plugins collect:
+    pupil_pts with "timestamp" and "norm_pupil", ref_pts with "timestamp" and "norm_pos".
+    see correlate_data
+    '''
+    if len(ref_pts)<=2 or not pupil_pts:
+        return np.zeros((0,4))
+    pupil_ts = np.array([p['timestamp'] for p in pupil_pts])
+    norm_pupil = np.array([p['norm_pupil'] for p in pupil_pts])
+    ref_ts = np.array([r['timestamp'] for r in ref_pts])
+    ref_norm_pos = np.array([r['norm_pos'] for r in ref_pts])
+    return correlate_data(pupil_ts,norm_pupil,ref_ts,ref_norm_pos)
+
+
+def preprocess_data(pupil_pts,ref_pts):
+    '''small utility function to deal with timestamped but uncorrelated data
+    input must be lists that contain dicts with at least "timestamp" and "norm_pos"
+    returns a list of (pupil x, pupil y, ref x, ref y) tuples, use make_cal_pt_cloud for the array.
+    '''
+    return [tuple(pt) for pt in make_cal_pt_cloud(pupil_pts,ref_pts)]
+
+def synthetic_cloud(n_points,noise=5.,screen_size=(1280,720),seed=0):
+    """
+    clean calibration point cloud: a smooth pupil to gaze mapping plus gaussian noise of noise pixels per axis.
+    """
+    rng = np.random.RandomState(seed)
+    X = rng.uniform(-.6,.6,n_points)
+    Y = rng.uniform(-.5,.5,n_points)
+    ZX = 1.3*X + .1*Y + .2*X*X - .1*Y*Y + .05*X*Y + .1
+    ZY = .2*X + 1.4*Y + .1*X*X + .15*Y*Y - .1*X*X*Y - .05
+    ZX += rng.normal(0,noise,n_points)/(screen_size[0]/2.)
+    ZY += rng.normal(0,noise,n_points)/(screen_size[1]/2.)
+    return np.column_stack((X,Y,ZX,ZY))
+
+
+def check_clean_clouds(sizes=(12,18,25,30,100,1000),noise=5.,screen_size=(1280,720),trials=20,max_dropped=.05):
+    """
+    fit_calibration must keep (nearly) all points of clean clouds, also small ones.
+    returns {size:(mean fraction of points dropped, mean rms in pixels)} and the sizes that failed
+    """
+    results = {}
+    failed = []
+    for n_points in sizes:
+        dropped,rms = [],[]
+        for seed in range(trials):
+            map_fn,inlier_map,report = fit_calibration(synthetic_cloud(n_points,noise,screen_size,seed),screen_size)
+            dropped.append(1-report['inliers']/float(n_points))
+            rms.append(report['rms'])
+        results[n_points] = float(np.mean(dropped)),float(np.mean(rms))
+        # 5 pixel noise per axis is about 7 pixel rms distance, a model that does not fit shows up far above that
+        if results[n_points][0] > max_dropped or results[n_points][1] > 2.*noise*np.sqrt(2):
+            failed.append(n_points)
+    return results,failed
+
+
+if __name__ == '__main__':
+    import sys
+    logging.basicConfig(level=logging.ERROR)
+    results,failed = check_clean_clouds()
+    for n_points in sorted(results):
+        print "%5i points: %4.1f%% dropped, rms %.1f pixel"%(n_points,results[n_points][0]*100,results[n_points][1])
+    if failed:
+        print "clean clouds of %s points lose too many points or fit badly"%failed
+        sys.exit(1)
+
+# if __name__ == '__main__':
+#     import matplotlib.pyplot as plt
+#     from matplotlib import cm
+#     from mpl_toolkits.mplot3d import Axes3D
+
+#     cal_pt_cloud = np.load('cal_pt_cloud.npy')
+#     # plot input data
+#     # Z = cal_pt_cloud
+#     # ax.scatter(Z[:,0],Z[:,1],Z[:,2], c= "r")
+#     # ax.scatter(Z[:,0],Z[:,1],Z[:,3], c= "b")
+
+#     # fit once
+#     model_n = 7
+#     cx,cy,err_x,err_y = fit_poly_surface(cal_pt_cloud,model_n)
+#     map_fn = make_map_function(cx,cy,model_n)
+#     err_dist,err_mean,err_rms = fit_error_screen(err_x,err_y,(1280,720))
+#     print err_rms,"in pixel"
+#     threshold =15 # err_rms*2
+
+#     # fit again disregarding crass outlines
+#     cx,cy,new_err_x,new_err_y = fit_poly_surface(cal_pt_cloud[err_dist<=threshold],model_n)
+#     map_fn = make_map_function(cx,cy,model_n)
+#     new_err_dist,new_err_mean,new_err_rms = fit_error_screen(new_err_x,new_err_y,(1280,720))
+#     print new_err_rms,"in pixel"
+
+#     print "using %i datapoints out of the full dataset %i: subset is %i percent" \
+#         %(cal_pt_cloud[err_dist<=threshold].shape[0], cal_pt_cloud.shape[0], \
+#         100*float(cal_pt_cloud[err_dist<=threshold].shape[0])/cal_pt_cloud.shape[0])
+
+#     # plot residuals
+#     fig_error = plt.figure()
+#     plt.scatter(err_x,err_y,c="y")
+#     plt.scatter(new_err_x,new_err_y)
+#     plt.title("fitting residuals full data set (y) and better subset (b)")
+
+
+#     # plot projection of eye and world vs observed data
+#     X,Y,ZX,ZY = cal_pt_cloud.transpose().copy()
+#     X,Y = map_fn((X,Y))
+#     X *= 1280/2.
+#     Y *= 720/2.
+#     ZX *= 1280/2.
+#     ZY *= 720/2.
+#     fig_projection = plt.figure()
+#     plt.scatter(X,Y)
+#     plt.scatter(ZX,ZY,c='y')
+#     plt.title("world space projection in pixes, mapped and observed (y)")
+
+#     # plot the fitting functions 3D plot
+#     fig = plt.figure()
+#     ax = fig.gca(projection='3d')
+#     outliers =cal_pt_cloud[err_dist>threshold]
+#     inliers = cal_pt_cloud[err_dist<=threshold]
+#     ax.scatter(outliers[:,0],outliers[:,1],outliers[:,2], c= "y")
+#     ax.scatter(outliers[:,0],outliers[:,1],outliers[:,3], c= "y")
+#     ax.scatter(inliers[:,0],inliers[:,1],inliers[:,2], c= "r")
+#     ax.scatter(inliers[:,0],inliers[:,1],inliers[:,3], c= "b")
+#     Z = cal_pt_cloud
+#     X = np.linspace(min(Z[:,0])-.2,max(Z[:,0])+.2,num=30,endpoint=True)
+#     Y = np.linspace(min(Z[:,1])-.2,max(Z[:,1]+.2),num=30,endpoint=True)
+#     X, Y = np.meshgrid(X,Y)
+#     ZX,ZY = map_fn((X,Y))
+#     ax.plot_surface(X, Y, ZX, rstride=1, cstride=1, linewidth=.1, antialiased=True,alpha=0.4,color='r')
+#     ax.plot_surface(X, Y, ZY, rstride=1, cstride=1, linewidth=.1, antialiased=True,alpha=0.4,color='b')
+#     plt.xlabel("Pupil x in Eye-Space")
+#     plt.ylabel("Pupil y Eye-Space")
+#     plt.title("Z: Gaze x (blue) Gaze y (red) World-Space, yellow=outliers")
+
+#     # X,Y,_,_ = cal_pt_cloud.transpose()
+
+#     # pts= map_fn((X,Y))
+#     # import cv2
+#     # pts = np.array(pts,dtype=np.float32).transpose()
+#     # print cv2.convexHull(pts)[:,0]
+#     plt.show()
@@ -0,0 +1,57 @@
+'''
+(*)~----------------------------------------------------------------------------------
+ Pupil - eye tracking platform
+ Copyright (C) 2012-2014  Pupil Labs
+
+ Distributed under the terms of the CC BY-NC-SA License.
+ License details are in the file license.txt, distributed as part of this software.
+----------------------------------------------------------------------------------~(*)
+'''
+
+from threading import Condition
+#logging
+import logging
+logger = logging.getLogger(__name__)
+
+
+class Latest_Frame_Slot(object):
+    """
+    hands the newest item from a producer thread to a consumer thread.
+
+    The slot holds at most one item: put() never blocks and replaces an item
+    that was not taken yet (counted in skipped), so a slow consumer
+    always works on the most recent frame and never makes the producer wait.
+    get() returns None when the slot is closed (or on timeout).
+    """
+    def __init__(self):
+        super(Latest_Frame_Slot, self).__init__()
+        self._cond = Condition()
+        self._item = None
+        self._closed = False
+        self.skipped = 0
+
+    def put(self,item):
+        with self._cond:
+            if self._item is not None:
+                self.skipped += 1
+            self._item = item
+            self._cond.notify()
+
+    def get(self,block=True,timeout=None):
+        with self._cond:
+            if block:
+                while self._item is None and not self._closed:
+                    self._cond.wait(timeout)
+                    if timeout is not None:
+                        break
+            item,self._item = self._item,None
+            return item
+
+    @property
+    def closed(self):
+        return self._closed
+
+    def close(self):
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
@@ -9,10 +9,8 @@
 '''
 
 import numpy as np
-try:
-    import numexpr as ne
-except:
-    ne = None
+from collections import deque
+from time import time
 import cv2
 import logging
 logger = logging.getLogger(__name__)
@@ -90,9 +88,42 @@ class Roi(object):
 
 
 
-def bin_thresholding(image, image_lower=0, image_upper=256):
+class Buffer_Pool(object):
+    """
+    reusable scratch images for per frame processing.
+
+    get(name,shape) returns an array of that shape to be used as dst= of OpenCV functions.
+    Each name is backed by one buffer that only grows (to the largest roi seen),
+    smaller shapes are views into it, so changing roi sizes do not cause allocations.
+    With enabled=False every get allocates a new array, like the code did without a pool.
+    """
+    def __init__(self,enabled=True):
+        super(Buffer_Pool, self).__init__()
+        self.enabled = enabled
+        self._buffers = {}
+
+    def get(self,name,shape,dtype=np.uint8):
+        shape = tuple(shape)
+        buf = self._buffers.get(name) if self.enabled else None
+        if buf is None or buf.dtype != dtype or buf.ndim != len(shape) or any(b < s for b,s in zip(buf.shape,shape)):
+            if buf is not None and buf.dtype == dtype and buf.ndim == len(shape):
+                shape_to_alloc = tuple(max(b,s) for b,s in zip(buf.shape,shape))
+            else:
+                shape_to_alloc = shape
+            buf = np.empty(shape_to_alloc,dtype=dtype)
+            if self.enabled:
+                self._buffers[name] = buf
+        return buf[tuple(slice(0,s) for s in shape)]
+
+    def zeros(self,name,shape,dtype=np.uint8):
+        buf = self.get(name,shape,dtype)
+        buf.fill(0)
+        return buf
+
+
+def bin_thresholding(image, image_lower=0, image_upper=256, dst=None):
     binary_img = cv2.inRange(image, np.asarray(image_lower),
-                np.asarray(image_upper))
+                np.asarray(image_upper), dst)
 
     return binary_img
 
@@ -374,6 +405,76 @@ def points_at_corner_index(contour,index):
     return [contour[i+1] for i in index]
 
 
+def concatenate_polylines(polylines):
+    """
+    stack a list of polylines (each shape=(n,1,2)) into one point array.
+    returns points (N,1,2), starts and lengths of the polylines in points.
+    """
+    lengths = np.array([p.shape[0] for p in polylines],dtype=np.intp)
+    starts = np.zeros(lengths.shape[0],dtype=np.intp)
+    starts[1:] = np.cumsum(lengths)[:-1]
+    if polylines:
+        points = np.concatenate(polylines)
+    else:
+        points = np.zeros((0,1,2),dtype=np.int32)
+    return points,starts,lengths
+
+
+def GetAnglesPolylines(points,starts,lengths):
+    """
+    batched GetAnglesPolyline over concatenated open polylines (see concatenate_polylines).
+    returns one signed angle in degrees per point, nan for the first and last point of every polyline.
+    """
+    p = points[:,0]
+    curvature = np.empty(p.shape[0])
+    curvature.fill(np.nan)
+    if p.shape[0] < 3:
+        return curvature
+    ab = p[1:-1]-p[:-2]
+    cb = p[1:-1]-p[2:]
+    dot = np.sum(ab * cb, axis=1)
+    cros = np.cross(ab,cb)
+    curvature[1:-1] = np.arctan2(cros,dot)*(180./np.pi)
+    # angles across polyline borders are not defined
+    ends = starts+lengths
+    curvature[starts[lengths>0]] = np.nan
+    curvature[ends[lengths>0]-1] = np.nan
+    return curvature
+
+
+def split_polylines_at_kinks(polylines,angle):
+    """
+    batched version of:
+        for c in polylines:
+            split_at_corner_index(c,find_kink_and_dir_change(GetAnglesPolyline(c),angle))
+    all polylines are processed as one concatenated point array.
+    returns points (N,1,2) and the start and end (excluded) index of every segment in points.
+    Like split_at_corner_index consecutive segments of a polyline share their border point.
+    """
+    points,starts,lengths = concatenate_polylines(polylines)
+    curvature = GetAnglesPolylines(points,starts,lengths)
+    valid = curvature == curvature #not nan
+    is_pos = curvature > 0
+    kink = valid & (np.abs(curvature) < angle)
+    # the sign of the curvature flipped with respect to the previous angle of the same polyline
+    dir_change = np.zeros(valid.shape,dtype=bool)
+    dir_change[1:] = valid[1:] & valid[:-1] & (is_pos[1:] != is_pos[:-1])
+    splits = np.flatnonzero(kink | dir_change)
+
+    polyline_starts = starts[lengths>0]
+    polyline_ends = (starts+lengths)[lengths>0]
+    seg_starts = np.concatenate((polyline_starts,splits))
+    order = np.argsort(seg_starts,kind='mergesort')
+    seg_starts = seg_starts[order]
+    # polylines are in order, so the owner of every segment start follows from the polyline starts
+    owner = np.searchsorted(polyline_starts,seg_starts,side='right')-1
+    seg_ends = polyline_ends[owner]
+    # a segment ends on the next split of the same polyline (inclusive)
+    same_polyline = owner[1:] == owner[:-1]
+    seg_ends[:-1][same_polyline] = seg_starts[1:][same_polyline]+1
+    return points,seg_starts,seg_ends
+
+
 def split_at_corner_index(contour,index):
     """
     contour is array([[[108, 290]],[[111, 290]]], dtype=int32) shape=(number of points,1,dimension(2) )
@@ -473,62 +574,57 @@ def denormalize(pos, (width, height), flip_y=False):
 
 
 
-def dist_pts_ellipse(((ex,ey),(dx,dy),angle),points):
+def dist_pts_ellipses(ellipses,points,threshold=None):
+    """
+    unsigned euclidian distances of points to a batch of ellipses.
+    ellipses: list of ((cx,cy),(width,height),angle) like cv2.fitEllipse returns them
+    points: array of shape (n,2) or (n,1,2)
+    returns distances with shape (len(ellipses),n)
+    and, if threshold is given, the inlier mask distances <= threshold as second result.
+
+    The distance is taken along the ray from the ellipse center through the point: |r - r/m|
+    with r the distance of the point to the center and m the same distance in the space where the ellipse is the unit circle.
+    Only m needs the rotated coordinates, they are computed once. All arithmetic is done in place.
+    """
+    pts = np.asarray(points,dtype=np.float64).reshape(-1,2)
+    params = np.array([(cx,cy,w/2.,h/2.,a) for (cx,cy),(w,h),a in ellipses],dtype=np.float64).reshape(-1,5)
+    cx,cy,rx,ry,angle = [params[:,i:i+1] for i in range(5)]
+    angle = angle*(np.pi/180.)
+    cos,sin = np.cos(angle),np.sin(angle)
+
+    dx = pts[:,0] - cx
+    dy = pts[:,1] - cy
+    # rotate so that ellipse axis align with coordinate system and normalize such that ellipse radii=1
+    u = dx*cos
+    u += dy*sin
+    u /= rx
+    v = dy*cos
+    v -= dx*sin
+    v /= ry
+    # m: distance in normalized space
+    u *= u
+    v *= v
+    u += v
+    np.sqrt(u,u)
+    # r: distance in image space
+    dx *= dx
+    dy *= dy
+    dx += dy
+    np.sqrt(dx,dx)
+    # |r - r/m|
+    np.divide(dx,u,u)
+    dx -= u
+    distances = np.abs(dx,dx)
+    if threshold is None:
+        return distances
+    return distances, distances <= threshold
+
+
+def dist_pts_ellipse(ellipse,points):
     """
     return unsigned euclidian distances of points to ellipse
     """
-    pts = np.float64(points)
-    rx,ry = dx/2., dy/2.
-    angle = (angle/180.)*np.pi
-    # ex,ey =ex+0.000000001,ey-0.000000001 #hack to make 0 divisions possible this is UGLY!!!
-    pts = pts - np.array((ex,ey)) # move pts to ellipse appears at origin , with this we copy data -deliberatly!
-
-    M_rot = np.mat([[np.cos(angle),-np.sin(angle)],[np.sin(angle),np.cos(angle)]])
-    pts = np.array(pts*M_rot) #rotate so that ellipse axis align with coordinate system
-    # print "rotated",pts
-
-    pts /= np.array((rx,ry)) #normalize such that ellipse radii=1
-    # print "normalize",norm_pts
-    norm_mag = np.sqrt((pts*pts).sum(axis=1))
-    norm_dist = abs(norm_mag-1) #distance of pt to ellipse in scaled space
-    # print 'norm_mag',norm_mag
-    # print 'norm_dist',norm_dist
-    ratio = (norm_dist)/norm_mag #scale factor to make the pts represent their dist to ellipse
-    # print 'ratio',ratio
-    scaled_error = np.transpose(pts.T*ratio) # per vector scalar multiplication: makeing sure that boradcasting is done right
-    # print "scaled error points", scaled_error
-    real_error = scaled_error*np.array((rx,ry))
-    # print "real point",real_error
-    error_mag = np.sqrt((real_error*real_error).sum(axis=1))
-    # print 'real_error',error_mag
-    # print 'result:',error_mag
-    return error_mag
-
-
-if ne:
-    def dist_pts_ellipse(((ex,ey),(dx,dy),angle),points):
-        """
-        return unsigned euclidian distances of points to ellipse
-        same as above but uses numexpr for 2x speedup
-        """
-        pts = np.float64(points)
-        pts.shape=(-1,2)
-        rx,ry = dx/2., dy/2.
-        angle = (angle/180.)*np.pi
-        # ex,ey = ex+0.000000001 , ey-0.000000001 #hack to make 0 divisions possible this is UGLY!!!
-        x = pts[:,0]
-        y = pts[:,1]
-        # px = '((x-ex) * cos(angle) + (y-ey) * sin(angle))/rx'
-        # py = '(-(x-ex) * sin(angle) + (y-ey) * cos(angle))/ry'
-        # norm_mag = 'sqrt(('+px+')**2+('+py+')**2)'
-        # norm_dist = 'abs('+norm_mag+'-1)'
-        # ratio = norm_dist + "/" + norm_mag
-        # x_err  = ''+px+'*'+ratio+'*rx'
-        # y_err =  ''+py+'*'+ratio+'*ry'
-        # term = 'sqrt(('+x_err+')**2 + ('+y_err+')**2 )'
-        term = 'sqrt((((x-ex) * cos(angle) + (y-ey) * sin(angle))/rx*abs(sqrt((((x-ex) * cos(angle) + (y-ey) * sin(angle))/rx)**2+((-(x-ex) * sin(angle) + (y-ey) * cos(angle))/ry)**2)-1)/sqrt((((x-ex) * cos(angle) + (y-ey) * sin(angle))/rx)**2+((-(x-ex) * sin(angle) + (y-ey) * cos(angle))/ry)**2)*rx)**2 + ((-(x-ex) * sin(angle) + (y-ey) * cos(angle))/ry*abs(sqrt((((x-ex) * cos(angle) + (y-ey) * sin(angle))/rx)**2+((-(x-ex) * sin(angle) + (y-ey) * cos(angle))/ry)**2)-1)/sqrt((((x-ex) * cos(angle) + (y-ey) * sin(angle))/rx)**2+((-(x-ex) * sin(angle) + (y-ey) * cos(angle))/ry)**2)*ry)**2 )'
-        error_mag = ne.evaluate(term)
-        return error_mag
+    return dist_pts_ellipses((ellipse,),points)[0]
 
 
 
@@ -544,7 +640,34 @@ def metric(l):
 
 
 
-def pruning_quick_combine(l,fn,seed_idx=None,max_evals=1e20,max_depth=5):
+class Prune_Trie(object):
+    """
+    set of failed combinations (increasing tuples of positions) stored as a trie.
+    has_subset_of(path) tells if any stored combination is a subset of path without testing them one by one.
+    """
+    def __init__(self):
+        self.root = {}
+
+    def add(self,path):
+        node = self.root
+        for i in path:
+            node = node.setdefault(i,{})
+        node[None] = True
+
+    def has_subset_of(self,path):
+        return self._search(self.root,path,0)
+
+    def _search(self,node,path,start):
+        if None in node:
+            return True
+        for k in xrange(start,len(path)):
+            child = node.get(path[k])
+            if child is not None and self._search(child,path,k+1):
+                return True
+        return False
+
+
+def pruning_quick_combine(l,fn,seed_idx=None,max_evals=1e20,max_depth=5,time_budget=None,extend=None,states=None):
     """
     l is a list of object to quick_combine.
     the evaluation fn should accept idecies to your list and the list
@@ -560,7 +683,19 @@ def pruning_quick_combine(l,fn,seed_idx=None,max_evals=1e20,max_depth=5):
     it needs more evaluations than finding strongly connected components in a graph because:
     (1,5) and (1,6) and (5,6) may work but (1,5,6) may not pass evaluation, (n,m) being list idx's
 
+    The search is breadth first, failed combinations are kept in a Prune_Trie.
+
+    incremental evaluation:
+    if extend is given fn is called with a state instead of the list of items.
+    The state of a combination is extend(state_of_parent,item) (state_of_parent is None for single items).
+    Each combination only adds one item to the memoized state of the combination it grew from,
+    how much work that saves depends on what extend can reuse from the parent state.
+    If states is a dict the state of every result is stored in it with tuple(result) as key.
+
+    time_budget: stop the search after this many seconds, None for no limit.
     """
+    if time_budget is not None:
+        deadline = time() + time_budget
     if seed_idx:
         non_seed_idx = [i for i in range(len(l)) if i not in seed_idx]
     else:
@@ -568,33 +703,40 @@ def pruning_quick_combine(l,fn,seed_idx=None,max_evals=1e20,max_depth=5):
         seed_idx = range(len(l))
         non_seed_idx = []
     mapping =  seed_idx+non_seed_idx
-    unknown = [[node] for node in range(len(seed_idx))]
-    # print mapping
+    n = len(mapping)
+    # entries: (path as tuple of increasing positions in mapping, state of the parent combination)
+    unknown = deque(((node,),None) for node in range(len(seed_idx)))
     results = []
-    prune = []
+    prune = Prune_Trie()
     while unknown and max_evals:
-        path = unknown.pop(0)
+        if time_budget is not None and time() > deadline:
+            break
+        path,parent_state = unknown.popleft()
         max_evals -= 1
-        # print '@idx',[mapping[i] for i in path]
-        # print '@content',path
         if not len(path) > max_depth:
             # is this combination even viable, or did a subset fail already?
-            if not any(m.issubset(set(path)) for m in prune):
+            if not prune.has_subset_of(path):
                 #we have not tested this and a subset of this was sucessfull before
-                if fn([l[mapping[i]] for i in path]):
+                if extend is None:
+                    state = None
+                    good = fn([l[mapping[i]] for i in path])
+                else:
+                    state = extend(parent_state,l[mapping[path[-1]]])
+                    good = fn(state)
+                if good:
                     # yes this was good, keep as solution
-                    results.append([mapping[i] for i in path])
+                    result = [mapping[i] for i in path]
+                    results.append(result)
+                    if states is not None:
+                        states[tuple(result)] = state
                     # lets explore more by creating paths to each remaining node
-                    decedents = [path+[i] for i in range(path[-1]+1,len(mapping)) ]
-                    unknown.extend(decedents)
+                    unknown.extend((path+(i,),state) for i in xrange(path[-1]+1,n))
                 else:
-                    # print "pruning",path
-                    prune.append(set(path))
+                    prune.add(path)
     return results
 
 
 
-
 # def is_subset(needle,haystack):
 #     """ Check if needle is ordered subset of haystack in O(n)
 #     taken from:
@@ -624,7 +766,26 @@ def pruning_quick_combine(l,fn,seed_idx=None,max_evals=1e20,max_depth=5):
 #             yield needle
 
 def filter_subsets(l):
-    return [m for i, m in enumerate(l) if not any(set(m).issubset(set(n)) for n in (l[:i] + l[i+1:]))]
+    """
+    remove every list of indices that is a subset of another list in l.
+    subsets are tested on bitmasks and only against lists that have more elements.
+    """
+    masks = [sum(1<<i for i in set(m)) for m in l]
+    sizes = [len(set(m)) for m in l]
+    order = sorted(range(len(l)),key=lambda i: -sizes[i])
+    keep = []
+    for i,m in enumerate(l):
+        mask = masks[i]
+        is_subset = False
+        for j in order:
+            if sizes[j] < sizes[i]:
+                break
+            if j != i and masks[j] & mask == mask:
+                is_subset = True
+                break
+        if not is_subset:
+            keep.append(m)
+    return keep
 
 
 
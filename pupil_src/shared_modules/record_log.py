@@ -0,0 +1,134 @@
+'''
+(*)~----------------------------------------------------------------------------------
+ Pupil - eye tracking platform
+ Copyright (C) 2012-2014  Pupil Labs
+
+ Distributed under the terms of the CC BY-NC-SA License.
+ License details are in the file license.txt, distributed as part of this software.
+----------------------------------------------------------------------------------~(*)
+'''
+
+"""
+Append-only on-disk log of fixed size float64 records.
+
+Used during recording instead of growing python lists:
+records are buffered in a small chunk, appended to the file when the chunk is full
+and the file is fsync'ed periodically. A crash loses at most one chunk.
+When the recording stops the log is turned into the usual .npy file.
+
+File layout:
+    16 byte header: 'PUPILLOG' | uint32 n_columns | uint32 reserved
+    followed by n_columns float64 per record (native byte order)
+"""
+
+import os
+import struct
+from time import time
+import numpy as np
+#logging
+import logging
+logger = logging.getLogger(__name__)
+
+header_magic = 'PUPILLOG'
+header_size = 16
+
+
+class Record_Log(object):
+    """
+    append-only log of records with n_columns float64 values each.
+    append() takes a sequence of n_columns numbers (or a single number if n_columns is 1).
+    """
+    def __init__(self, path, n_columns, chunk_size=120, fsync_interval=2.):
+        super(Record_Log, self).__init__()
+        self.path = path
+        self.n_columns = n_columns
+        self.chunk_size = chunk_size
+        self.fsync_interval = fsync_interval
+
+        self._chunk = np.empty((chunk_size,n_columns),dtype=np.float64)
+        self._chunk_len = 0
+        self._written = 0
+        self._last_sync = time()
+
+        self._file = open(path,'wb')
+        self._file.write(struct.pack('8sII',header_magic,n_columns,0))
+        self._sync()
+
+    def __len__(self):
+        return self._written + self._chunk_len
+
+    def append(self,record):
+        self._chunk[self._chunk_len] = record
+        self._chunk_len += 1
+        if self._chunk_len == self.chunk_size:
+            self.flush()
+
+    def extend(self,records):
+        """
+        append a (n,n_columns) array of records
+        """
+        records = np.asarray(records,dtype=np.float64).reshape(-1,self.n_columns)
+        done = 0
+        while done < records.shape[0]:
+            n = min(self.chunk_size-self._chunk_len,records.shape[0]-done)
+            self._chunk[self._chunk_len:self._chunk_len+n] = records[done:done+n]
+            self._chunk_len += n
+            done += n
+            if self._chunk_len == self.chunk_size:
+                self.flush()
+
+    def flush(self):
+        """
+        append the buffered chunk to the file, fsync if the last sync is older than fsync_interval.
+        """
+        if self._chunk_len:
+            self._file.write(self._chunk[:self._chunk_len].tostring())
+            self._written += self._chunk_len
+            self._chunk_len = 0
+        if time() - self._last_sync > self.fsync_interval:
+            self._sync()
+
+    def _sync(self):
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        self._last_sync = time()
+
+    def close(self):
+        if self._file:
+            self.flush()
+            self._sync()
+            self._file.close()
+            self._file = None
+
+    def finalize(self,npy_path):
+        """
+        close the log, save the data as .npy (with the same layout as np.save(np.asarray(list_of_records)) )
+        and remove the log file.
+        returns the data.
+        """
+        self.close()
+        data = load_record_log(self.path)
+        np.save(npy_path,data)
+        os.remove(self.path)
+        return data
+
+
+def load_record_log(path):
+    """
+    read a record log, also a partially written one (e.g. after a crash):
+    a trailing incomplete record is ignored.
+    Single column logs are returned as 1d array.
+    """
+    with open(path,'rb') as f:
+        magic,n_columns,_ = struct.unpack('8sII',f.read(header_size))
+        if magic != header_magic:
+            raise IOError("%s is not a record log."%path)
+        raw = f.read()
+    record_size = 8*n_columns
+    n_records = len(raw)//record_size
+    if len(raw) % record_size:
+        logger.warning("Ignoring incomplete last record in %s"%path)
+    data = np.fromstring(raw[:n_records*record_size],dtype=np.float64).reshape(n_records,n_columns)
+    if n_columns == 1:
+        return data[:,0]
+    return data
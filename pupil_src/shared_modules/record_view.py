@@ -0,0 +1,101 @@
+'''
+(*)~----------------------------------------------------------------------------------
+ Pupil - eye tracking platform
+ Copyright (C) 2012-2014  Pupil Labs
+
+ Distributed under the terms of the CC BY-NC-SA License.
+ License details are in the file license.txt, distributed as part of this software.
+----------------------------------------------------------------------------------~(*)
+'''
+
+"""
+dict like views on single rows of numpy record arrays.
+
+Pupil and gaze data is kept in structured arrays (ring buffer, gaze store),
+plugins are written for one dict per datum. A Record_View reads the dict values
+from the array row on access instead of building the dict.
+"""
+
+#logging
+import logging
+logger = logging.getLogger(__name__)
+
+
+class Record_View(object):
+    """
+    dict like view on one row of a structured array.
+
+    Subclasses describe their dtype with key_map: dict key -> field name, or a function
+    taking the view for values that are derived from other keys.
+    key_map = None exposes the dtype fields one to one.
+    With nan_is_none vectors that are nan read as None.
+
+    The records may be memory mapped read-only. Values set by plugins are kept in a small
+    per datum dict and shadow the record.
+    """
+    __slots__ = ('records','row','_edits')
+    key_map = None
+    nan_is_none = False
+
+    def __init__(self,records,row):
+        self.records = records
+        self.row = row
+        self._edits = None
+
+    def __getitem__(self,key):
+        if self._edits and key in self._edits:
+            return self._edits[key]
+        field = key
+        if self.key_map is not None:
+            try:
+                field = self.key_map[key]
+            except KeyError:
+                raise KeyError(key)
+            if not isinstance(field,str):
+                return field(self)
+        try:
+            value = self.records[field][self.row]
+        except ValueError:
+            raise KeyError(key)
+        if value.shape:
+            if self.nan_is_none and value[0] != value[0]: #nan
+                return None
+            return tuple(value.tolist())
+        return float(value)
+
+    def __setitem__(self,key,value):
+        if self._edits is None:
+            self._edits = {}
+        self._edits[key] = value
+
+    def record_keys(self):
+        """
+        the keys this row has in the record, without the edits
+        """
+        if self.key_map is None:
+            return list(self.records.dtype.names)
+        return list(self.key_map)
+
+    def __contains__(self,key):
+        return key in self.record_keys() or bool(self._edits and key in self._edits)
+
+    has_key = __contains__
+
+    def get(self,key,default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def keys(self):
+        keys = self.record_keys()
+        if self._edits:
+            keys += [k for k in self._edits if k not in keys]
+        return keys
+
+    def iteritems(self):
+        for key in self.keys():
+            yield key,self[key]
+
+    def __repr__(self):
+        return '%s(%s)'%(self.__class__.__name__,dict(self.iteritems()))
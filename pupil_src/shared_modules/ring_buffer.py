@@ -0,0 +1,286 @@
+'''
+(*)~----------------------------------------------------------------------------------
+ Pupil - eye tracking platform
+ Copyright (C) 2012-2014  Pupil Labs
+
+ Distributed under the terms of the CC BY-NC-SA License.
+ License details are in the file license.txt, distributed as part of this software.
+----------------------------------------------------------------------------------~(*)
+'''
+
+"""
+Lock-free single producer / single consumer ring buffer in shared memory.
+
+It replaces the pickling multiprocessing.Queue for pupil results:
+The eye process writes one fixed size record per frame, the world process drains all new records.
+No locks, no pickling: the producer only ever writes the head counter, the consumer only the tail counter.
+Both counters count up forever, the slot of a record is counter % capacity.
+When the buffer is full new records are dropped (and counted), the producer never waits on the consumer.
+"""
+
+import platform
+from ctypes import c_char, c_longlong
+import numpy as np
+from record_view import Record_View
+if platform.system() == 'Darwin':
+    from billiard.sharedctypes import RawArray, RawValue
+else:
+    from multiprocessing.sharedctypes import RawArray, RawValue
+del platform
+
+#logging
+import logging
+logger = logging.getLogger(__name__)
+
+
+# fixed size record for one pupil result. Not detected pupils have norm_pupil == nan,
+# norm_gaze is nan until the world process maps the pupil position.
+pupil_dtype = np.dtype([('timestamp',np.float64),
+                        ('confidence',np.float64),
+                        ('norm_pupil',np.float64,(2,)),
+                        ('center',np.float64,(2,)),
+                        ('axes',np.float64,(2,)),
+                        ('angle',np.float64),
+                        ('norm_gaze',np.float64,(2,))])
+
+
+def pupil_datum_to_record(datum,record):
+    """
+    write a pupil result dict (as returned by the detectors) into a pupil_dtype record
+    """
+    record['timestamp'] = datum['timestamp']
+    record['confidence'] = datum.get('confidence',0.)
+    if datum['norm_pupil'] is None:
+        record['norm_pupil'] = np.nan
+    else:
+        record['norm_pupil'] = datum['norm_pupil']
+    record['center'] = datum.get('center',(np.nan,np.nan))
+    record['axes'] = datum.get('axes',(np.nan,np.nan))
+    angle = datum.get('angle',None)
+    record['angle'] = np.nan if angle is None else angle
+    norm_gaze = datum.get('norm_gaze',None)
+    record['norm_gaze'] = np.nan if norm_gaze is None else norm_gaze
+
+
+def record_to_pupil_datum(record):
+    """
+    make the dict plugins expect from a pupil_dtype record
+    """
+    norm_pupil = record['norm_pupil']
+    if norm_pupil[0] != norm_pupil[0]: #nan
+        return {'timestamp':float(record['timestamp']),'norm_pupil':None,'norm_gaze':None}
+    axes = tuple(record['axes'])
+    norm_gaze = record['norm_gaze']
+    datum = {'timestamp':float(record['timestamp']),
+            'confidence':float(record['confidence']),
+            'norm_pupil':tuple(norm_pupil),
+            'norm_gaze':None if norm_gaze[0] != norm_gaze[0] else tuple(norm_gaze),
+            'center':tuple(record['center']),
+            'axes':axes,
+            'angle':float(record['angle']),
+            'major':max(axes),
+            'minor':min(axes),
+            'apparent_pupil_size':max(axes)}
+    return datum
+
+
+def _axes_value(pick):
+    def value(datum):
+        axes = datum['axes']
+        if axes is None:
+            return None
+        return pick(axes)
+    return value
+
+
+class Pupil_Datum(Record_View):
+    """
+    dict like view on one pupil_dtype record, for plugins written for the pupil result dicts.
+
+    Vectors that are nan (pupil not detected, gaze not mapped) read as None like in the dicts,
+    major, minor and apparent_pupil_size are derived from axes.
+    Values set by plugins (e.g. Marker_Detector's 'realtime gaze on ...') shadow the record.
+    """
+    __slots__ = ()
+    key_map = dict([(name,name) for name in pupil_dtype.names],
+                    major=_axes_value(max),
+                    minor=_axes_value(min),
+                    apparent_pupil_size=_axes_value(max))
+    nan_is_none = True
+
+    def record_keys(self):
+        norm_pupil = self.records['norm_pupil'][self.row]
+        if norm_pupil[0] != norm_pupil[0]: #nan
+            # not detected, same keys as the dicts of record_to_pupil_datum
+            return ['timestamp','norm_pupil','norm_gaze']
+        return list(self.key_map)
+
+
+class Pupil_Positions(list):
+    """
+    the pupil positions handed to plugins with one world frame:
+    a list of Pupil_Datum (one per record) for plugins that iterate over dicts
+    and the pupil_dtype batch itself as .records for code that works on columns.
+    """
+    def __init__(self,records):
+        super(Pupil_Positions, self).__init__([Pupil_Datum(records,row) for row in xrange(records.shape[0])])
+        self.records = records
+
+
+class Ring_Buffer(object):
+    """
+    single producer / single consumer ring buffer of fixed size records in shared memory.
+
+    Create it before spawning the processes and hand it over (e.g. via g_pool).
+    The producer calls put(), the consumer calls get_all() or empty()/get().
+    """
+    def __init__(self, capacity=1024, dtype=pupil_dtype):
+        self.capacity = int(capacity)
+        self.dtype = np.dtype(dtype)
+        self._raw_data = RawArray(c_char,self.capacity*self.dtype.itemsize)
+        self._head = RawValue(c_longlong,0) # written by producer only
+        self._tail = RawValue(c_longlong,0) # written by consumer only
+        self._dropped = RawValue(c_longlong,0) # written by producer only
+        self._make_views()
+
+    def _make_views(self):
+        self._data = np.frombuffer(self._raw_data,dtype=self.dtype,count=self.capacity)
+        self._out = np.empty(1,dtype=self.dtype)[0]
+
+    # the numpy views cannot be pickled when the buffer is handed to a spawned process
+    def __getstate__(self):
+        return self.capacity,self.dtype,self._raw_data,self._head,self._tail,self._dropped
+
+    def __setstate__(self,state):
+        self.capacity,self.dtype,self._raw_data,self._head,self._tail,self._dropped = state
+        self._make_views()
+
+    @property
+    def dropped(self):
+        return self._dropped.value
+
+    def __len__(self):
+        return self._head.value - self._tail.value
+
+    def empty(self):
+        return self._head.value == self._tail.value
+
+    def full(self):
+        return self._head.value - self._tail.value >= self.capacity
+
+    ### producer side
+    def put_record(self,record):
+        head = self._head.value
+        if head - self._tail.value >= self.capacity:
+            self._dropped.value += 1
+            return False
+        self._data[head % self.capacity] = record
+        # publish only after the record is written
+        self._head.value = head + 1
+        return True
+
+    def put(self,datum):
+        """
+        put a pupil result dict
+        """
+        pupil_datum_to_record(datum,self._out)
+        return self.put_record(self._out)
+
+    ### consumer side
+    def get_records(self):
+        """
+        return a copy of all records that are available and release their slots.
+        """
+        tail = self._tail.value
+        head = self._head.value
+        if head == tail:
+            return np.empty(0,dtype=self.dtype)
+        start,stop = tail % self.capacity, head % self.capacity
+        if start < stop:
+            records = self._data[start:stop].copy()
+        else:
+            records = np.concatenate((self._data[start:],self._data[:stop]))
+        self._tail.value = head
+        return records
+
+    def get_all(self):
+        """
+        drain the buffer: returns a list of pupil result dicts in the order they were put.
+        """
+        return [record_to_pupil_datum(r) for r in self.get_records()]
+
+    def get(self):
+        """
+        Queue like access to the oldest record as pupil result dict. Raises IndexError when empty.
+        """
+        tail = self._tail.value
+        if tail == self._head.value:
+            raise IndexError("Ring buffer is empty")
+        datum = record_to_pupil_datum(self._data[tail % self.capacity])
+        self._tail.value = tail + 1
+        return datum
+
+    def close(self):
+        pass
+
+
+
+### Microbenchmark: Ring_Buffer vs multiprocessing.Queue
+def _bench_producer(channel,n,rate):
+    from time import time,sleep
+    datum = {'timestamp':0.,'confidence':.9,'norm_pupil':(.5,.5),'center':(320.,180.),
+            'axes':(60.,55.),'angle':12.,'major':60.,'minor':55.,'ellipse':((20.,20.),(60.,55.),12.),
+            'pos_in_roi':(20.,20.),'apparent_pupil_size':60.}
+    for i in xrange(n):
+        datum['timestamp'] = time()
+        channel.put(datum)
+        if rate:
+            sleep(1./rate)
+
+def _bench_consumer(channel,n,is_ring):
+    from time import time
+    latencies = []
+    while len(latencies) < n:
+        if is_ring:
+            data = channel.get_all()
+        else:
+            data = []
+            while not channel.empty():
+                data.append(channel.get())
+        now = time()
+        latencies += [now-d['timestamp'] for d in data]
+    return np.array(latencies)
+
+def benchmark(n=20000,rate=0):
+    from time import time
+    import platform
+    if platform.system() == 'Darwin':
+        from billiard import Process,Queue,forking_enable
+    else:
+        from multiprocessing import Process,Queue
+        forking_enable = lambda x: x
+    forking_enable(0)
+
+    results = {}
+    for name,channel in (('Queue',Queue()),('Ring_Buffer',Ring_Buffer(capacity=max(1024,n)))):
+        p = Process(target=_bench_producer,args=(channel,n,rate))
+        start = time()
+        p.start()
+        latencies = _bench_consumer(channel,n,name=='Ring_Buffer')
+        duration = time()-start
+        p.join()
+        results[name] = {'throughput':n/duration,
+                        'latency_mean':latencies.mean(),
+                        'latency_p50':np.percentile(latencies,50),
+                        'latency_p99':np.percentile(latencies,99)}
+    return results
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.DEBUG)
+    for rate,label in ((0,'as fast as possible'),(120,'120Hz eye camera')):
+        n = 20000 if not rate else 600
+        print "%s, %s pupil results:"%(label,n)
+        for name,r in benchmark(n,rate).iteritems():
+            print "  %-12s %9.0f results/s  latency mean %7.3fms  p50 %7.3fms  p99 %7.3fms"%(name,r['throughput'],
+                        r['latency_mean']*1000,r['latency_p50']*1000,r['latency_p99']*1000)
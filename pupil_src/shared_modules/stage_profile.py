@@ -0,0 +1,69 @@
+'''
+(*)~----------------------------------------------------------------------------------
+ Pupil - eye tracking platform
+ Copyright (C) 2012-2014  Pupil Labs
+
+ Distributed under the terms of the CC BY-NC-SA License.
+ License details are in the file license.txt, distributed as part of this software.
+----------------------------------------------------------------------------------~(*)
+'''
+
+from time import time
+from ctypes import c_float
+#logging
+import logging
+logger = logging.getLogger(__name__)
+
+
+class Stage_Profile(object):
+    """
+    per stage timing of a detector (pupil detectors, the calibration marker detector).
+    start() and finish() bracket one call of detect(),
+    detect() calls mark(stage) at the end of each of its stages and the time since the previous mark is booked on that stage.
+    Stages a frame did not reach (early return) count with 0 for that frame.
+    times and total are running averages in ms as c_floats, ready to be shown in an atb bar.
+    frame_times holds the seconds spent in each stage in the last frame.
+    """
+    def __init__(self, stages, smoothing=.05, log_interval=30.):
+        super(Stage_Profile, self).__init__()
+        self.stages = stages
+        self.smoothing = smoothing
+        self.log_interval = log_interval #seconds
+        self.times = dict([(stage,c_float(0)) for stage in stages])
+        self.total = c_float(0)
+        self.frame_times = dict.fromkeys(stages,0.)
+        self._start = None
+        self._last = None
+        self._last_log = time()
+
+    def start(self):
+        for stage in self.stages:
+            self.frame_times[stage] = 0.
+        self._start = self._last = time()
+
+    def mark(self,stage):
+        #no-op when detect() is called without start(), i.e. not profiled
+        if self._last is not None:
+            now = time()
+            self.frame_times[stage] += now-self._last
+            self._last = now
+
+    def finish(self):
+        now = time()
+        a = self.smoothing
+        for stage in self.stages:
+            t = self.times[stage]
+            t.value += a * (self.frame_times[stage]*1000. - t.value)
+        self.total.value += a * ((now-self._start)*1000. - self.total.value)
+        self._start = self._last = None
+        if now-self._last_log > self.log_interval:
+            self._last_log = now
+            logger.info(self.report())
+
+    def report(self):
+        return "%.2fms per frame: "%self.total.value + ", ".join(["%s %.2fms"%(stage,self.times[stage].value) for stage in self.stages])
+
+    def add_to_bar(self,bar):
+        for stage in self.stages:
+            bar.add_var("%s ms"%stage,self.times[stage],readonly=True,group="timing")
+        bar.add_var("total ms",self.total,readonly=True,group="timing")
@@ -41,6 +41,10 @@ elif os_name == "Darwin":
 else:
     from other_video import Camera_Capture,Camera_List
 
+from avi_index import load_keyframe_index
+from frame_cache import Frame_Cache
+from read_ahead import Read_Ahead_Capture
+
 
 # non os specific defines
 class Frame(object):
@@ -58,8 +62,14 @@ class Frame(object):
 class FileCapture():
     """
     simple file capture.
+
+    We keep track of the frame index ourselves and only move the decoder when a frame is not where we expect it.
+    Seeks go to the last keyframe before the target (from the keyframe index) and decode forward from there.
+    This is frame accurate and much faster than CV_CAP_PROP_POS_FRAMES on a non keyframe.
+    With cache_size_mb > 0 decoded images are kept in a LRU cache:
+    Frames returned from the cache share their image with it; copy() the frame before drawing into it.
     """
-    def __init__(self,src,timestamps=None):
+    def __init__(self,src,timestamps=None,cache_size_mb=0):
         self.auto_rewind = True
         self.controls = None #No UVC controls available with file capture
         # we initialize the actual capture based on cv2.VideoCapture
@@ -77,6 +87,13 @@ class FileCapture():
             logger.debug("did not find timestamps")
             self.timestamps = None
 
+        self.keyframes = load_keyframe_index(src)
+        if self.keyframes is None:
+            logger.debug("No keyframe index, seeking with cv2.VideoCapture.")
+        self.frame_cache = Frame_Cache(cache_size_mb) if cache_size_mb else None
+        self._next_index = 0 #index of the frame get_frame returns next
+        self._decoder_index = 0 #index of the frame the decoder returns next
+
 
     def get_size(self):
         width,height = int(self.cap.get(cv2.cv.CV_CAP_PROP_FRAME_WIDTH)),int(self.cap.get(cv2.cv.CV_CAP_PROP_FRAME_HEIGHT))
@@ -94,7 +111,7 @@ class FileCapture():
         return fps
 
     def get_frame_index(self):
-        return int(self.cap.get(cv2.cv.CV_CAP_PROP_POS_FRAMES))
+        return self._next_index
 
     def get_frame_count(self):
         if self.timestamps is None:
@@ -103,11 +120,15 @@ class FileCapture():
         return len(self.timestamps)
 
     def get_frame(self):
-        idx = int(self.cap.get(cv2.cv.CV_CAP_PROP_POS_FRAMES))
-        s, img = self.cap.read()
-        if not s:
-            logger.warning("Reached end of video file.")
-            return None
+        idx = self._next_index
+        img = None
+        if self.frame_cache is not None:
+            img = self.frame_cache.get(idx)
+        if img is None:
+            img = self._decode(idx)
+            if img is None:
+                logger.warning("Reached end of video file.")
+                return None
         if self.timestamps:
             try:
                 timestamp = self.timestamps[idx]
@@ -116,34 +137,66 @@ class FileCapture():
                 return None
         else:
             timestamp = time()
+        self._next_index = idx+1
         return Frame(timestamp,img,index=idx)
 
+    def _decode(self,idx):
+        if self._decoder_index != idx and not self._move_decoder(idx):
+            return None
+        s, img = self.cap.read()
+        if not s:
+            self._decoder_index = -1 #unknown, force a seek next time
+            return None
+        self._decoder_index = idx+1
+        if self.frame_cache is not None:
+            self.frame_cache.put(idx,img)
+        return img
+
+    def _move_decoder(self,idx):
+        """
+        position the decoder so that the next read returns frame idx.
+        """
+        if self.keyframes is None:
+            if self.cap.set(cv2.cv.CV_CAP_PROP_POS_FRAMES,idx):
+                self._decoder_index = idx
+                return True
+            logger.error("Could not perform seek on cv2.VideoCapture. Command gave negative return.")
+            return False
+
+        i = np.searchsorted(self.keyframes,idx,side='right')-1
+        keyframe = self.keyframes[i] if i >= 0 else 0
+        #decoding forward from where we are is cheaper than a seek if we are between the keyframe and the target.
+        if not keyframe <= self._decoder_index <= idx:
+            if not self.cap.set(cv2.cv.CV_CAP_PROP_POS_FRAMES,int(keyframe)):
+                logger.error("Could not perform seek on cv2.VideoCapture. Command gave negative return.")
+                return False
+            self._decoder_index = int(keyframe)
+        while self._decoder_index < idx:
+            s, img = self.cap.read()
+            if not s:
+                logger.error("Could not seek to position %s" %idx)
+                self._decoder_index = -1
+                return False
+            if self.frame_cache is not None:
+                self.frame_cache.put(self._decoder_index,img)
+            self._decoder_index += 1
+        return True
+
     def seek_to_frame(self, seek_pos):
         logger.debug("seeking to frame: %s"%seek_pos)
-        if self.cap.set(cv2.cv.CV_CAP_PROP_POS_FRAMES,seek_pos):
-            return True
-        logger.error("Could not perform seek on cv2.VideoCapture. Command gave negative return.")
-        return False
-
+        seek_pos = int(seek_pos)
+        if seek_pos < 0 or (self.timestamps and seek_pos >= len(self.timestamps)):
+            logger.error("Could not seek to position %s, it is out of range." %seek_pos)
+            return False
+        #the decoder is moved lazily by the next get_frame, it may well find the frame in the cache.
+        self._next_index = seek_pos
+        return True
 
     def seek_to_frame_prefetch(self, seek_pos):
-        prefetch = 10
-        logger.debug("seeking to frame: %s"%seek_pos)
-        if self.cap.set(cv2.cv.CV_CAP_PROP_POS_FRAMES,int(seek_pos)-prefetch):
-            while self.cap.get(cv2.cv.CV_CAP_PROP_POS_FRAMES) < seek_pos:
-                print "seek:",self.cap.get(cv2.cv.CV_CAP_PROP_POS_FRAMES)
-                s,_=self.cap.read()
-                if not s:
-                    logger.error("Could not seek to position %s" %seek_pos)
-                    return
-                prefetch -=1
-                if prefetch < -10:
-                    logger.error("Could not seek to position %s stepped out of prefetch" %seek_pos)
-                    return
-            logger.debug("Sucsessful seek to %s" %self.cap.get(cv2.cv.CV_CAP_PROP_POS_FRAMES))
-            return True
-        logger.error("Could not perform seek on cv2.VideoCapture. Command gave negative return.")
-        return
+        """
+        seek_to_frame is frame accurate now, kept for compatibility.
+        """
+        return self.seek_to_frame(seek_pos)
 
     def create_atb_bar(self,pos):
         return 0,0
@@ -155,7 +208,7 @@ class FileCapture():
         pass
 
 
-def autoCreateCapture(src,size=(640,480),fps=30,timestamps=None):
+def autoCreateCapture(src,size=(640,480),fps=30,timestamps=None,cache_size_mb=0):
     # checking src and handling all cases:
     src_type = type(src)
 
@@ -196,7 +249,7 @@ def autoCreateCapture(src,size=(640,480),fps=30,timestamps=None):
             logger.error('Could not locate VideoFile %s'%src)
             return
         logger.info("Using %s as video source"%src)
-        return FileCapture(src,timestamps=timestamps)
+        return FileCapture(src,timestamps=timestamps,cache_size_mb=cache_size_mb)
     else:
         raise Exception("autoCreateCapture: Could not create capture, wrong src_type")
 
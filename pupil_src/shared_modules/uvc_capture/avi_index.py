@@ -0,0 +1,86 @@
+'''
+(*)~----------------------------------------------------------------------------------
+ Pupil - eye tracking platform
+ Copyright (C) 2012-2014  Pupil Labs
+
+ Distributed under the terms of the CC BY-NC-SA License.
+ License details are in the file license.txt, distributed as part of this software.
+----------------------------------------------------------------------------------~(*)
+'''
+
+"""
+Keyframe index of AVI files.
+
+cv2.VideoCapture cannot tell us where the keyframes of a video are and
+seeking with CV_CAP_PROP_POS_FRAMES to a frame that is not a keyframe is slow and not always accurate.
+The legacy 'idx1' index chunk of an AVI file lists every chunk of the movie with a keyframe flag.
+We read it once and keep the frame indices of all keyframes next to the video as <video>_keyframes.npy.
+"""
+
+import os
+import struct
+import numpy as np
+#logging
+import logging
+logger = logging.getLogger(__name__)
+
+AVIIF_KEYFRAME = 0x10
+
+
+def read_avi_keyframes(video_path):
+    """
+    return a sorted int array with the frame indices of all keyframes of the first video stream
+    or None if the file has no idx1 index.
+    """
+    with open(video_path,'rb') as f:
+        riff,_,form = struct.unpack('<4sI4s',f.read(12))
+        if riff != 'RIFF' or form != 'AVI ':
+            logger.debug("%s is not an AVI file."%video_path)
+            return None
+        while True:
+            header = f.read(8)
+            if len(header) < 8:
+                logger.debug("%s has no idx1 index."%video_path)
+                return None
+            chunk_id,chunk_size = struct.unpack('<4sI',header)
+            if chunk_id == 'idx1':
+                raw = f.read(chunk_size)
+                break
+            f.seek(chunk_size+(chunk_size&1),os.SEEK_CUR)
+
+    # one 16 byte entry per chunk: id, flags, offset, size
+    entries = np.fromstring(raw[:len(raw)//16*16],dtype=[('id','S4'),('flags','<u4'),('offset','<u4'),('size','<u4')])
+    is_video = np.array([i[2:] in ('dc','db') for i in entries['id']],dtype=bool)
+    if not is_video.any():
+        return None
+    #only the first video stream
+    first_stream = entries['id'][is_video][0][:2]
+    video_entries = entries[is_video & (np.array([i[:2] for i in entries['id']]) == first_stream)]
+    return np.flatnonzero(video_entries['flags'] & AVIIF_KEYFRAME)
+
+
+def load_keyframe_index(video_path):
+    """
+    load the keyframe index stored next to the video, build (and store) it if it does not exist or is outdated.
+    returns a sorted int array of keyframe indices or None if no index could be made.
+    """
+    index_path = os.path.splitext(video_path)[0] + '_keyframes.npy'
+    try:
+        if os.path.getmtime(index_path) >= os.path.getmtime(video_path):
+            return np.load(index_path)
+    except (OSError,IOError):
+        pass
+
+    try:
+        keyframes = read_avi_keyframes(video_path)
+    except (IOError,struct.error) as e:
+        logger.warning("Could not read keyframe index of %s: %s"%(video_path,e))
+        return None
+    if keyframes is None or len(keyframes) == 0:
+        return None
+    try:
+        np.save(index_path,keyframes)
+    except IOError:
+        logger.debug("Could not save keyframe index to %s"%index_path)
+    logger.debug("Built keyframe index for %s: %s keyframes"%(video_path,len(keyframes)))
+    return keyframes
@@ -0,0 +1,54 @@
+'''
+(*)~----------------------------------------------------------------------------------
+ Pupil - eye tracking platform
+ Copyright (C) 2012-2014  Pupil Labs
+
+ Distributed under the terms of the CC BY-NC-SA License.
+ License details are in the file license.txt, distributed as part of this software.
+----------------------------------------------------------------------------------~(*)
+'''
+
+from collections import OrderedDict
+
+
+class Frame_Cache(object):
+    """
+    least recently used cache of decoded images by frame index.
+    The memory used by the images is bounded by max_size_mb.
+    """
+    def __init__(self, max_size_mb=256):
+        super(Frame_Cache, self).__init__()
+        self.max_bytes = int(max_size_mb*1024*1024)
+        self.n_bytes = 0
+        self._images = OrderedDict()
+
+    def __contains__(self,index):
+        return index in self._images
+
+    def __len__(self):
+        return len(self._images)
+
+    def get(self,index):
+        """
+        return the image of frame index (and mark it as recently used) or None
+        """
+        img = self._images.pop(index,None)
+        if img is not None:
+            self._images[index] = img
+        return img
+
+    def put(self,index,img):
+        old = self._images.pop(index,None)
+        if old is not None:
+            self.n_bytes -= old.nbytes
+        if img.nbytes > self.max_bytes:
+            return
+        self._images[index] = img
+        self.n_bytes += img.nbytes
+        while self.n_bytes > self.max_bytes:
+            _,evicted = self._images.popitem(last=False)
+            self.n_bytes -= evicted.nbytes
+
+    def clear(self):
+        self._images.clear()
+        self.n_bytes = 0
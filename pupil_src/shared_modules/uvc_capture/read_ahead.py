@@ -0,0 +1,110 @@
+'''
+(*)~----------------------------------------------------------------------------------
+ Pupil - eye tracking platform
+ Copyright (C) 2012-2014  Pupil Labs
+
+ Distributed under the terms of the CC BY-NC-SA License.
+ License details are in the file license.txt, distributed as part of this software.
+----------------------------------------------------------------------------------~(*)
+'''
+
+from threading import Thread, Condition
+from collections import deque
+#logging
+import logging
+logger = logging.getLogger(__name__)
+
+
+class Read_Ahead_Capture(object):
+    """
+    wraps a FileCapture and decodes frames on a background thread into a bounded queue.
+
+    get_frame() takes the next frame from the queue, so decode spikes are hidden as long as the queue is not empty.
+    The wrapped capture is only ever used by the decode thread.
+    When the consumer stops calling get_frame() (paused) the thread fills the queue and waits.
+    seek_to_frame() flushes the queue, frames decoded before the seek are never returned.
+    All other attributes are taken from the wrapped capture.
+    """
+    def __init__(self, capture, max_queue_size=10):
+        super(Read_Ahead_Capture, self).__init__()
+        self.capture = capture
+        self.max_queue_size = max_queue_size
+
+        self._queue = deque()
+        self._cond = Condition()
+        self._generation = 0 # incremented with every seek, frames of older generations are discarded
+        self._seek_pos = None # seek that the decode thread still has to perform
+        self._at_end = False
+        self._closing = False
+        self._next_index = capture.get_frame_index()
+
+        self._thread = Thread(target=self._decode_loop,name='Read_Ahead_Capture')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def __getattr__(self,name):
+        return getattr(self.capture,name)
+
+    def _decode_loop(self):
+        while True:
+            with self._cond:
+                while not self._closing and self._seek_pos is None and (self._at_end or len(self._queue) >= self.max_queue_size):
+                    self._cond.wait()
+                if self._closing:
+                    break
+                if self._seek_pos is not None:
+                    self.capture.seek_to_frame(self._seek_pos)
+                    self._seek_pos = None
+                generation = self._generation
+
+            frame = self.capture.get_frame()
+
+            with self._cond:
+                if generation == self._generation:
+                    if frame is None:
+                        self._at_end = True
+                    else:
+                        self._queue.append(frame)
+                    self._cond.notify_all()
+
+    def get_frame(self):
+        """
+        next frame or None at the end of the video.
+        """
+        with self._cond:
+            while not self._queue and not self._at_end:
+                self._cond.wait()
+            if not self._queue:
+                return None
+            frame = self._queue.popleft()
+            self._cond.notify_all()
+        self._next_index = frame.index+1
+        return frame
+
+    def get_frame_index(self):
+        return self._next_index
+
+    def seek_to_frame(self,seek_pos):
+        seek_pos = int(seek_pos)
+        timestamps = self.capture.timestamps
+        if seek_pos < 0 or (timestamps and seek_pos >= len(timestamps)):
+            logger.error("Could not seek to position %s, it is out of range." %seek_pos)
+            return False
+        with self._cond:
+            self._generation += 1
+            self._queue.clear()
+            self._at_end = False
+            self._seek_pos = seek_pos
+            self._cond.notify_all()
+        self._next_index = seek_pos
+        return True
+
+    def seek_to_frame_prefetch(self,seek_pos):
+        return self.seek_to_frame(seek_pos)
+
+    def close(self):
+        with self._cond:
+            self._closing = True
+            self._cond.notify_all()
+        self._thread.join()
+        self.capture.close()
@@ -0,0 +1,116 @@
+'''
+(*)~----------------------------------------------------------------------------------
+ Pupil - eye tracking platform
+ Copyright (C) 2012-2014  Pupil Labs
+
+ Distributed under the terms of the CC BY-NC-SA License.
+ License details are in the file license.txt, distributed as part of this software.
+----------------------------------------------------------------------------------~(*)
+'''
+
+import cv2
+from threading import Thread, Condition
+from collections import deque
+from time import time
+#logging
+import logging
+logger = logging.getLogger(__name__)
+
+
+# what to do when the encoder falls behind and the frame queue is full:
+#   block:       the capture loop waits for a free slot (no frames lost, capture fps drops)
+#   drop_oldest: the oldest queued frame is discarded to make room
+#   drop_newest: the new frame is discarded
+policies = ('block','drop_oldest','drop_newest')
+
+
+class Async_Video_Writer(object):
+    """
+    cv2.VideoWriter that encodes on a worker thread.
+
+    write() only queues a copy of the image, encoding happens in the background
+    so an encoder hiccup does not stall the capture loop.
+    The timestamps of the frames that actually made it into the video file are appended to self.timestamps
+    (a list or anything with append() like a record_log.Record_Log).
+
+    counters:
+        dropped_frames: frames discarded by the backpressure policy
+        late_frames: frames that waited longer than one frame interval in the queue before being encoded
+    """
+    def __init__(self, video_path, fourcc, fps, size, max_queue_size=30, policy='block',timestamps=None):
+        super(Async_Video_Writer, self).__init__()
+        if policy not in policies:
+            raise Exception("Async_Video_Writer: Unknown backpressure policy '%s', use one of %s"%(policy,policies))
+        self.video_path = video_path
+        self.policy = policy
+        self.max_queue_size = max_queue_size
+        self.frame_interval = 1./fps if fps else 1/30.
+
+        self.writer = cv2.VideoWriter(video_path, cv2.cv.CV_FOURCC(*fourcc), fps, size)
+
+        if timestamps is None:
+            timestamps = []
+        self.timestamps = timestamps
+        self.dropped_frames = 0
+        self.late_frames = 0
+
+        self._queue = deque()
+        self._cond = Condition()
+        self._closing = False
+        self._thread = Thread(target=self._encode_loop,name='Async_Video_Writer')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def write(self,img,timestamp):
+        """
+        queue a frame for encoding. Returns False if the frame was dropped.
+        """
+        with self._cond:
+            if len(self._queue) >= self.max_queue_size:
+                if self.policy == 'block':
+                    while len(self._queue) >= self.max_queue_size:
+                        self._cond.wait()
+                elif self.policy == 'drop_oldest':
+                    self._queue.popleft()
+                    self.dropped_frames += 1
+                else:
+                    self.dropped_frames += 1
+                    return False
+            self._queue.append((img.copy(),timestamp,time()))
+            self._cond.notify_all()
+        return True
+
+    def _encode_loop(self):
+        while True:
+            with self._cond:
+                while not self._queue and not self._closing:
+                    self._cond.wait()
+                if not self._queue:
+                    break
+                img,timestamp,queue_time = self._queue.popleft()
+                self._cond.notify_all()
+
+            if time()-queue_time > self.frame_interval:
+                self.late_frames += 1
+            self.writer.write(img)
+            self.timestamps.append(timestamp)
+
+    def release(self):
+        """
+        encode all queued frames, stop the worker and release the VideoWriter.
+        """
+        with self._cond:
+            self._closing = True
+            self._cond.notify_all()
+        self._thread.join()
+        #explicit release of VideoWriter
+        self.writer.release()
+        self.writer = None
+        if self.dropped_frames or self.late_frames:
+            logger.warning("Video writer for %s: %s frames dropped, %s frames late."%(self.video_path,self.dropped_frames,self.late_frames))
+
+    def meta_info(self,prefix):
+        """
+        lines for info.csv
+        """
+        return prefix+" Dropped Frames\t"+str(self.dropped_frames)+"\n" + prefix+" Late Frames\t"+str(self.late_frames)+"\n"